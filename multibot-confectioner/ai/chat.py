@@ -1,61 +1,109 @@
-import openai
-from config import settings
-from typing import Optional
+from ai.prompts import prompts
+from ai.response_cache import is_faq_question, response_cache
+from ai.router import Reply, router
+from core.deadline import DeadlineExceeded, stream_within_deadline, within_deadline
+from typing import AsyncIterator, List, Optional
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Установка API ключа OpenAI
-openai.api_key = settings.openai_api_key
-if settings.openai_org_id:
-    openai.organization = settings.openai_org_id
+ERROR_RESPONSE = "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, повторите попытку позже."
 
 
-async def generate_response(message: str, user_info: dict = None) -> str:
+CHAT_PARAMS = dict(max_tokens=500, temperature=0.7)
+
+
+def _chat_messages(system_prompt: str, message: str, history: Optional[List[dict]] = None) -> List[dict]:
+    return [
+        {"role": "system", "content": system_prompt},
+        *(history or ()),
+        {"role": "user", "content": message}
+    ]
+
+
+async def _complete(system_prompt: str, message: str, history: Optional[List[dict]] = None) -> Reply:
+    reply = await within_deadline(router.complete(_chat_messages(system_prompt, message, history), **CHAT_PARAMS))
+    return reply._replace(text=reply.text.strip())
+
+
+async def generate_response(message: str, user_info: dict = None, cache: bool = False,
+                            history: Optional[List[dict]] = None) -> str:
     """
-    Генерация ответа с помощью GPT-4o-mini
+    Генерация ответа моделью (провайдер выбирает ai.router)
     :param message: Сообщение от пользователя
     :param user_info: Информация о пользователе (возраст, пол и т.д.)
+    :param cache: Брать ответ из кэша частых вопросов (для свободного диалога)
+    :param history: Предыдущие реплики диалога (core.context); частый вопрос (is_faq_question)
+        отвечается без истории - из кэша или новым ответом, который сохраняется в кэш
     :return: Сгенерированный ответ
+    :raises DeadlineExceeded: истек дедлайн сообщения (core.deadline) - ответ выбирает вызывающий
     """
     try:
-        # Подготовка промпта с учетом персонализации
-        age = user_info.get('age') if user_info else None
-        gender = user_info.get('gender') if user_info else None
-        
-        system_prompt = "Ты - AI-помощник кондитера. Помоги клиенту оформить заказ на торт или десерт. "
-        system_prompt += "Уточни детали: вес, форму, начинку, декор, дату доставки. "
-        system_prompt += "Стиль общения адаптируй под клиента. "
-        
-        if age:
-            if age < 18:
-                system_prompt += "Клиент несовершеннолетний, общайся с уважением и осторожно. "
-            elif age > 60:
-                system_prompt += "Клиент пожилой, общайся с уважением и терпением. "
-        
-        if gender:
-            if gender.lower() == 'male':
-                system_prompt += "Клиент мужчина. "
-            elif gender.lower() == 'female':
-                system_prompt += "Клиент женщина. "
-        
-        system_prompt += "Отвечай кратко и по существу, задавай уточняющие вопросы."
-
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": message}
-            ],
-            max_tokens=500,
-            temperature=0.7
-        )
-        
-        return response.choices[0].message.content.strip()
-    
+        # Заранее собранный промпт с учетом персонализации и версии A/B-теста
+        prompt_key, system_prompt = prompts.select(user_info)
+
+        cache = cache and is_faq_question(message)
+        if cache:
+            cached = response_cache.get(prompt_key, message)
+            if cached is not None:
+                return cached
+            # Ответ попадет в кэш для всех клиентов - он не должен зависеть от истории
+            history = None
+
+        reply = await _complete(system_prompt, message, history)
+        # Шаблонный ответ запасного провайдера в кэш не попадает
+        if cache and not reply.fallback:
+            response_cache.set(prompt_key, message, reply.text)
+        return reply.text
+
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при генерации ответа: {e}")
-        return "Извините, произошла ошибка при обработке вашего запроса. Пожалуйста, повторите попытку позже."
+        return ERROR_RESPONSE
+
+
+async def generate_response_stream(message: str, user_info: dict = None, cache: bool = False,
+                                   history: Optional[List[dict]] = None) -> AsyncIterator[str]:
+    """
+    Генерация ответа по частям - для показа ответа по мере генерации
+    Ответ из кэша частых вопросов отдается одним фрагментом. Ошибка до первого
+    фрагмента заменяется извинением, после - ответ обрывается на полученном тексте.
+    Истечение дедлайна сообщения передается вызывающему (DeadlineExceeded)
+    :param message: Сообщение от пользователя
+    :param user_info: Информация о пользователе (возраст, пол и т.д.)
+    :param cache: Брать ответ из кэша частых вопросов и сохранять в него полный ответ
+    :param history: Предыдущие реплики диалога; частый вопрос отвечается без истории
+    :return: Асинхронный итератор фрагментов текста
+    """
+    prompt_key, system_prompt = prompts.select(user_info)
+    cache = cache and is_faq_question(message)
+    if cache:
+        cached = response_cache.get(prompt_key, message)
+        if cached is not None:
+            yield cached
+            return
+        history = None
+
+    parts = []
+    fallback = False
+    try:
+        chunks = router.stream(_chat_messages(system_prompt, message, history), **CHAT_PARAMS)
+        async for chunk in stream_within_deadline(chunks):
+            fallback = chunk.fallback
+            parts.append(chunk.text)
+            yield chunk.text
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка при потоковой генерации ответа: {e}")
+        if not parts:
+            yield ERROR_RESPONSE
+        return
+
+    response = "".join(parts).strip()
+    if cache and response and not fallback:
+        response_cache.set(prompt_key, message, response)
 
 
 async def analyze_order_description(description: str) -> dict:
@@ -63,6 +111,7 @@ async def analyze_order_description(description: str) -> dict:
     Анализ описания заказа для извлечения ключевых параметров
     :param description: Описание заказа от пользователя
     :return: Словарь с извлеченными параметрами
+    :raises DeadlineExceeded: истек дедлайн сообщения
     """
     try:
         prompt = f"""
@@ -78,18 +127,19 @@ async def analyze_order_description(description: str) -> dict:
         Если какая-то информация отсутствует, верни null для этого поля.
         """
         
-        response = await openai.ChatCompletion.acreate(
-            model="gpt-4o-mini",
-            messages=[{"role": "user", "content": prompt}],
+        reply = await within_deadline(router.complete(
+            [{"role": "user", "content": prompt}],
             max_tokens=300,
             temperature=0.3,
             response_format={"type": "json_object"}
-        )
+        ))
         
         import json
-        extracted_info = json.loads(response.choices[0].message.content.strip())
+        extracted_info = json.loads(reply.text.strip())
         return extracted_info
     
+    except DeadlineExceeded:
+        raise
     except Exception as e:
         logger.error(f"Ошибка при анализе описания заказа: {e}")
         return {"weight": None, "ingredients": None, "decor": None, "delivery_date": None}
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+Общий асинхронный клиент OpenAI с ограничением частоты и параллельности запросов
+Все вызовы openai.ChatCompletion.acreate и openai.Image.acreate проходят через ai_client.
+Для каждой модели отдельно:
+- ведра токенов на запросы в минуту и токены в минуту (лимиты тарифа OpenAI): токены
+  запроса оцениваются заранее по длине текста и max_tokens и уточняются по usage ответа;
+- лимит одновременных запросов AIMD: растет примерно на 1 за каждые limit успешных ответов
+  и уменьшается вдвое на 429 и 5xx, поэтому в пик запросы ждут в очереди, а не получают 429;
+- повторы при 429, 5xx и обрыве соединения с экспоненциальной задержкой со случайным
+  разбросом (не меньше Retry-After, если он есть в ответе).
+
+Метрики (префикс ai.<модель>): queue_wait - ожидание лимитов перед отправкой (сек),
+concurrency_limit, in_flight, retries, rate_limited - ответы 429, failures - запросы,
+не выполненные после всех повторов, ttfb - время до первого фрагмента потокового ответа (сек),
+prompt_tokens, cached_tokens (из кэша префикса промпта), completion_tokens - токены на запрос по usage
+"""
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Iterable, Optional
+import logging
+
+import openai
+
+from config import settings
+from core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Установка API ключа OpenAI
+openai.api_key = settings.openai_api_key
+if settings.openai_org_id:
+    openai.organization = settings.openai_org_id
+
+CHAT_MODEL = "gpt-4o-mini"
+IMAGE_MODEL = "dall-e-3"
+# Оценка без токенизатора: в русском тексте около 3 символов на токен (с запасом)
+CHARS_PER_TOKEN = 3
+_RETRYABLE_ERRORS = {'APIConnectionError', 'APITimeoutError', 'Timeout', 'ServiceUnavailableError'}
+
+
+def estimate_tokens(messages: Optional[Iterable[dict]]) -> int:
+    """Оценка числа токенов сообщений чата по длине текста"""
+    chars = sum(len(str(message.get('content') or '')) for message in messages or ())
+    return chars // CHARS_PER_TOKEN + 1
+
+
+def _status(error: Exception) -> Optional[int]:
+    """HTTP-статус ошибки OpenAI (атрибуты различаются между версиями библиотеки)"""
+    for source in (error, getattr(error, 'response', None)):
+        for attr in ('http_status', 'status_code'):
+            value = getattr(source, attr, None)
+            if isinstance(value, int):
+                return value
+    return None
+
+
+def _retry_after(error: Exception) -> Optional[float]:
+    headers = getattr(error, 'headers', None) or getattr(getattr(error, 'response', None), 'headers', None)
+    try:
+        return float(headers.get('retry-after')) if headers else None
+    except (TypeError, ValueError, AttributeError):
+        return None
+
+
+def _usage_value(usage: Any, key: str) -> Optional[int]:
+    """Поле usage ответа (объект или словарь, в зависимости от версии библиотеки)"""
+    value = usage.get(key) if isinstance(usage, dict) else getattr(usage, key, None)
+    return value if isinstance(value, int) else None
+
+
+def is_overload(error: Exception) -> bool:
+    """429, 5xx, таймаут или обрыв соединения - запрос стоит повторить позже"""
+    status = _status(error)
+    if status is not None:
+        return status == 429 or status >= 500
+    return isinstance(error, asyncio.TimeoutError) or type(error).__name__ in _RETRYABLE_ERRORS
+
+
+class TokenBucket:
+    """
+    Ведро токенов, пополняется на rate_per_minute токенов в минуту
+    Токены списываются сразу, в том числе в долг: запрос ждет, пока долг не погасится,
+    поэтому ожидающие запросы проходят в порядке поступления
+    """
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Списание amount токенов; возвращает, сколько секунд ждать их появления"""
+        self._refill()
+        self._tokens -= min(amount, self.capacity)
+        return max(0.0, -self._tokens / self.rate)
+
+    def refund(self, amount: float):
+        """Возврат токенов (отрицательное amount - дополнительное списание)"""
+        self._refill()
+        self._tokens = min(self.capacity, self._tokens + amount)
+
+
+class AIMDLimiter:
+    """Лимит одновременных запросов: аддитивное увеличение, мультипликативное уменьшение"""
+
+    def __init__(self, initial: int, min_limit: int = 1, max_limit: int = 32, decrease: float = 0.5):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self._in_flight = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self):
+        if not self._waiters and self._in_flight < int(self.limit):
+            self._in_flight += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.cancelled():
+                self._waiters.remove(waiter)
+            else:
+                # Место уже выдано, но задача отменена - отдаем его следующему
+                self.release()
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake()
+
+    def on_success(self):
+        self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._wake()
+
+    def on_overload(self):
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+
+    def _wake(self):
+        while self._waiters and self._in_flight < int(self.limit):
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+
+class ModelLimits:
+    """Лимиты и метрики одной модели; 0 в лимитах частоты - без ограничения"""
+
+    def __init__(self, model: str, requests_per_minute: float, tokens_per_minute: float, limiter: AIMDLimiter):
+        self.model = model
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.limiter = limiter
+
+        prefix = f"ai.{model}"
+        self.queue_wait = metrics.histogram(f"{prefix}.queue_wait")
+        self.concurrency_limit = metrics.gauge(f"{prefix}.concurrency_limit")
+        self.in_flight = metrics.gauge(f"{prefix}.in_flight")
+        self.retries = metrics.counter(f"{prefix}.retries")
+        self.rate_limited = metrics.counter(f"{prefix}.rate_limited")
+        self.failures = metrics.counter(f"{prefix}.failures")
+        self.ttfb = metrics.histogram(f"{prefix}.ttfb")
+        self.prompt_tokens = metrics.histogram(f"{prefix}.prompt_tokens")
+        self.cached_tokens = metrics.histogram(f"{prefix}.cached_tokens")
+        self.completion_tokens = metrics.histogram(f"{prefix}.completion_tokens")
+        self._update_gauges()
+
+    def _update_gauges(self):
+        self.concurrency_limit.set(int(self.limiter.limit))
+        self.in_flight.set(self.limiter.in_flight)
+
+    async def admit(self, requests: int, tokens: int):
+        """Ожидание места в ведрах и в лимите одновременных запросов"""
+        started = time.monotonic()
+        delay = self.requests.reserve(requests) if self.requests else 0.0
+        if self.tokens and tokens:
+            delay = max(delay, self.tokens.reserve(tokens))
+        try:
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.limiter.acquire()
+        except asyncio.CancelledError:
+            if self.requests:
+                self.requests.refund(requests)
+            if self.tokens and tokens:
+                self.tokens.refund(tokens)
+            raise
+        self.queue_wait.observe(time.monotonic() - started)
+        self._update_gauges()
+
+    def done(self, success: bool = False, overloaded: bool = False):
+        if success:
+            self.limiter.on_success()
+        elif overloaded:
+            self.limiter.on_overload()
+        self.limiter.release()
+        self._update_gauges()
+
+    def settle(self, estimated: int, response: Any):
+        """Учет токенов запроса по usage ответа и уточнение расхода в ведре токенов"""
+        usage = getattr(response, 'usage', None)
+        used = _usage_value(usage, 'total_tokens')
+        if used is None:
+            return
+        if self.tokens:
+            self.tokens.refund(estimated - used)
+        self.prompt_tokens.observe(_usage_value(usage, 'prompt_tokens') or 0)
+        self.completion_tokens.observe(_usage_value(usage, 'completion_tokens') or 0)
+        # Токены начала промпта, взятые провайдером из кэша префикса
+        self.cached_tokens.observe(_usage_value(getattr(usage, 'prompt_tokens_details', None), 'cached_tokens') or 0)
+
+
+class AIClient:
+    """Вызовы OpenAI с лимитами по моделям и повторами при перегрузке"""
+
+    def __init__(self, max_retries: int = 4, retry_base_delay: float = 0.5, retry_max_delay: float = 20.0,
+                 initial_concurrency: int = 8, min_concurrency: int = 1, max_concurrency: int = 32):
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.initial_concurrency = initial_concurrency
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self._models: Dict[str, ModelLimits] = {}
+
+    def configure(self, model: str, requests_per_minute: float = 0, tokens_per_minute: float = 0) -> ModelLimits:
+        limiter = AIMDLimiter(self.initial_concurrency, self.min_concurrency, self.max_concurrency)
+        limits = self._models[model] = ModelLimits(model, requests_per_minute, tokens_per_minute, limiter)
+        return limits
+
+    def limits(self, model: str) -> ModelLimits:
+        limits = self._models.get(model)
+        return limits if limits is not None else self.configure(model)
+
+    def backoff(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """Задержка перед повтором: половина экспоненциальной задержки плюс случайная добавка"""
+        delay = min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt)
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        retry_after = _retry_after(error) if error is not None else None
+        if retry_after:
+            delay = max(delay, min(retry_after, self.retry_max_delay))
+        return delay
+
+    async def _send(self, limits: ModelLimits, create: Callable[[], Awaitable[Any]], tokens: int, requests: int) -> Any:
+        """Попытки до первого успешного ответа; место в лимите одновременных запросов остается занятым"""
+        for attempt in range(self.max_retries + 1):
+            await limits.admit(requests, tokens)
+            try:
+                return await create()
+            except Exception as e:
+                overloaded = is_overload(e)
+                limits.done(overloaded=overloaded)
+                if not overloaded or attempt == self.max_retries:
+                    limits.failures.inc()
+                    raise
+                if _status(e) == 429:
+                    limits.rate_limited.inc()
+                limits.retries.inc()
+                delay = self.backoff(attempt, e)
+                logger.warning(f"{limits.model}: перегрузка ({e}), повтор {attempt + 1} через {delay:.1f} с")
+                await asyncio.sleep(delay)
+            except BaseException:
+                limits.done()
+                raise
+
+    async def call(self, model: str, create: Callable[[], Awaitable[Any]], tokens: int = 0, requests: int = 1) -> Any:
+        """
+        Запрос к модели с ожиданием лимитов и повторами
+        :param model: Модель (лимиты и метрики ведутся по ней)
+        :param create: Функция, отправляющая запрос (вызывается на каждую попытку)
+        :param tokens: Оценка токенов запроса и ответа
+        :param requests: Сколько запросов списать из лимита в минуту (для изображений - n)
+        :return: Ответ OpenAI; ошибка последней попытки пробрасывается
+        """
+        limits = self.limits(model)
+        response = await self._send(limits, create, tokens, requests)
+        limits.done(success=True)
+        limits.settle(tokens, response)
+        return response
+
+    async def stream(self, model: str, create: Callable[[], Awaitable[AsyncIterator[Any]]],
+                     tokens: int = 0) -> AsyncIterator[Any]:
+        """
+        Потоковый запрос: повторяется только открытие потока, место в лимите
+        одновременных запросов занято до последнего фрагмента.
+        Время до первого фрагмента (вместе с очередью) - метрика ai.<модель>.ttfb
+        """
+        limits = self.limits(model)
+        started = time.monotonic()
+        response = await self._send(limits, create, tokens, 1)
+        success = first = False
+        try:
+            async for chunk in response:
+                if not first:
+                    first = True
+                    limits.ttfb.observe(time.monotonic() - started)
+                yield chunk
+            success = True
+        finally:
+            limits.done(success=success)
+
+    async def chat_completion(self, **kwargs) -> Any:
+        """openai.ChatCompletion.acreate с лимитами модели kwargs['model']"""
+        tokens = estimate_tokens(kwargs.get('messages')) + kwargs.get('max_tokens', 0)
+        return await self.call(kwargs['model'], lambda: openai.ChatCompletion.acreate(**kwargs), tokens=tokens)
+
+    def stream_chat_completion(self, **kwargs) -> AsyncIterator[Any]:
+        """Фрагменты openai.ChatCompletion.acreate(stream=True) с лимитами модели kwargs['model']"""
+        tokens = estimate_tokens(kwargs.get('messages')) + kwargs.get('max_tokens', 0)
+        return self.stream(kwargs['model'], lambda: openai.ChatCompletion.acreate(stream=True, **kwargs), tokens=tokens)
+
+    async def image(self, **kwargs) -> Any:
+        """openai.Image.acreate с лимитом изображений в минуту модели kwargs['model']"""
+        return await self.call(kwargs['model'], lambda: openai.Image.acreate(**kwargs), requests=kwargs.get('n', 1))
+
+
+def create_ai_client() -> AIClient:
+    client = AIClient(
+        max_retries=settings.openai_max_retries,
+        retry_base_delay=settings.openai_retry_base_delay,
+        retry_max_delay=settings.openai_retry_max_delay,
+        initial_concurrency=settings.openai_initial_concurrency,
+        min_concurrency=settings.openai_min_concurrency,
+        max_concurrency=settings.openai_max_concurrency
+    )
+    client.configure(CHAT_MODEL, settings.openai_chat_rpm, settings.openai_chat_tpm)
+    client.configure(IMAGE_MODEL, settings.openai_image_rpm)
+    return client
+
+
+# Глобальный клиент OpenAI
+ai_client = create_ai_client()
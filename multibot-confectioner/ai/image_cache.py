@@ -0,0 +1,231 @@
+"""
+Кэш изображений тортов с адресацией по содержимому заказа
+Ключ - хэш нормализованного промпта (описание, вес с округлением до
+IMAGE_WEIGHT_BUCKET кг, стиль), поэтому похожие заказы ("шоколадный торт 2 кг")
+получают уже сгенерированное изображение без платного запроса к DALL-E.
+Байты изображения хранятся на диске: ссылка OpenAI живет около часа,
+а клиенту и кондитеру отправляются сами байты или постоянная ссылка
+/images/<ключ>.png на это приложение.
+
+Метрики (префикс cache.images): hits, misses, evictions, size_bytes
+"""
+import asyncio
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Optional, Tuple
+import logging
+
+import aiohttp
+
+from ai.image_gen import generate_cake_image
+from config import settings
+from core.metrics import metrics
+from core.utils import normalize_text
+
+logger = logging.getLogger(__name__)
+
+IMAGE_WEIGHT_BUCKET = 0.5
+_KEY_RE = re.compile(r"^[0-9a-f]{64}$")
+
+
+@dataclass
+class CakeImage:
+    """
+    Изображение торта: байты, постоянная ссылка (если задан PUBLIC_BASE_URL)
+    и временная ссылка OpenAI (только у только что сгенерированного изображения)
+    """
+    key: str
+    data: bytes
+    url: Optional[str] = None
+    source_url: Optional[str] = None
+
+    @property
+    def filename(self) -> str:
+        return f"{self.key}.png"
+
+    @property
+    def link(self) -> Optional[str]:
+        """Ссылка для платформ, где изображение отправляется текстом: постоянная, иначе временная"""
+        return self.url or self.source_url
+
+
+def image_key(description: str, weight: Optional[float] = None, style: Optional[str] = None) -> str:
+    """Ключ кэша: sha256 нормализованного описания, корзины веса и стиля"""
+    bucket = round(weight / IMAGE_WEIGHT_BUCKET) * IMAGE_WEIGHT_BUCKET if weight else 0
+    payload = "\n".join((normalize_text(description), f"{bucket:g}", normalize_text(style)))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def public_image_url(key: str) -> Optional[str]:
+    if not settings.public_base_url:
+        return None
+    return f"{settings.public_base_url.rstrip('/')}/images/{key}.png"
+
+
+class DiskImageStore:
+    """
+    Хранилище файлов <ключ>.png с вытеснением давно не использованных
+    при превышении max_bytes и удалением записей старше ttl секунд
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._index: Optional["OrderedDict[str, Tuple[int, float]]"] = None  # ключ -> (размер, время записи)
+        self._total = 0
+        # Методы вызываются из пула потоков (asyncio.to_thread)
+        self._lock = threading.Lock()
+
+        self._hits = metrics.counter("cache.images.hits")
+        self._misses = metrics.counter("cache.images.misses")
+        self._evictions = metrics.counter("cache.images.evictions")
+        self._size_bytes = metrics.gauge("cache.images.size_bytes")
+
+    def path(self, key: str) -> Optional[str]:
+        """Путь к файлу изображения или None для некорректного ключа"""
+        if not _KEY_RE.match(key):
+            return None
+        return os.path.join(self.directory, f"{key}.png")
+
+    def _load_index(self):
+        """Индекс строится по файлам каталога при первом обращении (старые - в начале)"""
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if ext == ".png" and _KEY_RE.match(key):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, key, stat.st_size))
+        self._index = OrderedDict((key, (size, mtime)) for mtime, key, size in sorted(entries))
+        self._total = sum(size for size, _ in self._index.values())
+        self._size_bytes.set(self._total)
+
+    def _remove(self, key: str):
+        size, _ = self._index.pop(key)
+        self._total -= size
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            return self._get(key)
+
+    def put(self, key: str, data: bytes):
+        with self._lock:
+            self._put(key, data)
+
+    def _get(self, key: str) -> Optional[bytes]:
+        if self._index is None:
+            self._load_index()
+        entry = self._index.get(key)
+        if entry is not None and time.time() - entry[1] >= self.ttl:
+            self._remove(key)
+            self._size_bytes.set(self._total)
+            entry = None
+        if entry is None:
+            self._misses.inc()
+            return None
+        try:
+            with open(self.path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            self._index.pop(key)
+            self._total -= entry[0]
+            self._misses.inc()
+            return None
+        self._index.move_to_end(key)
+        self._hits.inc()
+        return data
+
+    def _put(self, key: str, data: bytes):
+        if self._index is None:
+            self._load_index()
+        if key in self._index:
+            self._remove(key)
+        path = self.path(key)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._index[key] = (len(data), time.time())
+        self._total += len(data)
+        while self._total > self.max_bytes and len(self._index) > 1:
+            self._remove(next(iter(self._index)))
+            self._evictions.inc()
+        self._size_bytes.set(self._total)
+
+
+image_store = DiskImageStore(
+    settings.image_cache_dir,
+    max_bytes=settings.image_cache_max_mb * 1024 * 1024,
+    ttl=settings.image_cache_ttl
+)
+_in_flight: Dict[str, asyncio.Future] = {}
+
+
+async def _download(url: str) -> bytes:
+    timeout = aiohttp.ClientTimeout(total=60)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.read()
+
+
+async def _generate(key: str, description: str, weight: Optional[float],
+                    style: Optional[str]) -> Optional[Tuple[bytes, str]]:
+    """Генерация, скачивание и сохранение в кэш; результат - байты и ссылка OpenAI"""
+    image_url = await generate_cake_image(description, weight, style)
+    if not image_url:
+        return None
+    try:
+        data = await _download(image_url)
+    except Exception as e:
+        logger.error(f"Не удалось скачать сгенерированное изображение: {e}")
+        return None
+    try:
+        await asyncio.to_thread(image_store.put, key, data)
+    except OSError as e:
+        logger.error(f"Не удалось сохранить изображение в кэш: {e}")
+    return data, image_url
+
+
+async def get_cake_image(description: str, weight: Optional[float] = None,
+                         style: Optional[str] = None) -> Optional[CakeImage]:
+    """
+    Изображение торта из кэша или новая генерация DALL-E
+    Одновременные заказы с одинаковым ключом ждут одну генерацию
+    :return: Изображение или None, если сгенерировать не удалось
+    """
+    key = image_key(description, weight, style)
+    data = await asyncio.to_thread(image_store.get, key)
+    source_url = None
+
+    if data is None:
+        pending = _in_flight.get(key)
+        if pending is not None:
+            generated = await asyncio.shield(pending)
+        else:
+            future = asyncio.get_running_loop().create_future()
+            _in_flight[key] = future
+            try:
+                generated = await _generate(key, description, weight, style)
+                future.set_result(generated)
+            except BaseException as e:
+                future.set_exception(e)
+                future.exception()
+                raise
+            finally:
+                del _in_flight[key]
+        if generated is None:
+            return None
+        data, source_url = generated
+
+    return CakeImage(key=key, data=data, url=public_image_url(key), source_url=source_url)
@@ -1,15 +1,11 @@
-import openai
+from ai.client import IMAGE_MODEL, ai_client
 from config import settings
+from core.deadline import deadline_after, within_deadline
 import logging
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
-# Установка API ключа OpenAI
-openai.api_key = settings.openai_api_key
-if settings.openai_org_id:
-    openai.organization = settings.openai_org_id
-
 
 async def generate_cake_image(description: str, weight: Optional[float] = None, 
                              photo_analysis: Optional[str] = None) -> Optional[str]:
@@ -18,7 +14,7 @@ async def generate_cake_image(description: str, weight: Optional[float] = None,
     :param description: Описание торта
     :param weight: Вес торта в кг
     :param photo_analysis: Анализ фото-примера (если есть)
-    :return: URL сгенерированного изображения
+    :return: URL сгенерированного изображения (None при ошибке или дольше IMAGE_GENERATION_TIMEOUT секунд)
     """
     try:
         # Формирование промпта для DALL-E
@@ -36,13 +32,15 @@ async def generate_cake_image(description: str, weight: Optional[float] = None,
         if len(prompt) > 1000:
             prompt = prompt[:1000]
         
-        response = await openai.Image.acreate(
-            model="dall-e-3",
-            prompt=prompt,
-            n=1,
-            size="1024x1024",
-            quality="standard"
-        )
+        # Генерация идет в фоне после ответа клиенту: дедлайн сообщения на нее не переносится
+        with deadline_after(settings.image_generation_timeout, inherit=False):
+            response = await within_deadline(ai_client.image(
+                model=IMAGE_MODEL,
+                prompt=prompt,
+                n=1,
+                size="1024x1024",
+                quality="standard"
+            ))
         
         image_url = response.data[0].url
         return image_url
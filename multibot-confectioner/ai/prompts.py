@@ -0,0 +1,140 @@
+"""
+Реестр системных промптов
+Вариант промпта определяется группой возраста и полом клиента (prompt_variant), вариантов
+всего девять. Промпты всех вариантов всех версий собираются один раз при запуске и дальше
+отдаются из словаря: текст для варианта одинаков до байта от запроса к запросу, поэтому
+начало запроса (системный промпт и история диалога) повторяется и кэш префикса промпта
+у провайдера срабатывает.
+
+Версии промптов - для A/B-тестов: доля PROMPT_AB_SHARE клиентов получает версию
+PROMPT_AB_VERSION, остальные - PROMPT_VERSION. Версия выбирается по хэшу идентификатора
+клиента и не меняется между сообщениями.
+
+Метрики: prompts.<версия>.requests - запросы с промптом этой версии
+"""
+import hashlib
+from typing import Callable, Dict, Optional, Tuple
+
+from config import settings
+from core.metrics import metrics
+
+AGE_GROUPS = ("", "minor", "senior")
+GENDER_GROUPS = ("", "male", "female")
+VARIANTS = tuple(f"{age_group}:{gender_group}" for age_group in AGE_GROUPS for gender_group in GENDER_GROUPS)
+
+
+def prompt_variant(user_info: Optional[dict] = None) -> str:
+    """
+    Вариант системного промпта: группа возраста и пол клиента
+    Клиенты с одинаковым вариантом получают одинаковый системный промпт
+    :param user_info: Информация о пользователе (возраст, пол и т.д.)
+    :return: Строка вида "<возраст>:<пол>", например "senior:female"
+    """
+    age = user_info.get('age') if user_info else None
+    gender = user_info.get('gender') if user_info else None
+
+    age_group = ""
+    if age:
+        if age < 18:
+            age_group = "minor"
+        elif age > 60:
+            age_group = "senior"
+
+    gender_group = gender.lower() if gender and gender.lower() in ('male', 'female') else ""
+    return f"{age_group}:{gender_group}"
+
+
+def _client_notes(variant: str) -> str:
+    """Предложения о клиенте для варианта промпта"""
+    age_group, gender_group = variant.split(":")
+    notes = ""
+
+    if age_group == "minor":
+        notes += "Клиент несовершеннолетний, общайся с уважением и осторожно. "
+    elif age_group == "senior":
+        notes += "Клиент пожилой, общайся с уважением и терпением. "
+
+    if gender_group == "male":
+        notes += "Клиент мужчина. "
+    elif gender_group == "female":
+        notes += "Клиент женщина. "
+    return notes
+
+
+def build_system_prompt(variant: str) -> str:
+    """Системный промпт для варианта из prompt_variant (версия v1)"""
+    system_prompt = "Ты - AI-помощник кондитера. Помоги клиенту оформить заказ на торт или десерт. "
+    system_prompt += "Уточни детали: вес, форму, начинку, декор, дату доставки. "
+    system_prompt += "Стиль общения адаптируй под клиента. "
+    system_prompt += _client_notes(variant)
+    system_prompt += "Отвечай кратко и по существу, задавай уточняющие вопросы."
+    return system_prompt
+
+
+def build_system_prompt_v2(variant: str) -> str:
+    """
+    Версия v2: те же указания, но сведения о клиенте в конце,
+    поэтому общее начало промпта одинаково у всех вариантов
+    """
+    system_prompt = "Ты - AI-помощник кондитера. Помоги клиенту оформить заказ на торт или десерт. "
+    system_prompt += "Уточни детали: вес, форму, начинку, декор, дату доставки. "
+    system_prompt += "Отвечай кратко и по существу, задавай уточняющие вопросы. "
+    system_prompt += "Стиль общения адаптируй под клиента. "
+    system_prompt += _client_notes(variant)
+    return system_prompt.rstrip()
+
+
+PROMPT_BUILDERS: Dict[str, Callable[[str], str]] = {
+    "v1": build_system_prompt,
+    "v2": build_system_prompt_v2,
+}
+
+
+class PromptRegistry:
+    """Заранее собранные системные промпты: (версия, вариант) -> текст"""
+
+    def __init__(self, builders: Dict[str, Callable[[str], str]], version: str,
+                 ab_version: Optional[str] = None, ab_share: float = 0.0):
+        for name in filter(None, (version, ab_version)):
+            if name not in builders:
+                raise ValueError(f"Неизвестная версия промпта: {name}")
+        self.version = version
+        self.ab_version = ab_version if ab_version and ab_share > 0 else None
+        self.ab_share = ab_share
+        # (версия, вариант) -> (ключ для кэша ответов, текст промпта)
+        self._prompts: Dict[Tuple[str, str], Tuple[str, str]] = {
+            (name, variant): (f"{name}/{variant}", build(variant))
+            for name, build in builders.items() for variant in VARIANTS
+        }
+        self._requests = {name: metrics.counter(f"prompts.{name}.requests") for name in builders}
+
+    def version_for(self, user_id: Optional[str] = None) -> str:
+        """Версия промпта клиента: постоянна для одного user_id"""
+        if self.ab_version is None or not user_id:
+            return self.version
+        digest = hashlib.sha256(str(user_id).encode("utf-8")).digest()
+        bucket = int.from_bytes(digest[:8], "big") / 2 ** 64
+        return self.ab_version if bucket < self.ab_share else self.version
+
+    def get(self, version: str, variant: str) -> str:
+        return self._prompts[(version, variant)][1]
+
+    def select(self, user_info: Optional[dict] = None) -> Tuple[str, str]:
+        """
+        Системный промпт для клиента
+        :param user_info: Информация о пользователе (id, возраст, пол)
+        :return: Ключ промпта "<версия>/<вариант>" (для кэша ответов) и текст промпта
+        """
+        version = self.version_for(user_info.get('id') if user_info else None)
+        variant = prompt_variant(user_info)
+        self._requests[version].inc()
+        return self._prompts[(version, variant)]
+
+
+# Глобальный реестр промптов, собирается при импорте (запуске приложения)
+prompts = PromptRegistry(
+    PROMPT_BUILDERS,
+    version=settings.prompt_version,
+    ab_version=settings.prompt_ab_version,
+    ab_share=settings.prompt_ab_share
+)
@@ -0,0 +1,84 @@
+"""
+Провайдеры языковых моделей для ai.router
+Провайдер принимает сообщения в формате чата OpenAI и возвращает текст ответа целиком
+(complete) или по частям (stream). OpenAIProvider работает с OpenAI и с любым
+OpenAI-совместимым API (api_base), запросы идут через ai.client с его лимитами.
+LocalProvider - локальная замена модели без сети: отвечает шаблоном, используется,
+когда все остальные провайдеры недоступны, и в тестах
+"""
+from typing import AsyncIterator, List, Optional
+
+from ai.client import ai_client
+
+LOCAL_REPLY = (
+    "Спасибо за сообщение! Сейчас я отвечаю в упрощенном режиме. "
+    "Расскажите, пожалуйста, какой торт вы хотите: вес, начинку, декор и дату доставки - "
+    "кондитер все учтет."
+)
+
+
+def delta_text(chunk) -> str:
+    """Текст фрагмента потокового ответа OpenAI"""
+    try:
+        return getattr(chunk.choices[0].delta, "content", None) or ""
+    except (AttributeError, IndexError):
+        return ""
+
+
+class ChatProvider:
+    """Интерфейс провайдера модели"""
+
+    name: str = ""
+    # Только запасной вариант: не участвует в дублировании медленных запросов
+    fallback: bool = False
+
+    async def complete(self, messages: List[dict], **params) -> str:
+        raise NotImplementedError
+
+    async def stream(self, messages: List[dict], **params) -> AsyncIterator[str]:
+        """Ответ по частям (по умолчанию - одним фрагментом)"""
+        yield await self.complete(messages, **params)
+
+
+class OpenAIProvider(ChatProvider):
+    """Модель OpenAI или OpenAI-совместимого API"""
+
+    def __init__(self, name: str, model: str, api_base: Optional[str] = None, api_key: Optional[str] = None):
+        self.name = name
+        self.model = model
+        self.api_base = api_base
+        self.api_key = api_key
+
+    def _request(self, messages: List[dict], params: dict) -> dict:
+        request = dict(model=self.model, messages=messages, **params)
+        if self.api_base:
+            request["api_base"] = self.api_base
+        if self.api_key:
+            request["api_key"] = self.api_key
+        return request
+
+    async def complete(self, messages: List[dict], **params) -> str:
+        response = await ai_client.chat_completion(**self._request(messages, params))
+        return response.choices[0].message.content
+
+    async def stream(self, messages: List[dict], **params) -> AsyncIterator[str]:
+        async for chunk in ai_client.stream_chat_completion(**self._request(messages, params)):
+            text = delta_text(chunk)
+            if text:
+                yield text
+
+
+class LocalProvider(ChatProvider):
+    """Шаблонный ответ без обращения к сети"""
+
+    fallback = True
+
+    def __init__(self, name: str = "local", reply: str = LOCAL_REPLY):
+        self.name = name
+        self.reply = reply
+
+    async def complete(self, messages: List[dict], **params) -> str:
+        # Для запросов на извлечение данных в JSON - "ничего не найдено"
+        if (params.get("response_format") or {}).get("type") == "json_object":
+            return "{}"
+        return self.reply
@@ -0,0 +1,165 @@
+"""
+Кэш ответов AI на частые вопросы клиентов ("сколько стоит", "доставляете?")
+Ключ - версия и вариант системного промпта (группа возраста и пол, ai.prompts) и нормализованный
+текст сообщения, поэтому "Доставляете?" и "доставляете" получают один ответ.
+Дополнительно можно подключить индекс похожих вопросов (SimilarityIndex):
+если точного совпадения нет, берется ответ на достаточно похожий вопрос.
+
+Кэшируются только самостоятельные частые вопросы (is_faq_question): ответ на них не зависит
+от предыдущих реплик, поэтому их можно отвечать из кэша и при непустой истории диалога.
+
+Метрики (префикс cache.responses): hits и misses точного поиска, similar_hits -
+ответы по похожему вопросу, hit_rate - доля сообщений, отвеченных из кэша
+"""
+import re
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Hashable, Optional, Set, Tuple
+
+from config import settings
+from core.cache import TTLCache
+from core.metrics import metrics
+from core.utils import normalize_text
+
+# Признаки частых вопросов (основы слов) и слов, отсылающих к предыдущим репликам
+_FAQ_RE = re.compile(
+    r"\b(?:сколько стоит|цен[аыу]|стоимост|прайс|доставк|доставля|самовывоз|адрес|где вы|"
+    r"где находит|график|работаете|часы работы|оплат|предоплат|скидк|акци|заранее|минимальн)"
+)
+_REFERENCE_RE = re.compile(
+    r"\b(?:это|этот|эта|эту|этого|этой|он|она|оно|они|его|ее|их|него|нее|них|такой|такую|такие|"
+    r"такого|тот|ту|тогда|там|тоже|еще|а если)\b"
+)
+FAQ_MAX_WORDS = 12
+
+
+def is_faq_question(message: str) -> bool:
+    """
+    Самостоятельный частый вопрос: короткий, с признаком частого вопроса ("сколько стоит",
+    "доставляете?") и без отсылок к предыдущим репликам ("а его можно доставить?")
+    """
+    text = normalize_text(message)
+    if not text or len(text.split()) > FAQ_MAX_WORDS:
+        return False
+    return _FAQ_RE.search(text) is not None and _REFERENCE_RE.search(text) is None
+
+
+class SimilarityIndex:
+    """Интерфейс индекса похожих вопросов внутри одного варианта промпта"""
+
+    def add(self, variant: str, text: str):
+        raise NotImplementedError
+
+    def find(self, variant: str, text: str) -> Optional[str]:
+        """Наиболее похожий сохраненный текст или None"""
+        raise NotImplementedError
+
+    def discard(self, variant: str, text: str):
+        raise NotImplementedError
+
+
+class TrigramIndex(SimilarityIndex):
+    """
+    Похожесть по символьным триграммам (коэффициент Жаккара)
+    Кандидаты ищутся по инвертированному индексу триграмм, без перебора всех вопросов
+    """
+
+    def __init__(self, threshold: float = 0.8, max_entries: int = 10000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], FrozenSet[str]]" = OrderedDict()
+        self._postings: Dict[Tuple[str, str], Set[str]] = {}
+
+    @staticmethod
+    def _grams(text: str) -> FrozenSet[str]:
+        padded = f"  {text} "
+        return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    def add(self, variant: str, text: str):
+        key = (variant, text)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        grams = self._grams(text)
+        self._entries[key] = grams
+        for gram in grams:
+            self._postings.setdefault((variant, gram), set()).add(text)
+        while len(self._entries) > self.max_entries:
+            self.discard(*next(iter(self._entries)))
+
+    def discard(self, variant: str, text: str):
+        grams = self._entries.pop((variant, text), None)
+        if grams is None:
+            return
+        for gram in grams:
+            texts = self._postings.get((variant, gram))
+            if texts is not None:
+                texts.discard(text)
+                if not texts:
+                    del self._postings[(variant, gram)]
+
+    def find(self, variant: str, text: str) -> Optional[str]:
+        grams = self._grams(text)
+        shared: Dict[str, int] = {}
+        for gram in grams:
+            for candidate in self._postings.get((variant, gram), ()):
+                shared[candidate] = shared.get(candidate, 0) + 1
+
+        best, best_score = None, self.threshold
+        for candidate, common in shared.items():
+            score = common / (len(grams) + len(self._entries[(variant, candidate)]) - common)
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+
+class ResponseCache:
+    """Кэш ответов с ограничением по размеру (LRU) и времени жизни"""
+
+    def __init__(self, max_size: int = 2000, ttl: float = 3600, index: Optional[SimilarityIndex] = None):
+        self._cache = TTLCache("responses", max_size=max_size, ttl=ttl)
+        self.index = index
+        self._lookups = 0
+        self._served = 0
+        self._similar_hits = metrics.counter("cache.responses.similar_hits")
+        self._hit_rate = metrics.gauge("cache.responses.hit_rate")
+
+    def _record(self, hit: bool):
+        self._lookups += 1
+        self._served += hit
+        self._hit_rate.set(self._served / self._lookups)
+
+    def get(self, variant: str, message: str) -> Optional[str]:
+        text = normalize_text(message)
+        if not text:
+            return None
+        key: Hashable = (variant, text)
+        response = self._cache.get(key)
+        if response is None and self.index is not None:
+            similar = self.index.find(variant, text)
+            if similar is not None:
+                response = self._cache.peek((variant, similar))
+                if response is None:
+                    self.index.discard(variant, similar)  # ответ уже вытеснен
+                else:
+                    self._similar_hits.inc()
+        self._record(response is not None)
+        return response
+
+    def set(self, variant: str, message: str, response: str):
+        text = normalize_text(message)
+        if not text:
+            return
+        self._cache.set((variant, text), response)
+        if self.index is not None:
+            self.index.add(variant, text)
+
+
+def create_response_cache() -> ResponseCache:
+    index = None
+    if settings.response_cache_similarity > 0:
+        index = TrigramIndex(threshold=settings.response_cache_similarity, max_entries=settings.response_cache_size)
+    return ResponseCache(max_size=settings.response_cache_size, ttl=settings.response_cache_ttl, index=index)
+
+
+# Глобальный кэш ответов для свободного диалога
+response_cache = create_response_cache()
@@ -0,0 +1,318 @@
+"""
+Маршрутизатор запросов к языковым моделям
+Запрос чата уходит провайдеру (ai.providers) с наименьшим ожидаемым временем ответа:
+EWMA задержки успешных ответов с поправкой на EWMA доли ошибок; пока у провайдера нет замеров,
+его задержка считается равной hedge_default_delay, и провайдеры идут в порядке настройки.
+
+- Дублирование (hedging): если ответ не пришел за p95 задержки провайдера (не меньше
+  hedge_min_delay), тот же запрос отправляется следующему провайдеру, берется первый ответ,
+  второй запрос отменяется. Одновременно - не больше двух запросов.
+- Переключение: ошибка провайдера - сразу запрос к следующему.
+- Предохранитель: после breaker_failures ошибок подряд провайдер отключается на
+  breaker_cooldown секунд, затем получает один пробный запрос.
+- Запасные провайдеры (LocalProvider) не дублируют медленные запросы и вызываются,
+  только когда остальные провайдеры ответили ошибкой или отключены.
+
+Метрики: router.hedges, router.failovers, router.fallbacks (ответ запасного провайдера),
+router.<провайдер>.{latency, requests, errors, ewma_latency, error_rate, breaker_open}
+"""
+import asyncio
+import time
+from typing import AsyncIterator, Callable, Dict, List, NamedTuple, Optional, Sequence
+import logging
+
+from ai.client import CHAT_MODEL
+from ai.providers import ChatProvider, LocalProvider, OpenAIProvider
+from config import settings
+from core.metrics import Histogram, metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Reply(NamedTuple):
+    """Ответ или фрагмент ответа провайдера"""
+    text: str
+    provider: str
+    fallback: bool = False
+
+
+class NoProviderAvailable(Exception):
+    """Все провайдеры отключены предохранителями"""
+
+
+class CircuitBreaker:
+    """Предохранитель провайдера: closed -> open (после ошибок подряд) -> half_open (пробный запрос)"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0,
+                 clock: Callable[[], float] = time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+
+    @property
+    def available(self) -> bool:
+        """Можно ли отправить запрос (без перевода в half_open)"""
+        if self.state == self.CLOSED:
+            return True
+        return self.state == self.OPEN and self._clock() - self.opened_at >= self.cooldown
+
+    def allow(self) -> bool:
+        """Разрешение на запрос; после паузы пропускает один пробный запрос"""
+        if not self.available:
+            return False
+        if self.state == self.OPEN:
+            self.state = self.HALF_OPEN
+        return True
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self.opened_at = self._clock()
+
+    def record_cancel(self):
+        """Пробный запрос отменен (проиграл дублю) - следующий запрос снова пробный"""
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+
+
+class ProviderState:
+    """Провайдер со статистикой задержек и ошибок и предохранителем"""
+
+    def __init__(self, provider: ChatProvider, alpha: float, breaker: CircuitBreaker):
+        self.provider = provider
+        self.name = provider.name
+        self.alpha = alpha
+        self.breaker = breaker
+        # EWMA задержки успешных ответов (сек) и доли ошибок
+        self.latency: Optional[float] = None
+        self.error_rate = 0.0
+        # Окно задержек для дедлайна дублирования; метрика router.<имя>.latency - общая на процесс
+        self.window = Histogram(max_samples=256)
+        prefix = f"router.{self.name}"
+        self._latency = metrics.histogram(f"{prefix}.latency")
+        self._requests = metrics.counter(f"{prefix}.requests")
+        self._errors = metrics.counter(f"{prefix}.errors")
+        self._ewma_latency = metrics.gauge(f"{prefix}.ewma_latency")
+        self._error_rate = metrics.gauge(f"{prefix}.error_rate")
+        self._breaker_open = metrics.gauge(f"{prefix}.breaker_open")
+
+    def record(self, seconds: float, ok: bool):
+        self._requests.inc()
+        self.error_rate += self.alpha * ((0.0 if ok else 1.0) - self.error_rate)
+        if ok:
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+            self.window.observe(seconds)
+            self._latency.observe(seconds)
+            self.breaker.record_success()
+        else:
+            self._errors.inc()
+            self.breaker.record_failure()
+        self._ewma_latency.set(round(self.latency or 0.0, 4))
+        self._error_rate.set(round(self.error_rate, 4))
+        self._breaker_open.set(0 if self.breaker.state == CircuitBreaker.CLOSED else 1)
+
+    def record_cancel(self, seconds: float):
+        """Запрос отменен (ответил дубль): задержка провайдера не меньше seconds"""
+        if self.latency is None or seconds > self.latency:
+            self.latency = seconds if self.latency is None else self.latency + self.alpha * (seconds - self.latency)
+            self._ewma_latency.set(round(self.latency, 4))
+        self.breaker.record_cancel()
+
+    def score(self, default_latency: float) -> float:
+        """Ожидаемое время до успешного ответа"""
+        latency = self.latency if self.latency is not None else default_latency
+        return latency / max(0.05, 1.0 - self.error_rate)
+
+
+class LLMRouter:
+    """Выбор провайдера, дублирование медленных запросов и переключение при ошибках"""
+
+    def __init__(self, providers: Sequence[ChatProvider], ewma_alpha: float = 0.2, hedge: bool = True,
+                 hedge_percentile: float = 95, hedge_min_delay: float = 1.0, hedge_default_delay: float = 5.0,
+                 hedge_min_samples: int = 20, breaker_failures: int = 5, breaker_cooldown: float = 30.0):
+        if not providers:
+            raise ValueError("Не задано ни одного провайдера модели")
+        self.states: List[ProviderState] = [
+            ProviderState(provider, ewma_alpha, CircuitBreaker(breaker_failures, breaker_cooldown))
+            for provider in providers
+        ]
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_samples = hedge_min_samples
+        self._hedges = metrics.counter("router.hedges")
+        self._failovers = metrics.counter("router.failovers")
+        self._fallbacks = metrics.counter("router.fallbacks")
+
+    def state(self, name: str) -> ProviderState:
+        return next(state for state in self.states if state.name == name)
+
+    def _candidates(self) -> List[ProviderState]:
+        """Доступные провайдеры: основные по ожидаемому времени ответа, затем запасные"""
+        primary, fallback = [], []
+        for state in self.states:
+            if state.breaker.available:
+                (fallback if state.provider.fallback else primary).append(state)
+        primary.sort(key=lambda state: state.score(self.hedge_default_delay))
+        return primary + fallback
+
+    def hedge_delay(self, state: ProviderState) -> float:
+        """Через сколько секунд без ответа дублировать запрос к провайдеру"""
+        if state.window.count < self.hedge_min_samples:
+            return self.hedge_default_delay
+        return max(self.hedge_min_delay, state.window.percentile(self.hedge_percentile))
+
+    async def _attempt(self, state: ProviderState, messages: List[dict], params: dict) -> Reply:
+        started = time.monotonic()
+        try:
+            text = await state.provider.complete(messages, **params)
+        except asyncio.CancelledError:
+            state.record_cancel(time.monotonic() - started)
+            raise
+        except Exception as e:
+            state.record(time.monotonic() - started, ok=False)
+            logger.warning(f"Провайдер {state.name} ответил ошибкой: {e}")
+            raise
+        state.record(time.monotonic() - started, ok=True)
+        if state.provider.fallback:
+            self._fallbacks.inc()
+        return Reply(text, state.name, state.provider.fallback)
+
+    async def complete(self, messages: List[dict], **params) -> Reply:
+        """
+        Ответ первого успешно ответившего провайдера
+        :param messages: Сообщения в формате чата OpenAI
+        :param params: Параметры запроса (max_tokens, temperature, response_format)
+        :return: Текст ответа, имя провайдера и признак запасного провайдера
+        """
+        candidates = self._candidates()
+        position = 0
+        loop = asyncio.get_running_loop()
+        tasks: Dict[asyncio.Task, ProviderState] = {}
+        hedge_at: Optional[float] = None
+        error: Optional[Exception] = None
+
+        def launch(hedging: bool = False) -> bool:
+            """Запрос к следующему доступному провайдеру; дубль - только основному"""
+            nonlocal position, hedge_at
+            hedge_at = None
+            while position < len(candidates):
+                state = candidates[position]
+                if hedging and state.provider.fallback:
+                    return False
+                position += 1
+                if not state.breaker.allow():
+                    continue
+                tasks[asyncio.ensure_future(self._attempt(state, messages, params))] = state
+                if self.hedge and not state.provider.fallback:
+                    hedge_at = loop.time() + self.hedge_delay(state)
+                return True
+            return False
+
+        if not launch():
+            raise NoProviderAvailable("Все провайдеры модели недоступны")
+        try:
+            while tasks:
+                timeout = None
+                if hedge_at is not None and len(tasks) < 2:
+                    timeout = max(0.0, hedge_at - loop.time())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Нет ответа к дедлайну: дублируем запрос следующему основному провайдеру
+                    if launch(hedging=True):
+                        self._hedges.inc()
+                    continue
+                for task in done:
+                    tasks.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                if not tasks and launch():
+                    self._failovers.inc()
+            raise error or NoProviderAvailable("Все провайдеры модели недоступны")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def stream(self, messages: List[dict], **params) -> AsyncIterator[Reply]:
+        """
+        Ответ по частям от провайдера с наименьшим ожидаемым временем ответа
+        Ошибка до первого фрагмента - переключение на следующего провайдера,
+        после первого фрагмента - ошибка передается вызывающему (текст уже показан)
+        """
+        error: Optional[Exception] = None
+        for state in self._candidates():
+            if not state.breaker.allow():
+                continue
+            if error is not None:
+                self._failovers.inc()
+            started = time.monotonic()
+            first = False
+            try:
+                async for text in state.provider.stream(messages, **params):
+                    if not first:
+                        first = True
+                        if state.provider.fallback:
+                            self._fallbacks.inc()
+                    yield Reply(text, state.name, state.provider.fallback)
+            except asyncio.CancelledError:
+                state.record_cancel(time.monotonic() - started)
+                raise
+            except Exception as e:
+                state.record(time.monotonic() - started, ok=False)
+                logger.warning(f"Провайдер {state.name} ответил ошибкой: {e}")
+                if first:
+                    raise
+                error = e
+                continue
+            state.record(time.monotonic() - started, ok=True)
+            return
+        raise error or NoProviderAvailable("Все провайдеры модели недоступны")
+
+
+def create_providers() -> List[ChatProvider]:
+    """Провайдеры из LLM_PROVIDERS в порядке приоритета"""
+    available = {
+        "openai": lambda: OpenAIProvider("openai", CHAT_MODEL),
+        "backup": lambda: OpenAIProvider("backup", settings.llm_backup_model,
+                                         api_base=settings.llm_backup_api_base,
+                                         api_key=settings.llm_backup_api_key),
+        "local": lambda: LocalProvider("local"),
+    }
+    providers = []
+    for name in filter(None, (name.strip() for name in settings.llm_providers.split(","))):
+        if name not in available:
+            raise ValueError(f"Неизвестный провайдер модели: {name}")
+        providers.append(available[name]())
+    return providers
+
+
+def create_router() -> LLMRouter:
+    return LLMRouter(
+        create_providers(),
+        ewma_alpha=settings.llm_ewma_alpha,
+        hedge=settings.llm_hedge,
+        hedge_percentile=settings.llm_hedge_percentile,
+        hedge_min_delay=settings.llm_hedge_min_delay,
+        hedge_default_delay=settings.llm_hedge_default_delay,
+        hedge_min_samples=settings.llm_hedge_min_samples,
+        breaker_failures=settings.llm_breaker_failures,
+        breaker_cooldown=settings.llm_breaker_cooldown
+    )
+
+
+# Глобальный маршрутизатор запросов к моделям чата
+router = create_router()
@@ -0,0 +1,78 @@
+"""
+Пиковая нагрузка на OpenAI: прямые вызовы против ai.client.AIClient
+
+Провайдер заглушен: ответ за LATENCY секунд, сверх PROVIDER_CONCURRENCY одновременных
+запросов - ошибка 429 (как при превышении лимита тарифа). Пик - MESSAGES сообщений
+одновременно. "До" - прямой вызов, как раньше: 429 превращается в извинение клиенту.
+"После" - AIClient: лишние запросы ждут в очереди, лимит одновременных запросов
+подстраивается под провайдера, 429 повторяются с задержкой.
+
+Запуск: python -m benchmarks.bench_ai_client
+"""
+import asyncio
+import logging
+import time
+
+from ai.client import AIClient
+
+LATENCY = 0.05
+PROVIDER_CONCURRENCY = 6
+MESSAGES = 200
+
+
+class RateLimitError(Exception):
+    http_status = 429
+
+
+class FakeProvider:
+    def __init__(self):
+        self.active = 0
+        self.rejected = 0
+
+    async def create(self):
+        if self.active >= PROVIDER_CONCURRENCY:
+            self.rejected += 1
+            await asyncio.sleep(0.005)
+            raise RateLimitError("Rate limit reached")
+        self.active += 1
+        try:
+            await asyncio.sleep(LATENCY)
+            return "ответ"
+        finally:
+            self.active -= 1
+
+
+async def run(label: str, call) -> None:
+    provider = FakeProvider()
+    latencies = []
+
+    async def one():
+        started = time.perf_counter()
+        try:
+            await call(provider)
+            latencies.append(time.perf_counter() - started)
+            return True
+        except RateLimitError:
+            return False
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*(one() for _ in range(MESSAGES)))
+    total = time.perf_counter() - started
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000 if latencies else 0.0
+    print(f"{label:<8} {sum(results) / MESSAGES * 100:9.0f}% {provider.rejected:8} {p95:10.0f} {total:9.2f}")
+
+
+async def main():
+    # Предупреждения о повторах не нужны в выводе
+    logging.getLogger("ai.client").setLevel(logging.ERROR)
+    client = AIClient(retry_base_delay=0.02, retry_max_delay=0.5, max_retries=8, initial_concurrency=16)
+    print(f"Пик: {MESSAGES} сообщений, провайдер принимает {PROVIDER_CONCURRENCY} запросов одновременно")
+    print(f"{'клиент':<8} {'ответов':>10} {'429':>8} {'p95, мс':>10} {'всего, с':>9}")
+    await run("до", lambda provider: provider.create())
+    await run("после", lambda provider: client.call("bench", provider.create))
+    print(f"Лимит одновременных запросов после пика: {int(client.limits('bench').limiter.limit)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,79 @@
+"""
+История диалога в запросе к модели: чтение chats на каждое сообщение против core.context
+
+Таблица chats заглушена списком в памяти с задержкой DB_COST на запрос. Каждый из USERS
+клиентов пишет MESSAGES сообщений. "До" - наивный вариант: вся история пользователя
+читается из базы на каждое сообщение и целиком уходит в запрос. "После" - ContextBuilder:
+кольцевой буфер в памяти, база - только при первом сообщении, бюджет CONTEXT_TOKEN_BUDGET.
+
+Запуск: python -m benchmarks.bench_context
+"""
+import asyncio
+import time
+from typing import Dict, List
+
+from config import settings
+from core.context import ContextBuilder, Turn, estimate_tokens
+
+DB_COST = 0.005
+USERS = 20
+MESSAGES = 40
+
+
+class FakeChats:
+    def __init__(self):
+        self.rows: Dict[str, List[Turn]] = {}
+        self.reads = 0
+
+    async def load(self, user_id: str, limit: int = None) -> List[Turn]:
+        self.reads += 1
+        await asyncio.sleep(DB_COST)
+        rows = self.rows.get(user_id, [])
+        return rows[-limit:] if limit else list(rows)
+
+    def write(self, user_id: str, turn: Turn):
+        self.rows.setdefault(user_id, []).append(turn)
+
+
+def turn(user: int, i: int) -> Turn:
+    return Turn(f"Клиент {user}, вопрос {i}: а можно торт с вишней и сливками на субботу?",
+                f"Ответ {i}: да, сделаем. Уточните вес торта и надпись, если она нужна. " * 2, time.time())
+
+
+async def run(label: str, history_for, chats: FakeChats, append=None):
+    tokens = []
+    started = time.perf_counter()
+    for i in range(MESSAGES):
+        for user in range(USERS):
+            history = await history_for(str(user))
+            tokens.append(sum(estimate_tokens(message["content"]) for message in history))
+            new_turn = turn(user, i)
+            chats.write(str(user), new_turn)
+            if append:
+                append(str(user), new_turn.message, new_turn.response)
+    per_message = (time.perf_counter() - started) / (USERS * MESSAGES) * 1000
+    print(f"{label:<8} {chats.reads:10} {sum(tokens) / len(tokens):12.0f} {max(tokens):10} {per_message:10.2f}")
+
+
+async def main():
+    print(f"{USERS} клиентов по {MESSAGES} сообщений, бюджет истории {settings.context_token_budget} токенов")
+    print(f"{'история':<8} {'чтений БД':>10} {'токенов ср.':>12} {'макс.':>10} {'мс/сообщ.':>10}")
+
+    chats = FakeChats()
+
+    async def naive(user_id):
+        messages = []
+        for row in await chats.load(user_id):
+            messages += [{"role": "user", "content": row.message}, {"role": "assistant", "content": row.response}]
+        return messages
+
+    await run("до", naive, chats)
+
+    chats = FakeChats()
+    builder = ContextBuilder(max_turns=settings.context_max_turns, token_budget=settings.context_token_budget,
+                             load=chats.load)
+    await run("после", builder.messages, chats, append=builder.append)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
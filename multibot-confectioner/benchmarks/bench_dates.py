@@ -0,0 +1,59 @@
+"""
+Точность и скорость разбора дат доставки на корпусе benchmarks/data/date_expressions.json
+
+Корпус - выражения клиентов ("к пятнице", "20 декабря", "через неделю") с ожидаемой
+датой относительно момента "now" корпуса; пустая дата - в тексте даты нет.
+"До" - прежний extract_date_from_text (только числовые форматы), "после" -
+core.utils.extract_date_from_text с таблицами core.dates.
+
+Запуск: python -m benchmarks.bench_dates
+"""
+import json
+import os
+import time
+from datetime import datetime
+
+from benchmarks.bench_text_extraction import legacy_date
+from core.utils import extract_date_from_text
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "data", "date_expressions.json")
+ROUNDS = 2000
+
+
+def load_corpus(path: str = CORPUS_PATH) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def accuracy(parse, items) -> float:
+    correct = 0
+    for item in items:
+        parsed = parse(item["text"])
+        correct += (parsed.strftime("%Y-%m-%d") if parsed else None) == item["date"]
+    return correct / len(items) * 100
+
+
+def throughput(parse, items) -> float:
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        for item in items:
+            parse(item["text"])
+    return ROUNDS * len(items) / (time.perf_counter() - started)
+
+
+def main():
+    corpus = load_corpus()
+    items = corpus["items"]
+    now = datetime.fromisoformat(corpus["now"])
+
+    def parse(text):
+        return extract_date_from_text(text, now=now)
+
+    print(f"Корпус: {len(items)} выражений, относительные даты от {corpus['now']}")
+    print(f"{'реализация':<10} {'точность':>9} {'выражений/с':>12}")
+    for label, func in (("до", legacy_date), ("после", parse)):
+        print(f"{label:<10} {accuracy(func, items):8.0f}% {throughput(func, items):12.0f}")
+
+
+if __name__ == "__main__":
+    main()
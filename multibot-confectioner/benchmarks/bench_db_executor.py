@@ -0,0 +1,93 @@
+"""
+Нагрузочный тест: задержка /health во время запросов к базе
+
+Клиент Supabase заглушен: каждый запрос синхронно "ждет сеть" QUERY_COST секунд.
+Параллельно с CRUD_WORKERS конкурентными вызовами crud /health запрашивается
+раз в HEALTH_INTERVAL секунд; задержка считается от запланированного момента
+запроса, поэтому в нее входит и время, пока event loop был занят.
+Сравниваются вызов .execute() прямо в event loop и выполнение запросов
+в пуле потоков (database.init.execute)
+
+Запуск: python -m benchmarks.bench_db_executor
+"""
+import asyncio
+import logging
+import time
+from unittest.mock import patch
+
+import httpx
+
+from core.metrics import Histogram
+from database import crud
+from main import app
+
+QUERY_COST = 0.01
+CRUD_WORKERS = 20
+HEALTH_REQUESTS = 100
+HEALTH_INTERVAL = 0.005
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class StubResponse:
+    data = []
+
+
+class StubQuery:
+    """Построитель запроса: любые .table/.select/.eq возвращают его же"""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self
+
+    def execute(self):
+        time.sleep(QUERY_COST)
+        return StubResponse()
+
+
+async def execute_in_loop(query):
+    """Старое поведение crud: синхронный вызов прямо в event loop"""
+    return query.execute()
+
+
+async def crud_load(stop: asyncio.Event):
+    i = 0
+    while not stop.is_set():
+        i += 1
+        await crud.get_orders_by_user_id(str(i))
+        # Между запросами обработчик отдает управление (отправка ответа и т.п.)
+        await asyncio.sleep(0)
+
+
+async def measure(label: str, load_workers: int = CRUD_WORKERS) -> Histogram:
+    latency = Histogram(max_samples=HEALTH_REQUESTS)
+    stop = asyncio.Event()
+    load = [asyncio.create_task(crud_load(stop)) for _ in range(load_workers)]
+
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        start = time.perf_counter()
+        for i in range(HEALTH_REQUESTS):
+            scheduled = start + i * HEALTH_INTERVAL
+            await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            response = await client.get("/health")
+            latency.observe(time.perf_counter() - scheduled)
+            assert response.status_code == 200
+
+    stop.set()
+    await asyncio.gather(*load)
+    snapshot = latency.snapshot()
+    print(f"{label:<22} /health p50 {snapshot['p50'] * 1000:7.2f} мс  p99 {snapshot['p99'] * 1000:7.2f} мс")
+    return latency
+
+
+async def main():
+    with patch("database.crud.get_supabase_client", return_value=StubQuery()):
+        await measure("без нагрузки", load_workers=0)
+        with patch("database.crud.execute", execute_in_loop):
+            before = await measure("execute в event loop")
+        after = await measure("пул потоков")
+    print(f"p99 /health под нагрузкой: {before.percentile(99) * 1000:.1f} мс -> {after.percentile(99) * 1000:.1f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
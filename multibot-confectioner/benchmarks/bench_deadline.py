@@ -0,0 +1,77 @@
+"""
+Зависший вызов модели: обработка сообщений без дедлайна против дедлайна core.deadline
+
+Сообщения одного потока опроса (как VK long poll или опрос Avito) обрабатываются по очереди.
+Провайдер модели заглушен: обычно отвечает за LATENCY, но доля HANG_SHARE вызовов зависает.
+"до" - без дедлайна: первый зависший вызов останавливает весь поток до конца окна WINDOW,
+"после" - дедлайн DEADLINE от получения сообщения, по истечении - шаблонный ответ.
+
+Запуск: python -m benchmarks.bench_deadline
+"""
+import asyncio
+import random
+import time
+from typing import List, Optional
+from unittest.mock import patch
+
+from ai.chat import generate_response
+from ai.providers import ChatProvider
+from ai.router import LLMRouter
+from core.deadline import DeadlineExceeded, deadline_after
+from core.metrics import _pick
+
+MESSAGES = 200
+LATENCY = 0.01
+HANG_SHARE = 0.03
+DEADLINE = 0.1
+WINDOW = 5.0
+
+
+class HangingProvider(ChatProvider):
+    name = "openai"
+
+    async def complete(self, messages, **params) -> str:
+        await asyncio.sleep(3600 if random.random() < HANG_SHARE else LATENCY)
+        return "ответ"
+
+
+async def run(label: str, deadline: Optional[float]):
+    random.seed(3)
+    latencies: List[float] = []
+    degraded = 0
+
+    async def poll():
+        nonlocal degraded
+        for i in range(MESSAGES):
+            started = time.perf_counter()
+            try:
+                if deadline is None:
+                    await generate_response(f"Сообщение {i}")
+                else:
+                    with deadline_after(deadline):
+                        await generate_response(f"Сообщение {i}")
+            except DeadlineExceeded:
+                degraded += 1
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    with patch("ai.chat.router", LLMRouter([HangingProvider()], hedge=False)):
+        try:
+            await asyncio.wait_for(poll(), WINDOW)
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    p99 = _pick(latencies, 99) * 1000 if latencies else 0
+    print(f"{label:<6} {len(latencies):>10} {degraded:>9} {p99:>8.0f} {elapsed:>8.2f}")
+
+
+async def main():
+    print(f"{MESSAGES} сообщений подряд, зависает {HANG_SHARE:.0%} вызовов, окно {WINDOW:.0f} с")
+    print(f"{'':<6} {'обработано':>10} {'шаблоном':>9} {'p99 мс':>8} {'время с':>8}")
+    await run("до", None)
+    await run("после", DEADLINE)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
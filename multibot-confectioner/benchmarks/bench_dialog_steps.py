@@ -0,0 +1,153 @@
+"""
+Задержка шагов диалога заказа: последовательные вызовы против параллельных
+
+Бэкенды заглушены задержками (OpenAI, Supabase). "До" - шаги описания
+и подтверждения, ждущие вызовы по очереди, как раньше; "после" - текущий
+ConversationEngine, где независимые вызовы выполняются через asyncio.gather,
+а изображение к подтвержденному заказу генерируется в фоне.
+
+Запуск: python -m benchmarks.bench_dialog_steps
+"""
+import asyncio
+import time
+from unittest.mock import patch
+
+from ai.image_cache import CakeImage
+from core.conversation import (
+    _TRANSITIONS, ASK_WEIGHT_TEXT, CONFIRM_WORDS, IMAGE_CAPTION, ORDER_ACCEPTED_TEXT,
+    ConversationEngine, IncomingMessage, PlatformAdapter, StepContext, build_order
+)
+from core.context import ContextBuilder
+from core.fsm import FSM, OrderState
+from database.models import Order, User
+
+ANALYZE_COST = 0.08
+RESPONSE_COST = 0.12
+IMAGE_COST = 0.30
+DB_COST = 0.02
+DIALOGS = 5
+
+SCRIPT = [
+    ("start", "/start"),
+    ("description", "Шоколадный торт на день рождения"),
+    ("weight", "2"),
+    ("ingredients", "вишня"),
+    ("delivery_date", "20.12.2030"),
+    ("confirmation", "да"),
+]
+
+
+async def stub_user(platform, platform_user_id):
+    return User(id=platform_user_id, platform=platform, platform_user_id=platform_user_id)
+
+
+async def stub_history(user_id, limit):
+    await asyncio.sleep(DB_COST)
+    return []
+
+
+async def stub_analyze(text):
+    await asyncio.sleep(ANALYZE_COST)
+    return {"weight": None}
+
+
+async def stub_response(prompt, user_info, cache=False, history=None):
+    await asyncio.sleep(RESPONSE_COST)
+    return "ответ"
+
+
+async def stub_image(description, weight, photo_analysis=None):
+    await asyncio.sleep(IMAGE_COST)
+    return CakeImage(key="0" * 64, data=b"", url="https://example.com/cake.png")
+
+
+async def stub_create_order(order):
+    await asyncio.sleep(DB_COST)
+    return Order(id="o1", **order.dict(exclude={"id"}))
+
+
+async def stub_update_order(order_id, order):
+    await asyncio.sleep(DB_COST)
+    return order
+
+
+class SilentAdapter(PlatformAdapter):
+    platform = "bench"
+    start_commands = frozenset(["/start"])
+
+    async def send_text(self, text):
+        pass
+
+    async def notify_confectioner(self, order):
+        pass
+
+    async def notify_confectioner_image(self, order, image):
+        pass
+
+
+# Прежний порядок вызовов: шаги ждут вызовы по очереди
+async def sequential_description(self: ConversationEngine, ctx: StepContext):
+    text = ctx.message.text
+    order_info = await stub_analyze(text)
+    data = {'description': text}
+    for key in ('weight', 'ingredients', 'delivery_date'):
+        if order_info.get(key):
+            data[key] = order_info[key]
+    await self._reply_with_ai(ctx, text)
+    await ctx.adapter.send_text(ASK_WEIGHT_TEXT)
+    await self._set_state(ctx, OrderState.WAITING_FOR_WEIGHT, data)
+
+
+async def sequential_confirmation(self: ConversationEngine, ctx: StepContext):
+    if ctx.message.text.strip().lower() not in CONFIRM_WORDS:
+        return
+    order = await stub_create_order(build_order(ctx.user, ctx.data))
+    image = await stub_image(ctx.data.get('description', ''), ctx.data.get('weight'))
+    await ctx.adapter.send_image(image, IMAGE_CAPTION)
+    await ctx.adapter.notify_confectioner(order)
+    await ctx.adapter.notify_confectioner_image(order, image)
+    await self.fsm.reset_state(ctx.user.id, ctx.message.platform)
+    await ctx.adapter.send_text(ORDER_ACCEPTED_TEXT)
+
+
+async def run(engine: ConversationEngine):
+    timings = {step: 0.0 for step, _ in SCRIPT}
+    adapter = SilentAdapter()
+    for dialog in range(DIALOGS):
+        for step, text in SCRIPT:
+            started = time.perf_counter()
+            await engine.handle(adapter, IncomingMessage(platform="bench", platform_user_id=str(dialog), text=text))
+            timings[step] += time.perf_counter() - started
+    # Фоновые генерации изображений не входят в задержку ответа
+    await engine.image_jobs.join()
+    return {step: total / DIALOGS for step, total in timings.items()}
+
+
+class NullChatLog:
+    async def write(self, chat):
+        pass
+
+
+async def main():
+    with patch("core.conversation.get_user_by_platform_id", stub_user), \
+         patch("core.conversation.chat_log", NullChatLog()), \
+         patch("core.conversation.analyze_order_description", stub_analyze), \
+         patch("core.conversation.generate_response", stub_response), \
+         patch("core.conversation.get_cake_image", stub_image), \
+         patch("core.conversation.create_order", stub_create_order), \
+         patch("core.conversation.update_order", stub_update_order):
+        sequential = {
+            OrderState.WAITING_FOR_DESCRIPTION: sequential_description,
+            OrderState.WAITING_FOR_CONFIRMATION: sequential_confirmation,
+        }
+        with patch.dict(_TRANSITIONS, sequential):
+            before = await run(ConversationEngine(FSM(), context=ContextBuilder(load=stub_history)))
+        after = await run(ConversationEngine(FSM(), context=ContextBuilder(load=stub_history)))
+
+    print(f"{'шаг':<14} {'до, мс':>8} {'после, мс':>10}")
+    for step, _ in SCRIPT:
+        print(f"{step:<14} {before[step] * 1000:8.1f} {after[step] * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""
+Точность и задержка извлечения параметров заказа на размеченном корпусе
+
+Корпус - benchmarks/data/order_descriptions.json: описание и ожидаемые вес (кг),
+ингредиенты и дата доставки (относительные даты - от момента "now" корпуса).
+Уровни: local - регулярные выражения core.extraction, tiered - local с обращением
+к модели за недостающими полями, llm - только analyze_order_description.
+Уровни с моделью платные и запускаются только при BENCH_LLM=1 (нужен OPENAI_API_KEY);
+без модели для tiered выводится, сколько описаний ушло бы в модель.
+
+Запуск: python -m benchmarks.bench_extraction
+"""
+import asyncio
+import json
+import os
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from ai.chat import analyze_order_description
+from config import settings
+from core.extraction import ORDER_FIELDS, Extraction, TieredExtractor, extract_local, needs_llm
+from core.utils import extract_date_from_text
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "data", "order_descriptions.json")
+LOCAL_ROUNDS = 200
+MIN_CONFIDENCE = settings.extraction_min_confidence
+
+
+def load_corpus(path: str = CORPUS_PATH) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _as_date(value: Any) -> Optional[str]:
+    if not value:
+        return None
+    for fmt in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(str(value), fmt).strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+    parsed = extract_date_from_text(str(value))
+    return parsed.strftime("%Y-%m-%d") if parsed else None
+
+
+def _as_weight(value: Any) -> Optional[float]:
+    try:
+        return float(str(value).replace(",", ".")) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def _as_items(value: Any) -> List[str]:
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.replace(" и ", ",").split(",")
+    return [str(item).strip().lower() for item in value if str(item).strip()]
+
+
+def _ingredients_match(expected: List[str], predicted: List[str]) -> bool:
+    """Совпадение по основе слова (первые 4 буквы): "вишня" == "вишней", "сметана" == "сметанный крем" """
+    stems = [item[:4] for item in expected]
+    return (all(any(stem in item for item in predicted) for stem in stems)
+            and all(any(stem in item for stem in stems) for item in predicted))
+
+
+def score(item: Dict[str, Any], values: Dict[str, Any]) -> Dict[str, bool]:
+    weight = _as_weight(values.get("weight"))
+    return {
+        "weight": (weight is None if item["weight"] is None
+                   else weight is not None and abs(weight - item["weight"]) < 0.01),
+        "ingredients": _ingredients_match(item["ingredients"], _as_items(values.get("ingredients"))),
+        "delivery_date": _as_date(values.get("delivery_date")) == item["delivery_date"],
+    }
+
+
+def report(label: str, items: List[Dict[str, Any]], results: List[Dict[str, Any]],
+           latencies: List[float], llm_calls: Optional[int] = None):
+    scores = [score(item, values) for item, values in zip(items, results)]
+    accuracy = {key: sum(s[key] for s in scores) / len(scores) * 100 for key in ORDER_FIELDS}
+    exact = sum(all(s.values()) for s in scores) / len(scores) * 100
+    latencies = sorted(latencies)
+    mean = sum(latencies) / len(latencies) * 1000
+    p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+    calls = f"{llm_calls:>6}" if llm_calls is not None else f"{'-':>6}"
+    print(f"{label:<8} {accuracy['weight']:6.0f}% {accuracy['ingredients']:6.0f}% {accuracy['delivery_date']:6.0f}% "
+          f"{exact:6.0f}% {mean:10.3f} {p95:10.3f} {calls}")
+
+
+def bench_local(items: List[Dict[str, Any]], now: datetime):
+    results, latencies = [], []
+    for item in items:
+        started = time.perf_counter()
+        for _ in range(LOCAL_ROUNDS):
+            extraction = extract_local(item["text"], now=now)
+        latencies.append((time.perf_counter() - started) / LOCAL_ROUNDS)
+        # В результат попадают только уверенные значения, как в TieredExtractor
+        results.append({key: extraction.values[key] for key in ORDER_FIELDS
+                        if key in extraction.values and key not in extraction.missing(MIN_CONFIDENCE)})
+    report("local", items, results, latencies)
+
+
+async def bench_llm(items: List[Dict[str, Any]]):
+    results, latencies = [], []
+    for item in items:
+        started = time.perf_counter()
+        results.append(await analyze_order_description(item["text"]))
+        latencies.append(time.perf_counter() - started)
+    report("llm", items, results, latencies, llm_calls=len(items))
+
+
+async def bench_tiered(items: List[Dict[str, Any]], now: datetime):
+    extractor = TieredExtractor(min_confidence=MIN_CONFIDENCE)
+    calls = 0
+
+    async def counting_llm(text: str) -> Dict[str, Any]:
+        nonlocal calls
+        calls += 1
+        return await analyze_order_description(text)
+
+    results, latencies = [], []
+    for item in items:
+        started = time.perf_counter()
+        extraction: Extraction = await extractor.extract(item["text"], counting_llm, now=now)
+        latencies.append(time.perf_counter() - started)
+        results.append(extraction.values)
+    report("tiered", items, results, latencies, llm_calls=calls)
+
+
+async def main():
+    corpus = load_corpus()
+    items = corpus["items"]
+    now = datetime.fromisoformat(corpus["now"])
+    print(f"Корпус: {len(items)} описаний, относительные даты от {corpus['now']}")
+    print(f"{'уровень':<8} {'вес':>7} {'начинка':>7} {'дата':>7} {'все':>7} {'сред, мс':>10} {'p95, мс':>10} {'модель':>6}")
+    bench_local(items, now)
+
+    if os.environ.get("BENCH_LLM") == "1":
+        await bench_llm(items)
+        await bench_tiered(items, now)
+    else:
+        routed = sum(1 for item in items if needs_llm(item["text"], extract_local(item["text"], now=now), MIN_CONFIDENCE))
+        print(f"Уровни с моделью пропущены (BENCH_LLM=1 для запуска); "
+              f"в модель ушло бы {routed} из {len(items)} описаний")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+"""
+Микробенчмарк операций с состояниями диалога для хранилищ core.fsm
+
+Один "шаг диалога" - get_session + set_state, как в ConversationEngine.
+Redis проверяется, если доступен REDIS_URL (по умолчанию redis://localhost:6379/15,
+например из docker-compose), иначе пропускается.
+
+Запуск: python -m benchmarks.bench_fsm_storage
+"""
+import asyncio
+import os
+import time
+
+from core.fsm import FSM, MemoryStorage, OrderState, RedisStorage
+
+USERS = 500
+STEPS = 4000
+
+
+async def bench(label: str, state_machine: FSM):
+    start = time.perf_counter()
+    for i in range(STEPS):
+        user_id = str(i % USERS)
+        await state_machine.get_session(user_id, "bench")
+        await state_machine.set_state(user_id, "bench", OrderState.WAITING_FOR_WEIGHT, {"description": "торт", "step": i})
+    elapsed = time.perf_counter() - start
+    ops = STEPS * 2 / elapsed
+    print(f"{label:<10} {ops:10.0f} операций/с  ({STEPS} шагов за {elapsed:.2f} с)")
+
+    for i in range(USERS):
+        await state_machine.reset_state(str(i), "bench")
+
+
+async def main():
+    await bench("memory", FSM(MemoryStorage(), ttl=60))
+
+    redis_url = os.environ.get("BENCH_REDIS_URL", "redis://localhost:6379/15")
+    try:
+        storage = RedisStorage(redis_url, prefix="bench:fsm:")
+        await storage._redis.ping()
+    except Exception as e:
+        print(f"redis      пропущен: {e}")
+        return
+    try:
+        await bench("redis", FSM(storage, ttl=60))
+    finally:
+        await storage.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
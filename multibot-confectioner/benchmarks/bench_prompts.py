@@ -0,0 +1,50 @@
+"""
+Системный промпт: сборка на каждый запрос против заранее собранного реестра ai.prompts
+
+Время получения промпта (мкс) и общее начало промптов разных вариантов в каждой версии:
+кэш префикса у провайдера работает только для совпадающего начала запроса, поэтому
+чем длиннее общее начало, тем больше токенов разных клиентов может браться из кэша.
+
+Запуск: python -m benchmarks.bench_prompts
+"""
+import os
+import time
+
+from ai.prompts import PROMPT_BUILDERS, VARIANTS, PromptRegistry, build_system_prompt, prompt_variant
+from core.context import estimate_tokens
+
+ROUNDS = 100000
+USERS = [{"id": str(i), "age": (12, 30, 70)[i % 3], "gender": ("male", "female", None)[i % 3]} for i in range(90)]
+
+
+def common_prefix(texts) -> str:
+    return os.path.commonprefix(list(texts))
+
+
+def main():
+    registry = PromptRegistry(PROMPT_BUILDERS, version="v1")
+
+    started = time.perf_counter()
+    for i in range(ROUNDS):
+        build_system_prompt(prompt_variant(USERS[i % len(USERS)]))
+    build = (time.perf_counter() - started) / ROUNDS * 1e6
+
+    started = time.perf_counter()
+    for i in range(ROUNDS):
+        registry.select(USERS[i % len(USERS)])
+    lookup = (time.perf_counter() - started) / ROUNDS * 1e6
+
+    print(f"{'промпт':<22} {'мкс':>8}")
+    print(f"{'сборка на запрос':<22} {build:8.2f}")
+    print(f"{'реестр':<22} {lookup:8.2f}")
+    print()
+    print(f"{'версия':<8} {'общее начало, токенов':>22} {'промпт, токенов':>16}")
+    for version in PROMPT_BUILDERS:
+        texts = [registry.get(version, variant) for variant in VARIANTS]
+        prefix = common_prefix(texts)
+        average = sum(map(estimate_tokens, texts)) / len(texts)
+        print(f"{version:<8} {estimate_tokens(prefix):22} {average:16.0f}")
+
+
+if __name__ == "__main__":
+    main()
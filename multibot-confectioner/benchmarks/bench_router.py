@@ -0,0 +1,91 @@
+"""
+Маршрутизатор моделей ai.router: один провайдер против переключения и дублирования запросов
+
+Провайдеры заглушены: задержка BASE с "хвостом" - доля TAIL_SHARE ответов в TAIL_FACTOR раз
+медленнее. Основной провайдер в середине прогона (OUTAGE) недоступен: отвечает ошибкой
+через OUTAGE_DELAY. "один" - только основной провайдер (как до маршрутизатора, ошибка - извинение клиенту),
+"переключение" - основной, резервный и локальный без дублирования, "дубль p95" - с дублированием.
+Задержки - по полученным ответам.
+
+Запуск: python -m benchmarks.bench_router
+"""
+import asyncio
+import logging
+import random
+import time
+
+from ai.providers import ChatProvider, LocalProvider
+from ai.router import LLMRouter
+from core.metrics import _pick
+
+REQUESTS = 600
+CONCURRENCY = 20
+BASE = 0.04
+TAIL_SHARE = 0.04
+TAIL_FACTOR = 8
+OUTAGE = range(250, 400)
+OUTAGE_DELAY = 0.1
+
+
+class FakeProvider(ChatProvider):
+    def __init__(self, name: str, base: float, down=lambda: False):
+        self.name = name
+        self.base = base
+        self.down = down
+        self.calls = 0
+
+    async def complete(self, messages, **params) -> str:
+        self.calls += 1
+        if self.down():
+            await asyncio.sleep(OUTAGE_DELAY)
+            raise RuntimeError("503 Service Unavailable")
+        slow = random.random() < TAIL_SHARE
+        await asyncio.sleep(self.base * random.uniform(0.8, 1.2) * (TAIL_FACTOR if slow else 1))
+        return f"ответ {self.name}"
+
+
+async def run(label: str, hedge: bool, backup: bool):
+    random.seed(1)
+    sent = 0
+    primary = FakeProvider("openai", BASE, down=lambda: sent in OUTAGE)
+    providers = [primary]
+    if backup:
+        providers += [FakeProvider("backup", BASE * 1.5), LocalProvider()]
+    router = LLMRouter(providers, hedge=hedge, hedge_min_delay=0.01, hedge_default_delay=0.2,
+                       hedge_min_samples=20, breaker_failures=5, breaker_cooldown=0.5)
+
+    latencies, errors, fallbacks = [], 0, 0
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def request():
+        nonlocal sent, errors, fallbacks
+        async with semaphore:
+            sent += 1
+            started = time.perf_counter()
+            try:
+                reply = await router.complete([{"role": "user", "content": "Торт на субботу?"}])
+                fallbacks += reply.fallback
+                latencies.append(time.perf_counter() - started)
+            except Exception:
+                errors += 1
+
+    await asyncio.gather(*(request() for _ in range(REQUESTS)))
+    latencies.sort()
+    calls = sum(getattr(provider, "calls", 0) for provider in providers)
+    print(f"{label:<14} {_pick(latencies, 50) * 1000:7.0f} {_pick(latencies, 95) * 1000:7.0f} "
+          f"{_pick(latencies, 99) * 1000:7.0f} {errors:7} {fallbacks:9} {calls / REQUESTS:10.2f}")
+
+
+async def main():
+    logging.getLogger("ai.router").setLevel(logging.ERROR)
+    print(f"{REQUESTS} запросов по {CONCURRENCY} одновременно, основной провайдер недоступен "
+          f"на запросах {OUTAGE.start}-{OUTAGE.stop}")
+    print(f"{'маршрутизация':<14} {'p50 мс':>7} {'p95 мс':>7} {'p99 мс':>7} {'ошибок':>7} "
+          f"{'локально':>9} {'вызовов/з':>10}")
+    await run("один", hedge=False, backup=False)
+    await run("переключение", hedge=False, backup=True)
+    await run("дубль p95", hedge=True, backup=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,64 @@
+"""
+Время до первого текста у клиента Telegram: ответ целиком против потокового ответа
+
+Модель заглушена: CHUNKS фрагментов с интервалом CHUNK_INTERVAL секунд (ответ около
+400 токенов). "До" - message.answer после полного ответа, "после" - TelegramAdapter.send_stream:
+первое сообщение с первым фрагментом, затем правки не чаще TELEGRAM_STREAM_EDIT_INTERVAL.
+
+Запуск: python -m benchmarks.bench_streaming
+"""
+import asyncio
+import time
+from unittest.mock import AsyncMock, MagicMock
+
+from bots.telegram import TelegramAdapter
+from core.conversation import PlatformAdapter
+
+CHUNKS = 120
+CHUNK_INTERVAL = 0.025
+
+
+async def fake_stream():
+    for i in range(CHUNKS):
+        await asyncio.sleep(CHUNK_INTERVAL)
+        yield f"слово{i} "
+
+
+def fake_message(started: float, first_text: list):
+    sent = MagicMock()
+    sent.edit_text = AsyncMock()
+
+    async def answer(text):
+        first_text.append(time.perf_counter() - started)
+        return sent
+
+    message = MagicMock()
+    message.answer = answer
+    return message, sent
+
+
+async def measure(label: str, send) -> None:
+    first_text = []
+    started = time.perf_counter()
+    message, sent = fake_message(started, first_text)
+    await send(message)
+    total = time.perf_counter() - started
+    print(f"{label:<8} {first_text[0] * 1000:14.0f} {total * 1000:12.0f} {sent.edit_text.await_count:7}")
+
+
+async def main():
+    print(f"Ответ: {CHUNKS} фрагментов по {CHUNK_INTERVAL * 1000:.0f} мс")
+    print(f"{'ответ':<8} {'до текста, мс':>14} {'всего, мс':>12} {'правок':>7}")
+
+    async def whole(message):
+        await PlatformAdapter.send_stream(TelegramAdapter(message), fake_stream())
+
+    async def streaming(message):
+        await TelegramAdapter(message).send_stream(fake_stream())
+
+    await measure("целиком", whole)
+    await measure("поток", streaming)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
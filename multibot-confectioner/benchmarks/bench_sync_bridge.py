@@ -0,0 +1,69 @@
+"""
+Бенчмарк синхронных обёрток ботов VK/Avito: новый event loop на каждый вызов
+против общего фонового цикла (core.async_bridge)
+
+Бэкенд заглушен: "клиент" держит пул соединений на каждый event loop,
+а установка соединения стоит CONNECT_COST секунд (TLS-рукопожатие к OpenAI/Supabase).
+Одно сообщение VK проходит через CALLS_PER_MESSAGE вызовов *_sync.
+
+Запуск: python -m benchmarks.bench_sync_bridge
+"""
+import asyncio
+import time
+import weakref
+
+from core.async_bridge import AsyncBridge
+
+CONNECT_COST = 0.002
+REQUEST_COST = 0.0005
+CALLS_PER_MESSAGE = 5
+MESSAGES = 200
+
+# Пул "соединений" на каждый event loop, как у aiohttp/httpx клиентов
+_pools = weakref.WeakKeyDictionary()
+
+
+async def stub_backend_call():
+    loop = asyncio.get_running_loop()
+    if loop not in _pools:
+        await asyncio.sleep(CONNECT_COST)
+        _pools[loop] = True
+    await asyncio.sleep(REQUEST_COST)
+    return {"ok": True}
+
+
+def run_with_new_loop(coro):
+    """Старое поведение *_sync функций"""
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+def bench(label, runner):
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        for _ in range(CALLS_PER_MESSAGE):
+            runner(stub_backend_call())
+    elapsed = time.perf_counter() - start
+    rate = MESSAGES / elapsed
+    print(f"{label:<28} {rate:8.1f} сообщений/с  ({elapsed:.2f} с на {MESSAGES} сообщений)")
+    return rate
+
+
+def main():
+    before = bench("new_event_loop на вызов", run_with_new_loop)
+
+    bridge = AsyncBridge(name="bench-bridge")
+    try:
+        after = bench("общий фоновый цикл", bridge.run)
+    finally:
+        bridge.stop()
+
+    print(f"Ускорение: x{after / before:.2f}")
+
+
+if __name__ == "__main__":
+    main()
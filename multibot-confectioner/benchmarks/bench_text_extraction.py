@@ -0,0 +1,112 @@
+"""
+Пропускная способность извлечения веса, даты и ингредиентов из текста (сообщений/с)
+
+Синтетический корпус описаний заказов на русском собирается из шаблонов с фиксированным
+seed. "До" - прежние функции core.utils: пять некомпилированных шаблонов веса
+и пять шаблонов даты через re.findall, 26 поисков подстроки для ингредиентов.
+"После" - core.utils.extract_order_fields: одно заранее скомпилированное выражение,
+все поля за один проход по тексту, ингредиенты и декор - по словарю core.lexicon
+(около 60 записей с формами слов вместо 26 слов в именительном падеже).
+
+Запуск: python -m benchmarks.bench_text_extraction
+"""
+import random
+import re
+import time
+from datetime import datetime
+
+from core.utils import extract_order_fields
+
+MESSAGES = 20000
+ROUNDS = 3
+
+CAKES = ["Торт", "Шоколадный торт", "Медовик", "Наполеон", "Чизкейк", "Бенто-торт", "Свадебный торт"]
+FILLINGS = ["с вишней", "с клубникой и сливками", "с кремом", "с орехами", "с малиной и шоколадом",
+            "с творогом и лимоном", "с манго", "без начинки", "с карамелью"]
+WEIGHTS = ["2 кг", "1,5 кг", "800 г", "3кг", "весом 2.5 кг", "на 10 человек", ""]
+DATES = ["к 20.12.2030", "на 05/01/2031", "доставка 2030-12-30", "к пятнице", "на 15.03.31", ""]
+TAILS = ["", "Надпись 'С днем рождения!'", "Для дочки на 7 лет", "Сколько будет стоить?",
+         "Хотим ярко и с ягодами сверху, без мастики"]
+
+
+def build_corpus(size: int = MESSAGES, seed: int = 42) -> list:
+    rng = random.Random(seed)
+    corpus = []
+    for _ in range(size):
+        parts = [rng.choice(CAKES), rng.choice(FILLINGS), rng.choice(WEIGHTS), rng.choice(DATES), rng.choice(TAILS)]
+        corpus.append(", ".join(part for part in parts if part))
+    return corpus
+
+
+# Прежняя реализация core.utils
+def legacy_weight(text):
+    patterns = [r'(\d+[,\.]?\d*)\s*кг', r'(\d+[,\.]?\d*)\s*kg', r'(\d+[,\.]?\d*)\s*г', r'(\d+[,\.]?\d*)\s*g',
+                r'(\d+[,\.]?\d*)']
+    for i, pattern in enumerate(patterns):
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            try:
+                weight = float(matches[0].replace(',', '.'))
+                return weight / 1000.0 if i in [2, 3] else weight
+            except ValueError:
+                continue
+    return None
+
+
+def legacy_date(text):
+    date_patterns = [r'(\d{1,2})\.(\d{1,2})\.(\d{4})', r'(\d{1,2})-(\d{1,2})-(\d{4})', r'(\d{1,2})/(\d{1,2})/(\d{4})',
+                     r'(\d{4})-(\d{1,2})-(\d{1,2})', r'(\d{1,2})\.(\d{1,2})\.(\d{2})']
+    for pattern in date_patterns:
+        matches = re.findall(pattern, text)
+        if matches:
+            try:
+                match = matches[0]
+                year = int('20' + match[2]) if len(match[2]) == 2 else int(match[2])
+                return datetime(year, int(match[1]), int(match[0]))
+            except ValueError:
+                continue
+    return None
+
+
+LEGACY_KEYWORDS = [
+    'шоколад', 'вишня', 'клубника', 'крем', 'орехи', 'изюм', 'масло',
+    'сметана', 'творог', 'яйца', 'мука', 'сахар', 'ваниль', 'какао',
+    'малина', 'черника', 'лимон', 'апельсин', 'кокос', 'миндаль',
+    'фундук', 'кешью', 'фисташки', 'сливки', 'повидло', 'джем'
+]
+
+
+def legacy_ingredients(text):
+    text_lower = text.lower()
+    return [ingredient for ingredient in LEGACY_KEYWORDS if ingredient in text_lower]
+
+
+def legacy(text):
+    return legacy_weight(text), legacy_date(text), legacy_ingredients(text)
+
+
+def bench(extract, corpus) -> float:
+    best = float("inf")
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        for text in corpus:
+            extract(text)
+        best = min(best, time.perf_counter() - started)
+    return len(corpus) / best
+
+
+def main():
+    corpus = build_corpus()
+    # Прогрев кэша регулярных выражений модуля re для прежней реализации
+    legacy(corpus[0])
+    before = bench(legacy, corpus)
+    after = bench(extract_order_fields, corpus)
+    print(f"Корпус: {len(corpus)} сообщений, средняя длина {sum(map(len, corpus)) / len(corpus):.0f} символов")
+    print(f"{'реализация':<24} {'сообщений/с':>12}")
+    print(f"{'до (по шаблону)':<24} {before:12.0f}")
+    print(f"{'после (один проход)':<24} {after:12.0f}")
+    print(f"Ускорение: {after / before:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,554 +1,300 @@
-import requests
 from config import settings
-from ai.chat import generate_response, analyze_order_description
-from ai.image_gen import generate_cake_image
-from database.crud import create_user, get_user_by_platform_id, create_order, create_chat
-import threading
+from ai.image_cache import CakeImage
+from core.cache import TTLCache
+from core.conversation import IncomingMessage, PlatformAdapter, engine
+from core.dispatcher import KeyedDispatcher
+from bots.telegram import notify_confectioner, send_confectioner_image
+from database.models import Order
+import aiohttp
+import asyncio
 import time
 import logging
 from typing import Optional
 
 logger = logging.getLogger(__name__)
 
-# Глобальные переменные для хранения токенов
-access_token = None
-expires_in = None
-last_token_refresh = None
+AVITO_API_URL = "https://api.avito.ru"
 
-# Словарь для хранения состояний пользователей (в реальной реализации лучше использовать Redis или базу данных)
-user_states = {}
 
-def setup_avito_bot():
+class AvitoAdapter(PlatformAdapter):
+    """Отправка ответов в диалог Avito"""
+
+    platform = "avito"
+    welcome_text = (
+        "🎂 Спасибо за обращение! Я AI-помощник кондитерской.\n\n"
+        "Давайте оформим ваш заказ на торт или десерт. "
+        "Опишите, какой торт вы хотите?"
+    )
+    start_keywords = ('торт', 'десерт', 'заказ', 'хочу', 'нужен')
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+
+    async def send_text(self, text: str):
+        await send_message_to_avito(self.conversation_id, text)
+
+    async def notify_confectioner(self, order: Order):
+        # Отправляем уведомление в чат кондитера через Telegram
+        await notify_confectioner(order, source="Avito")
+
+    async def notify_confectioner_image(self, order: Order, image: CakeImage):
+        await send_confectioner_image(order, image)
+
+
+class AvitoClient:
+    """Асинхронный клиент Avito API с общим пулом HTTP-соединений"""
+
+    def __init__(self):
+        self.access_token: Optional[str] = None
+        self.expires_in: Optional[int] = None
+        self.last_token_refresh: Optional[float] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token_lock = asyncio.Lock()
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=settings.avito_http_pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=30)
+            )
+        return self._session
+
+    async def refresh_token(self):
+        """Обновление токена Avito"""
+        try:
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': settings.avito_client_id,
+                'client_secret': settings.avito_client_secret
+            }
+
+            async with self.session.post(f"{AVITO_API_URL}/oauth/token", data=data) as response:
+                response.raise_for_status()
+                token_data = await response.json()
+
+            self.access_token = token_data['access_token']
+            self.expires_in = token_data['expires_in']
+            self.last_token_refresh = time.time()
+
+            logger.info("Токен Avito успешно обновлен")
+
+        except Exception as e:
+            logger.error(f"Ошибка обновления токена Avito: {e}")
+            raise
+
+    async def get_headers(self) -> dict:
+        """Получение заголовков для запросов к Avito API"""
+        # Обновляем токен за 10 минут до истечения; блокировка не дает
+        # параллельным обработчикам обновлять токен одновременно
+        async with self._token_lock:
+            if self.last_token_refresh is None or time.time() - self.last_token_refresh >= (self.expires_in - 600):
+                await self.refresh_token()
+
+        return {
+            'Authorization': f'Bearer {self.access_token}',
+            'Content-Type': 'application/json'
+        }
+
+    async def get_new_messages(self) -> list:
+        """Получение новых сообщений от Avito"""
+        headers = await self.get_headers()
+
+        # URL для получения сообщений (в реальной реализации нужно использовать правильный endpoint)
+        url = f"{AVITO_API_URL}/messenger/v1/accounts/messages"
+
+        async with self.session.get(url, headers=headers) as response:
+            response.raise_for_status()
+            messages = await response.json()
+
+        # Непрочитанные сообщения возвращаются при каждом опросе, пока диалог не отмечен прочитанным:
+        # повторы отсеивает enqueue_message по ID сообщения
+        return messages.get('messages', [])
+
+    async def mark_read(self, conversation_id: str):
+        """Отметка диалога прочитанным, чтобы его сообщения не возвращались следующим опросом"""
+        headers = await self.get_headers()
+
+        # URL отметки прочтения (в реальной реализации нужно использовать правильный endpoint)
+        url = f"{AVITO_API_URL}/messenger/v1/accounts/conversations/{conversation_id}/read"
+
+        async with self.session.post(url, headers=headers) as response:
+            response.raise_for_status()
+
+    async def send_message(self, conversation_id: str, message: str):
+        """Отправка сообщения в диалог Avito"""
+        headers = await self.get_headers()
+
+        # URL для отправки сообщения (в реальной реализации нужно использовать правильный endpoint)
+        url = f"{AVITO_API_URL}/messenger/v1/accounts/conversations/{conversation_id}/messages"
+
+        async with self.session.post(url, headers=headers, json={'text': message}) as response:
+            response.raise_for_status()
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+client = AvitoClient()
+dispatcher: Optional[KeyedDispatcher] = None
+# ID уже принятых сообщений по диалогам: опрос возвращает непрочитанные сообщения повторно,
+# а вебхук может доставить одно уведомление дважды
+seen_messages = TTLCache("avito_seen", max_size=settings.avito_seen_messages, ttl=settings.avito_seen_ttl)
+poller_task: Optional[asyncio.Task] = None
+
+
+async def setup_avito_bot():
     """Инициализация Avito бота"""
-    global access_token, last_token_refresh
-    
+    global dispatcher, poller_task
+
     try:
         # Получаем токен при инициализации
-        refresh_avito_token()
-        
+        await client.refresh_token()
+
         logger.info("Avito бот инициализирован")
-        
-        # Запускаем обработку сообщений в отдельном потоке
-        thread = threading.Thread(target=process_avito_messages)
-        thread.daemon = True
-        thread.start()
-        
+        if not settings.public_base_url:
+            logger.warning("PUBLIC_BASE_URL не задан: изображения из кэша не будут отправлены в Avito "
+                           "(новые отправляются временной ссылкой OpenAI)")
+
+        # Опрос сообщений и их обработка выполняются задачами в event loop приложения
+        dispatcher = KeyedDispatcher("avito", max_in_flight=settings.avito_max_concurrency)
+        
+        # При вебхуках сообщения приходят на /webhook/avito/<секрет>, опрос не нужен
+        if settings.avito_use_webhook and not settings.avito_webhook_secret:
+            logger.error("AVITO_WEBHOOK_SECRET не задан: вебхук Avito отклоняет все уведомления")
+        if not settings.avito_use_webhook:
+            poller_task = asyncio.create_task(process_avito_messages(), name="avito-poller")
+
     except Exception as e:
         logger.error(f"Ошибка инициализации Avito бота: {e}")
         raise
 
-def refresh_avito_token():
-    """Обновление токена Avito"""
-    global access_token, expires_in, last_token_refresh
-    
-    try:
-        url = "https://api.avito.ru/oauth/token"
-        
-        data = {
-            'grant_type': 'client_credentials',
-            'client_id': settings.avito_client_id,
-            'client_secret': settings.avito_client_secret
-        }
-        
-        response = requests.post(url, data=data)
-        response.raise_for_status()
-        
-        token_data = response.json()
-        access_token = token_data['access_token']
-        expires_in = token_data['expires_in']
-        last_token_refresh = time.time()
-        
-        logger.info("Токен Avito успешно обновлен")
-        
-    except Exception as e:
-        logger.error(f"Ошибка обновления токена Avito: {e}")
-        raise
 
-def check_token_validity():
-    """Проверка валидности токена"""
-    global last_token_refresh
-    
-    if last_token_refresh is None:
-        return False
-    
-    # Обновляем токен за 10 минут до истечения
-    if time.time() - last_token_refresh >= (expires_in - 600):
-        refresh_avito_token()
-        return True
-    
-    return True
+async def shutdown_avito_bot():
+    """Остановка опроса Avito и закрытие HTTP-сессии"""
+    if poller_task is not None:
+        poller_task.cancel()
+        await asyncio.gather(poller_task, return_exceptions=True)
+    if dispatcher is not None:
+        await dispatcher.close()
+    await client.close()
 
-def get_headers():
-    """Получение заголовков для запросов к Avito API"""
-    check_token_validity()
-    return {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
 
-def process_avito_messages():
-    """Обработка сообщений от Avito в отдельном потоке"""
-    try:
-        while True:
-            try:
-                # Получаем новые сообщения
-                messages = get_new_messages()
-                
-                for message in messages:
-                    handle_message(message)
-                
-                # Пауза между запросами (чтобы не превышать лимиты API)
-                time.sleep(30)
-                
-            except Exception as e:
-                logger.error(f"Ошибка обработки сообщений Avito: {e}")
-                time.sleep(60)  # Пауза перед повторной попыткой
-                
-    except Exception as e:
-        logger.error(f"Критическая ошибка в процессе обработки сообщений Avito: {e}")
-
-def get_new_messages() -> list:
-    """Получение новых сообщений от Avito"""
-    try:
-        headers = get_headers()
-        
-        # URL для получения сообщений (в реальной реализации нужно использовать правильный endpoint)
-        # Это пример - в реальности нужно использовать соответствующий API endpoint
-        url = "https://api.avito.ru/messenger/v1/accounts/messages"
-        
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()
-        
-        messages = response.json()
-        
-        # Возвращаем только новые сообщения (в реальной реализации нужно отслеживать уже обработанные сообщения)
-        return messages.get('messages', [])
-        
-    except Exception as e:
-        logger.error(f"Ошибка получения сообщений от Avito: {e}")
-        return []
+async def poll_avito_messages() -> int:
+    """
+    Один опрос: новые сообщения ставятся в очередь по порядку создания, диалоги отмечаются прочитанными
+    :return: Число принятых (не повторных) сообщений
+    """
+    messages = sorted(await get_new_messages(), key=lambda message: message.get('created') or 0)
+    accepted = 0
+    conversations = []
+    for message in messages:
+        accepted += await enqueue_message(message)
+        conversation_id = message.get('conversation_id')
+        if conversation_id and conversation_id not in conversations:
+            conversations.append(conversation_id)
 
-def handle_message(message_data):
-    """Обработка сообщения от Avito"""
-    try:
-        # Извлекаем информацию из сообщения
-        user_id = str(message_data.get('user_id', ''))
-        message_text = message_data.get('text', '')
-        conversation_id = message_data.get('conversation_id', '')
-        
-        # Проверяем, есть ли пользователь в базе
-        user = get_user_by_platform_id_sync("avito", user_id)
-        
-        if not user:
-            # Создаем нового пользователя
-            user_data = {
-                "platform": "avito",
-                "platform_user_id": user_id,
-            }
-            user = create_user_sync(user_data)
-        
-        # Сохраняем сообщение в чат
-        create_chat_sync({
-            "user_id": user.id,
-            "platform": "avito",
-            "message": message_text,
-            "ai_model": "user"
-        })
-        
-        # Получаем текущее состояние пользователя
-        current_state = user_states.get(user_id)
-        
-        # Проверяем, является ли сообщение инициацией нового заказа
-        if any(word in message_text.lower() for word in ['торт', 'десерт', 'заказ', 'хочу', 'нужен']):
-            # Начинаем новый заказ
-            user_states[user_id] = 'waiting_for_description'
-            
-            # Отправляем приветственное сообщение
-            welcome_text = (
-                "🎂 Спасибо за обращение! Я AI-помощник кондитерской.\n\n"
-                "Давайте оформим ваш заказ на торт или десерт. "
-                "Опишите, какой торт вы хотите?"
-            )
-            
-            send_message_to_avito(conversation_id, welcome_text)
-            return
-        
-        # Обработка в зависимости от состояния
-        if current_state == 'waiting_for_description':
-            handle_description(user, user_id, conversation_id, message_text)
-        elif current_state == 'waiting_for_weight':
-            handle_weight(user, user_id, conversation_id, message_text)
-        elif current_state == 'waiting_for_ingredients':
-            handle_ingredients(user, user_id, conversation_id, message_text)
-        elif current_state == 'waiting_for_delivery_date':
-            handle_delivery_date(user, user_id, conversation_id, message_text)
-        elif current_state == 'waiting_for_confirmation':
-            handle_confirmation(user, user_id, conversation_id, message_text)
-        else:
-            # Если состояние не установлено, отвечаем с помощью AI
-            response = generate_response_sync(message_text, {
-                "age": user.age if user else None,
-                "gender": user.gender if user else None
-            })
-            
-            # Сохраняем ответ в чат
-            create_chat_sync({
-                "user_id": user.id,
-                "platform": "avito",
-                "message": message_text,
-                "response": response,
-                "ai_model": "gpt-4o-mini"
-            })
-            
-            # Отправляем ответ пользователю
-            send_message_to_avito(conversation_id, response)
-    
-    except Exception as e:
-        logger.error(f"Ошибка в handle_message: {e}")
-        send_message_to_avito(message_data.get('conversation_id', ''), "Произошла ошибка. Пожалуйста, попробуйте позже.")
+    for conversation_id in conversations:
+        try:
+            await client.mark_read(conversation_id)
+        except Exception as e:
+            logger.warning(f"Не удалось отметить диалог Avito {conversation_id} прочитанным: {e}")
+    return accepted
 
-def handle_description(user, user_id, conversation_id, message_text):
-    """Обработка описания торта"""
-    try:
-        # Анализируем описание заказа
-        order_info = analyze_order_description_sync(message_text)
-        
-        # Сохраняем информацию в состоянии
-        user_states[user_id] = {
-            'description': message_text,
-            'weight': order_info.get('weight'),
-            'ingredients': order_info.get('ingredients'),
-            'delivery_date': order_info.get('delivery_date')
-        }
-        
-        # Генерируем ответ от AI
-        response = generate_response_sync(message_text, {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем ответ в чат
-        create_chat_sync({
-            "user_id": user.id,
-            "platform": "avito",
-            "message": message_text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        send_message_to_avito(conversation_id, response)
-        
-        # Запрашиваем вес
-        send_message_to_avito(conversation_id, "Теперь укажите вес торта в килограммах:")
-        
-        # Обновляем состояние
-        user_states[user_id] = 'waiting_for_weight'
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_description: {e}")
-        send_message_to_avito(conversation_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
 
-def handle_weight(user, user_id, conversation_id, message_text):
-    """Обработка веса торта"""
-    try:
-        # Пробуем распознать вес из сообщения
-        weight = None
+async def process_avito_messages():
+    """Периодический опрос новых сообщений Avito"""
+    while True:
         try:
-            weight = float(message_text.replace(',', '.'))
-        except ValueError:
-            # Если не число, пробуем извлечь из текста с помощью AI
-            response = generate_response_sync(f"Извлеки вес торта из сообщения: {message_text}", {"gender": user.gender if user else None})
-            # Пробуем найти число в ответе AI
-            import re
-            numbers = re.findall(r'\d+\.?\d*', response)
-            if numbers:
-                weight = float(numbers[0])
-        
-        # Обновляем данные состояния
-        state_data = user_states[user_id]
-        if isinstance(state_data, dict):
-            state_data['weight'] = weight
-        else:
-            state_data = {'weight': weight}
-        
-        user_states[user_id] = state_data
-        
-        # Генерируем ответ от AI
-        response = generate_response_sync(f"Вес торта: {weight} кг. Какие ингредиенты или начинку вы бы хотели?", {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        create_chat_sync({
-            "user_id": user.id,
-            "platform": "avito",
-            "message": message_text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        send_message_to_avito(conversation_id, response)
-        
-        # Запрашиваем ингредиенты
-        user_states[user_id] = 'waiting_for_ingredients'
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_weight: {e}")
-        send_message_to_avito(conversation_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+            await poll_avito_messages()
 
-def handle_ingredients(user, user_id, conversation_id, message_text):
-    """Обработка ингредиентов/начинки"""
-    try:
-        # Обновляем данные состояния
-        state_data = user_states[user_id]
-        if isinstance(state_data, dict):
-            state_data['ingredients'] = message_text
-        else:
-            state_data = {'ingredients': message_text}
-        
-        user_states[user_id] = state_data
-        
-        # Генерируем ответ от AI
-        response = generate_response_sync(f"Ингредиенты: {message_text}. Когда вам нужна доставка торта?", {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        create_chat_sync({
-            "user_id": user.id,
-            "platform": "avito",
-            "message": message_text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        send_message_to_avito(conversation_id, response)
-        
-        # Запрашиваем дату доставки
-        user_states[user_id] = 'waiting_for_delivery_date'
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_ingredients: {e}")
-        send_message_to_avito(conversation_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+            # Пауза между запросами (чтобы не превышать лимиты API)
+            await asyncio.sleep(settings.avito_poll_interval)
 
-def handle_delivery_date(user, user_id, conversation_id, message_text):
-    """Обработка даты доставки"""
-    try:
-        # Обновляем данные состояния
-        state_data = user_states[user_id]
-        if isinstance(state_data, dict):
-            state_data['delivery_date'] = message_text
-        else:
-            state_data = {'delivery_date': message_text}
-        
-        user_states[user_id] = state_data
-        
-        # Формируем сообщение с подтверждением
-        confirmation_msg = (
-            f"Вот что мы знаем о вашем заказе:\n\n"
-            f"Описание: {state_data.get('description', 'Не указано')}\n"
-            f"Вес: {state_data.get('weight', 'Не указан')} кг\n"
-            f"Ингредиенты: {state_data.get('ingredients', 'Не указаны')}\n"
-            f"Дата доставки: {state_data.get('delivery_date', 'Не указана')}\n\n"
-            f"Все верно? Отправьте 'Да' для подтверждения или уточните, что-то."
-        )
-        
-        # Генерируем ответ от AI
-        response = generate_response_sync(confirmation_msg, {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        create_chat_sync({
-            "user_id": user.id,
-            "platform": "avito",
-            "message": message_text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем сообщение с подтверждением
-        send_message_to_avito(conversation_id, response)
-        send_message_to_avito(conversation_id, confirmation_msg)
-        
-        # Устанавливаем состояние ожидания подтверждения
-        user_states[user_id] = 'waiting_for_confirmation'
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_delivery_date: {e}")
-        send_message_to_avito(conversation_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка обработки сообщений Avito: {e}")
+            await asyncio.sleep(60)  # Пауза перед повторной попыткой
+
+
+async def enqueue_message(message_data: dict) -> bool:
+    """
+    Постановка сообщения в очередь: сообщения одного диалога обрабатываются по порядку, разных - параллельно
+    :return: False, если сообщение с этим ID уже было принято
+    :raises RuntimeError: бот Avito не инициализирован (setup_avito_bot не выполнен или завершился ошибкой)
+    """
+    if dispatcher is None:
+        raise RuntimeError("Avito бот не инициализирован")
+    message_id = message_data.get('id')
+    if message_id is not None:
+        key = (message_data.get('conversation_id', ''), str(message_id))
+        if seen_messages.get(key) is not None:
+            logger.debug(f"Повторное сообщение Avito {message_id} пропущено")
+            return False
+        seen_messages.set(key, True)
+
+    # Дедлайн ответа отсчитывается от получения, а не от начала обработки
+    received_at = time.monotonic()
+    await dispatcher.submit(
+        message_data.get('conversation_id', ''),
+        lambda: handle_message(message_data, received_at)
+    )
+    return True
+
+
+async def enqueue_webhook_event(data: dict):
+    """
+    Разбор уведомления вебхука Avito Messenger и постановка сообщения в очередь
+    :param data: JSON уведомления
+    :raises ValueError: если уведомление имеет неверный формат
+    :raises RuntimeError: бот Avito не инициализирован
+    """
+    payload = data.get('payload')
+    if not isinstance(payload, dict) or 'type' not in payload:
+        raise ValueError("Некорректное уведомление Avito: нет payload")
+    
+    if payload['type'] != 'message':
+        return
+    
+    value = payload.get('value') or {}
+    if 'chat_id' not in value or 'author_id' not in value:
+        raise ValueError("Некорректное сообщение Avito: нет chat_id или author_id")
+    
+    # Собственные сообщения аккаунта тоже приходят в вебхук - пропускаем их
+    if value['author_id'] == value.get('user_id'):
+        return
+    
+    await enqueue_message({
+        'id': value.get('id'),
+        'user_id': value['author_id'],
+        'text': (value.get('content') or {}).get('text', ''),
+        'conversation_id': value['chat_id']
+    })
 
-def handle_confirmation(user, user_id, conversation_id, message_text):
-    """Обработка подтверждения заказа"""
+
+async def get_new_messages() -> list:
+    """Получение новых сообщений от Avito"""
     try:
-        state_data = user_states[user_id]
-        
-        # Проверяем, подтверждает ли пользователь заказ
-        confirmation_text = message_text.lower()
-        if confirmation_text in ['да', 'ок', 'подтверждаю', 'yes', 'y']:
-            # Создаем заказ в базе данных
-            order_data = {
-                "user_id": user.id,
-                "platform": "avito",
-                "description": state_data.get('description', ''),
-                "weight": state_data.get('weight'),
-                "ingredients": [state_data.get('ingredients')] if state_data.get('ingredients') else [],
-                "delivery_date": state_data.get('delivery_date'),
-                "status": "pending"
-            }
-            
-            order = create_order_sync(order_data)
-            
-            # Генерируем изображение торта
-            image_url = generate_cake_image_sync(
-                state_data.get('description', ''),
-                state_data.get('weight')
-            )
-            
-            if image_url:
-                # В тексте сообщения указываем URL изображения
-                send_message_to_avito(conversation_id, f"Вот как будет выглядеть ваш торт! {image_url}")
-            
-            # Отправляем уведомление кондитеру
-            notify_confectioner_avito(order, image_url)
-            
-            # Удаляем состояние пользователя
-            if user_id in user_states:
-                del user_states[user_id]
-            
-            send_message_to_avito(
-                conversation_id,
-                "Ваш заказ принят! 🎂 Кондитер свяжется с вами в ближайшее время для уточнения деталей. "
-                "Спасибо за заказ!"
-            )
-        else:
-            # Если пользователь не подтверждает, возвращаем к предыдущему шагу
-            send_message_to_avito(conversation_id, "Пожалуйста, уточните, что вы хотели бы изменить в заказе.")
-            user_states[user_id] = 'waiting_for_delivery_date'
-        
+        return await client.get_new_messages()
     except Exception as e:
-        logger.error(f"Ошибка в handle_confirmation: {e}")
-        send_message_to_avito(conversation_id, "Произошла ошибка. Пожалуйста, попробуйте позже.")
+        logger.error(f"Ошибка получения сообщений от Avito: {e}")
+        return []
+
+async def handle_message(message_data, received_at: Optional[float] = None):
+    """Передача сообщения Avito в движок диалога"""
+    await engine.handle(AvitoAdapter(message_data.get('conversation_id', '')), IncomingMessage(
+        platform="avito",
+        platform_user_id=str(message_data.get('user_id', '')),
+        text=message_data.get('text', ''),
+        received_at=received_at or time.monotonic()
+    ))
 
-def send_message_to_avito(conversation_id: str, message: str):
+async def send_message_to_avito(conversation_id: str, message: str):
     """Отправка сообщения пользователю через Avito API"""
     try:
-        headers = get_headers()
-        
-        # URL для отправки сообщения (в реальной реализации нужно использовать правильный endpoint)
-        url = f"https://api.avito.ru/messenger/v1/accounts/conversations/{conversation_id}/messages"
-        
-        data = {
-            'text': message
-        }
-        
-        response = requests.post(url, headers=headers, json=data)
-        response.raise_for_status()
-        
+        await client.send_message(conversation_id, message)
     except Exception as e:
         logger.error(f"Ошибка отправки сообщения в Avito: {e}")
-
-def notify_confectioner_avito(order, image_url: str = None):
-    """Уведомление кондитера о новом заказе из Avito"""
-    try:
-        notification_text = (
-            f"🔔 Новый заказ от Avito!\n\n"
-            f"ID заказа: {order.id}\n"
-            f"Клиент: {order.user_id}\n"
-            f"Описание: {order.description}\n"
-            f"Вес: {order.weight} кг\n"
-            f"Ингредиенты: {', '.join(order.ingredients) if order.ingredients else 'Не указаны'}\n"
-            f"Дата доставки: {order.delivery_date}\n"
-        )
-        
-        if image_url:
-            notification_text += f"\nИзображение торта: {image_url}"
-        
-        # Отправляем уведомление в чат кондитера через Telegram
-        import requests
-        telegram_url = f"https://api.telegram.org/bot{settings.telegram_bot_token}/sendMessage"
-        data = {
-            'chat_id': settings.telegram_confectioner_chat_id,
-            'text': notification_text
-        }
-        requests.post(telegram_url, data=data)
-            
-    except Exception as e:
-        logger.error(f"Ошибка при уведомлении кондитера из Avito: {e}")
-
-# Синхронные версии асинхронных функций для Avito (в реальной реализации лучше использовать Redis или другой асинхронный подход)
-def get_user_by_platform_id_sync(platform, platform_user_id):
-    """Синхронная версия получения пользователя"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(get_user_by_platform_id(platform, platform_user_id))
-    finally:
-        loop.close()
-
-def create_user_sync(user_data):
-    """Синхронная версия создания пользователя"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(create_user(user_data))
-    finally:
-        loop.close()
-
-def create_order_sync(order_data):
-    """Синхронная версия создания заказа"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(create_order(order_data))
-    finally:
-        loop.close()
-
-def create_chat_sync(chat_data):
-    """Синхронная версия создания чата"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(create_chat(chat_data))
-    finally:
-        loop.close()
-
-def generate_response_sync(message, user_info):
-    """Синхронная версия генерации ответа"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(generate_response(message, user_info))
-    finally:
-        loop.close()
-
-def analyze_order_description_sync(description):
-    """Синхронная версия анализа описания заказа"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(analyze_order_description(description))
-    finally:
-        loop.close()
-
-def generate_cake_image_sync(description, weight=None, photo_analysis=None):
-    """Синхронная версия генерации изображения торта"""
-    import asyncio
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(generate_cake_image(description, weight, photo_analysis))
-    finally:
-        loop.close()
\ No newline at end of file
@@ -1,316 +1,151 @@
-from aiogram import Bot, Dispatcher, types
-from aiogram.filters import Command
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.context import FSMContext
+from aiogram import Bot, Dispatcher, F, types
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import BufferedInputFile
+from ai.image_cache import CakeImage
 from config import settings
-from ai.chat import generate_response, analyze_order_description
-from ai.image_gen import generate_cake_image
-from database.crud import create_user, get_user_by_platform_id, create_order, create_chat
-from typing import Dict
+from core.conversation import IncomingMessage, PlatformAdapter, engine
+from core.dispatcher import KeyedDispatcher
+from core.metrics import metrics
+from database.models import Order
+from typing import AsyncIterator, Optional
+import asyncio
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 bot: Bot = None
 dp: Dispatcher = None
+# Очередь обновлений, пришедших через вебхук
+update_dispatcher: KeyedDispatcher = None
 
-# FSM для управления состоянием заказа
-class OrderState(StatesGroup):
-    waiting_for_description = State()
-    waiting_for_weight = State()
-    waiting_for_ingredients = State()
-    waiting_for_delivery_date = State()
-    waiting_for_confirmation = State()
+class TelegramAdapter(PlatformAdapter):
+    """Отправка ответов в чат Telegram"""
+
+    platform = "telegram"
+    start_commands = frozenset(["/start"])
+    streaming = settings.telegram_stream_replies
+
+    def __init__(self, message: types.Message, edit_interval: float = settings.telegram_stream_edit_interval):
+        self.message = message
+        self.edit_interval = edit_interval
+
+    async def send_text(self, text: str):
+        await self.message.answer(text)
+
+    async def send_stream(self, chunks: AsyncIterator[str]) -> str:
+        """
+        Первая часть ответа отправляется сразу, остальные дописываются правкой сообщения.
+        Правки не чаще раза в edit_interval секунд (ограничение Telegram на правки одного
+        сообщения): части, пришедшие между правками, попадают в одну правку
+        """
+        text, shown, sent, next_edit = "", "", None, 0.0
+        async for chunk in chunks:
+            text += chunk
+            now = time.monotonic()
+            if sent is None:
+                if text.strip():
+                    sent = await self.message.answer(text)
+                    shown, next_edit = text, now + self.edit_interval
+            elif now >= next_edit and text != shown:
+                retry_after = await self._edit(sent, text)
+                next_edit = time.monotonic() + max(self.edit_interval, retry_after or 0)
+                if retry_after is None:
+                    shown = text
+
+        text = text.strip()
+        if sent is not None and text != shown.strip():
+            # Последняя правка обязательна: ждем, если Telegram попросил подождать
+            delay = next_edit - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            retry_after = await self._edit(sent, text)
+            if retry_after is not None:
+                await asyncio.sleep(retry_after)
+                await self._edit(sent, text)
+        return text
+
+    async def _edit(self, sent: types.Message, text: str) -> Optional[float]:
+        """Правка отправленного сообщения; возвращает паузу, которую попросил Telegram"""
+        try:
+            await sent.edit_text(text)
+            metrics.counter("telegram.stream.edits").inc()
+        except TelegramRetryAfter as e:
+            metrics.counter("telegram.stream.retry_after").inc()
+            return e.retry_after
+        except TelegramBadRequest as e:
+            # Например, "message is not modified"
+            logger.warning(f"Не удалось изменить сообщение Telegram: {e}")
+        return None
+
+    async def send_image(self, image: CakeImage, caption: str):
+        await self.message.answer_photo(photo=BufferedInputFile(image.data, image.filename), caption=caption)
+
+    async def notify_confectioner(self, order: Order):
+        await notify_confectioner(order, source="Telegram")
+
+    async def notify_confectioner_image(self, order: Order, image: CakeImage):
+        await send_confectioner_image(order, image)
 
 async def setup_telegram_bot():
     """Инициализация Telegram бота"""
-    global bot, dp
+    global bot, dp, update_dispatcher
     bot = Bot(token=settings.telegram_bot_token)
     dp = Dispatcher()
+    update_dispatcher = KeyedDispatcher("telegram", max_in_flight=settings.telegram_max_concurrency)
     
-    # Регистрация хендлеров
-    dp.message.register(start_command, Command("start"))
-    dp.message.register(handle_description, OrderState.waiting_for_description)
-    dp.message.register(handle_weight, OrderState.waiting_for_weight)
-    dp.message.register(handle_ingredients, OrderState.waiting_for_ingredients)
-    dp.message.register(handle_delivery_date, OrderState.waiting_for_delivery_date)
-    dp.message.register(process_confirmation, OrderState.waiting_for_confirmation)
-    dp.message.register(message_handler, lambda message: True)
+    # Все текстовые сообщения (включая /start) обрабатывает общий движок диалога
+    dp.message.register(message_handler, F.text)
+    
+    if settings.telegram_webhook_url:
+        webhook_url = f"{settings.telegram_webhook_url.rstrip('/')}/webhook/telegram/{settings.telegram_bot_token}"
+        await bot.set_webhook(webhook_url)
+        logger.info("Вебхук Telegram установлен")
     
     logger.info("Telegram бот инициализирован")
 
-async def start_command(message: types.Message, state: FSMContext):
-    """Обработка команды /start"""
-    try:
-        # Проверяем, есть ли пользователь в базе
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        if not user:
-            # Создаем нового пользователя
-            user_data = {
-                "platform": "telegram",
-                "platform_user_id": str(message.from_user.id),
-                "first_name": message.from_user.first_name,
-                "last_name": message.from_user.last_name,
-            }
-            user = await create_user(user_data)
-        
-        # Сохраняем сообщение в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": "/start",
-            "ai_model": "system"
-        })
-        
-        # Отправляем приветственное сообщение
-        welcome_text = (
-            "🎂 Добро пожаловать в кондитерскую AI-помощника!\n\n"
-            "Я помогу вам оформить заказ на торт или десерт. "
-            "Давайте начнем с описания, какой торт вы хотите?"
-        )
-        
-        await message.answer(welcome_text)
-        await state.set_state(OrderState.waiting_for_description)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в start_command: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+async def shutdown_telegram_bot():
+    """Остановка обработки обновлений и закрытие сессии бота"""
+    if update_dispatcher is not None:
+        await update_dispatcher.close()
+    if bot is not None:
+        await bot.session.close()
 
-async def handle_description(message: types.Message, state: FSMContext):
-    """Обработка описания торта"""
+async def enqueue_update(data: dict):
+    """
+    Проверка обновления из вебхука и постановка его в очередь обработки
+    :param data: JSON обновления Telegram
+    :raises ValueError: если обновление не удалось разобрать
+    """
     try:
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        # Сохраняем сообщение в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": message.text,
-            "ai_model": "user"
-        })
-        
-        # Анализируем описание заказа
-        order_info = await analyze_order_description(message.text)
-        
-        # Сохраняем информацию в состоянии
-        await state.update_data(description=message.text, **order_info)
-        
-        # Генерируем ответ от AI
-        response = await generate_response(message.text, {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем ответ в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": message.text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        await message.answer(response)
-        
-        # Запрашиваем вес
-        await message.answer("Теперь укажите вес торта в килограммах:")
-        await state.set_state(OrderState.waiting_for_weight)
-        
+        update = types.Update.model_validate(data, context={"bot": bot})
     except Exception as e:
-        logger.error(f"Ошибка в handle_description: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
-
-async def handle_weight(message: types.Message, state: FSMContext):
-    """Обработка веса торта"""
-    try:
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        # Пробуем распознать вес из сообщения
-        weight = None
-        try:
-            weight = float(message.text.replace(',', '.'))
-        except ValueError:
-            # Если не число, пробуем извлечь из текста с помощью AI
-            response = await generate_response(f"Извлеки вес торта из сообщения: {message.text}", {"gender": user.gender if user else None})
-            # Пробуем найти число в ответе AI
-            import re
-            numbers = re.findall(r'\d+\.?\d*', response)
-            if numbers:
-                weight = float(numbers[0])
-        
-        # Обновляем данные состояния
-        await state.update_data(weight=weight)
-        
-        # Генерируем ответ от AI
-        response = await generate_response(f"Вес торта: {weight} кг. Какие ингредиенты или начинку вы бы хотели?", {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": message.text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        await message.answer(response)
-        
-        # Запрашиваем ингредиенты
-        await state.set_state(OrderState.waiting_for_ingredients)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_weight: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
-
-async def handle_ingredients(message: types.Message, state: FSMContext):
-    """Обработка ингредиентов/начинки"""
-    try:
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        # Обновляем данные состояния
-        await state.update_data(ingredients=message.text)
-        
-        # Генерируем ответ от AI
-        response = await generate_response(f"Ингредиенты: {message.text}. Когда вам нужна доставка торта?", {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": message.text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем ответ пользователю
-        await message.answer(response)
-        
-        # Запрашиваем дату доставки
-        await state.set_state(OrderState.waiting_for_delivery_date)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_ingredients: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
-
-async def handle_delivery_date(message: types.Message, state: FSMContext):
-    """Обработка даты доставки"""
-    try:
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        # Обновляем данные состояния
-        await state.update_data(delivery_date=message.text)
-        
-        # Получаем все данные заказа
-        data = await state.get_data()
-        
-        # Формируем сообщение с подтверждением
-        confirmation_msg = (
-            f"Вот что мы знаем о вашем заказе:\n\n"
-            f"Описание: {data.get('description', 'Не указано')}\n"
-            f"Вес: {data.get('weight', 'Не указан')} кг\n"
-            f"Ингредиенты: {data.get('ingredients', 'Не указаны')}\n"
-            f"Дата доставки: {data.get('delivery_date', 'Не указана')}\n\n"
-            f"Все верно? Отправьте 'Да' для подтверждения или уточните, что-то."
-        )
-        
-        # Генерируем ответ от AI
-        response = await generate_response(confirmation_msg, {
-            "age": user.age if user else None,
-            "gender": user.gender if user else None
-        })
-        
-        # Сохраняем сообщение и ответ в чат
-        await create_chat({
-            "user_id": user.id,
-            "platform": "telegram",
-            "message": message.text,
-            "response": response,
-            "ai_model": "gpt-4o-mini"
-        })
-        
-        # Отправляем сообщение с подтверждением
-        await message.answer(response)
-        await message.answer(confirmation_msg)
-        
-        # Устанавливаем состояние ожидания подтверждения
-        await state.set_state(OrderState.waiting_for_confirmation)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в handle_delivery_date: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+        raise ValueError(f"Некорректное обновление Telegram: {e}")
+    
+    # Обновления одного чата обрабатываются по порядку; дедлайн ответа - от получения обновления
+    message = update.message or update.edited_message
+    key = message.chat.id if message else update.update_id
+    received_at = time.monotonic()
+    await update_dispatcher.submit(key, lambda: dp.feed_update(bot, update, received_at=received_at))
 
-async def process_confirmation(message: types.Message, state: FSMContext):
-    """Обработка подтверждения заказа"""
-    try:
-        user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-        
-        # Получаем все данные заказа
-        data = await state.get_data()
-        
-        # Проверяем, подтверждает ли пользователь заказ
-        confirmation_text = message.text.lower()
-        if confirmation_text in ['да', 'ок', 'подтверждаю', 'yes', 'y']:
-            # Создаем заказ в базе данных
-            order_data = {
-                "user_id": user.id,
-                "platform": "telegram",
-                "description": data.get('description', ''),
-                "weight": data.get('weight'),
-                "ingredients": [data.get('ingredients')] if data.get('ingredients') else [],
-                "delivery_date": data.get('delivery_date'),
-                "status": "pending"
-            }
-            
-            order = await create_order(order_data)
-            
-            # Генерируем изображение торта
-            image_url = await generate_cake_image(
-                data.get('description', ''),
-                data.get('weight'),
-                data.get('photo_analysis')  # если было загружено фото
-            )
-            
-            if image_url:
-                # Обновляем заказ с URL изображения
-                order_data["image_url"] = image_url
-                await create_order(order_data)  # в реальности нужно использовать update_order
-                
-                # Отправляем изображение пользователю
-                await message.answer_photo(photo=image_url, caption="Вот как будет выглядеть ваш торт!")
-            
-            # Отправляем уведомление кондитеру
-            await notify_confectioner(order, image_url)
-            
-            # Завершаем FSM
-            await state.clear()
-            
-            await message.answer(
-                "Ваш заказ принят! 🎂 Кондитер свяжется с вами в ближайшее время для уточнения деталей. "
-                "Спасибо за заказ!"
-            )
-        else:
-            # Если пользователь не подтверждает, возвращаем к предыдущему шагу
-            await message.answer("Пожалуйста, уточните, что вы хотели бы изменить в заказе.")
-            await state.set_state(OrderState.waiting_for_delivery_date)
-        
-    except Exception as e:
-        logger.error(f"Ошибка в process_confirmation: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
+async def message_handler(message: types.Message, received_at: Optional[float] = None):
+    """Передача сообщения в движок диалога (received_at передается из enqueue_update)"""
+    await engine.handle(TelegramAdapter(message), IncomingMessage(
+        platform="telegram",
+        platform_user_id=str(message.from_user.id),
+        text=message.text,
+        profile={
+            "first_name": message.from_user.first_name,
+            "last_name": message.from_user.last_name,
+        },
+        received_at=received_at or time.monotonic()
+    ))
 
-async def notify_confectioner(order, image_url: str = None):
-    """Уведомление кондитера о новом заказе"""
+async def notify_confectioner(order: Order, source: str = "Telegram"):
+    """Уведомление кондитера о новом заказе (используется всеми платформами)"""
     try:
         notification_text = (
-            f"🔔 Новый заказ от Telegram!\n\n"
+            f"🔔 Новый заказ от {source}!\n\n"
             f"ID заказа: {order.id}\n"
             f"Клиент: {order.user_id}\n"
             f"Описание: {order.description}\n"
@@ -318,49 +153,16 @@ async def notify_confectioner(order, image_url: str = None):
             f"Ингредиенты: {', '.join(order.ingredients) if order.ingredients else 'Не указаны'}\n"
             f"Дата доставки: {order.delivery_date}\n"
         )
-        
-        if image_url:
-            await bot.send_photo(chat_id=settings.telegram_confectioner_chat_id, photo=image_url, caption=notification_text)
-        else:
-            await bot.send_message(chat_id=settings.telegram_confectioner_chat_id, text=notification_text)
-            
+        await bot.send_message(chat_id=settings.telegram_confectioner_chat_id, text=notification_text)
     except Exception as e:
         logger.error(f"Ошибка при уведомлении кондитера: {e}")
 
-async def message_handler(message: types.Message, state: FSMContext):
-    """Обработка обычных сообщений (вне FSM)"""
+async def send_confectioner_image(order: Order, image: CakeImage):
+    """Изображение торта кондитеру отдельным сообщением после уведомления о заказе"""
     try:
-        current_state = await state.get_state()
-        if current_state is None:
-            # Если состояние не установлено, отвечаем с помощью AI
-            user = await get_user_by_platform_id("telegram", str(message.from_user.id))
-            
-            # Сохраняем сообщение в чат
-            await create_chat({
-                "user_id": user.id,
-                "platform": "telegram",
-                "message": message.text,
-                "ai_model": "user"
-            })
-            
-            # Генерируем ответ от AI
-            response = await generate_response(message.text, {
-                "age": user.age if user else None,
-                "gender": user.gender if user else None
-            })
-            
-            # Сохраняем ответ в чат
-            await create_chat({
-                "user_id": user.id,
-                "platform": "telegram",
-                "message": message.text,
-                "response": response,
-                "ai_model": "gpt-4o-mini"
-            })
-            
-            # Отправляем ответ пользователю
-            await message.answer(response)
-    
+        # Отправляются байты из кэша: ссылка OpenAI к этому моменту может истечь
+        photo = BufferedInputFile(image.data, image.filename)
+        await bot.send_photo(chat_id=settings.telegram_confectioner_chat_id, photo=photo,
+                             caption=f"🖼 Изображение к заказу {order.id}")
     except Exception as e:
-        logger.error(f"Ошибка в message_handler: {e}")
-        await message.answer("Произошла ошибка. Пожалуйста, попробуйте позже.")
\ No newline at end of file
+        logger.error(f"Ошибка при отправке изображения кондитеру: {e}")
@@ -7,31 +7,108 @@ class Settings(BaseSettings):
     telegram_bot_token: str
     telegram_webhook_url: Optional[str] = None
     telegram_confectioner_chat_id: str
+    telegram_max_concurrency: int = 16  # одновременно обрабатываемых обновлений из вебхука
+    telegram_stream_replies: bool = True  # показывать ответ AI по мере генерации правкой сообщения
+    telegram_stream_edit_interval: float = 1.0  # секунд между правками одного сообщения
 
     # VK
     vk_group_id: str
     vk_access_token: str
     vk_confirmation_token: str
     vk_secret_key: str
+    vk_max_concurrency: int = 8  # одновременно обрабатываемых сообщений
+    vk_max_pending: int = 1000  # максимальная глубина очереди сообщений
+    vk_use_callback_api: bool = False  # получать сообщения через /webhook/vk вместо long poll
 
     # Avito
     avito_client_id: str
     avito_client_secret: str
     avito_access_token: str
     avito_refresh_token: str
+    avito_poll_interval: int = 30  # секунд между опросами сообщений
+    avito_max_concurrency: int = 8  # одновременно обрабатываемых диалогов
+    avito_http_pool_size: int = 20  # соединений в пуле aiohttp
+    avito_use_webhook: bool = False  # получать сообщения через /webhook/avito/<секрет> вместо опроса
+    avito_webhook_secret: Optional[str] = None  # секрет в адресе вебхука Avito; без него вебхук отклоняется
+    avito_seen_messages: int = 10000  # ID принятых сообщений в памяти (защита от повторной обработки)
+    avito_seen_ttl: int = 24 * 3600  # секунд хранения ID принятого сообщения
 
     # OpenAI
     openai_api_key: str
     openai_org_id: Optional[str] = None
+    openai_chat_rpm: int = 500  # запросов в минуту к gpt-4o-mini по тарифу (0 - без ограничения)
+    openai_chat_tpm: int = 200000  # токенов в минуту к gpt-4o-mini
+    openai_image_rpm: int = 5  # изображений в минуту DALL-E 3
+    openai_initial_concurrency: int = 8  # одновременных запросов к модели при старте
+    openai_min_concurrency: int = 1  # пределы адаптивного лимита одновременных запросов
+    openai_max_concurrency: int = 32
+    openai_max_retries: int = 4  # повторов при 429, 5xx и обрыве соединения
+    openai_retry_base_delay: float = 0.5  # секунд до первого повтора, далее вдвое больше
+    openai_retry_max_delay: float = 20.0
+    image_max_concurrency: int = 4  # одновременных фоновых генераций изображений
+    image_max_pending: int = 100  # заказов в очереди на генерацию изображения
+    image_shutdown_timeout: float = 30.0  # секунд ожидания генераций при остановке
+    response_cache_size: int = 2000  # ответов на частые вопросы в кэше
+    response_cache_ttl: int = 3600  # секунд хранения ответа
+    response_cache_similarity: float = 0.0  # порог похожести вопросов (0 - только точное совпадение)
+    image_cache_dir: str = "data/images"  # каталог кэша сгенерированных изображений
+    image_cache_max_mb: int = 500  # максимальный размер кэша изображений
+    image_cache_ttl: int = 30 * 24 * 3600  # секунд хранения изображения в кэше
+    extraction_min_confidence: float = 0.6  # уверенность локального извлечения, ниже - уточнение у модели
+    extraction_llm_fallback: bool = True  # уточнять недостающие параметры заказа у модели
+    lexicon_path: Optional[str] = None  # JSON-словарь ингредиентов и декора (по умолчанию core/lexicon.json)
+    lexicon_reload_interval: float = 5.0  # секунд между проверками изменения файла словаря
+    context_max_turns: int = 10  # последних обменов репликами в памяти на пользователя
+    context_token_budget: int = 1000  # токенов истории диалога в запросе к модели
+    context_max_age: int = 3600  # секунд: более старые реплики в историю не попадают
+    context_max_users: int = 10000  # пользователей с историей в памяти
+    prompt_version: str = "v1"  # версия системного промпта (ai/prompts.py)
+    prompt_ab_version: Optional[str] = None  # версия для A/B-теста
+    prompt_ab_share: float = 0.0  # доля клиентов с версией prompt_ab_version
+    llm_providers: str = "openai,backup,local"  # провайдеры чата по приоритету (ai/router.py): openai, backup, local
+    llm_backup_model: str = "gpt-3.5-turbo"  # резервная модель (провайдер backup)
+    llm_backup_api_base: Optional[str] = None  # OpenAI-совместимый API резервной модели (пусто - OpenAI)
+    llm_backup_api_key: Optional[str] = None
+    llm_ewma_alpha: float = 0.2  # вес нового замера в EWMA задержки и доли ошибок провайдера
+    llm_hedge: bool = True  # дублировать медленный запрос следующему провайдеру
+    llm_hedge_percentile: float = 95  # перцентиль задержки провайдера - дедлайн до дубля
+    llm_hedge_min_delay: float = 1.0  # секунд: дубль не раньше
+    llm_hedge_default_delay: float = 5.0  # секунд до дубля, пока у провайдера мало замеров
+    llm_hedge_min_samples: int = 20  # замеров задержки для расчета перцентиля
+    llm_breaker_failures: int = 5  # ошибок подряд до отключения провайдера
+    llm_breaker_cooldown: float = 30.0  # секунд отключения до пробного запроса
+    ai_reply_deadline: float = 20.0  # секунд от получения сообщения на ответ модели, дальше - шаблонный ответ
+    image_generation_timeout: float = 120.0  # секунд на генерацию изображения DALL-E
 
     # Supabase
     supabase_url: str
     supabase_key: str
+    db_executor_workers: int = 10  # потоков для синхронных запросов к Supabase
 
     # Database
     database_url: str
+    db_backend: str = "supabase"  # supabase (HTTP API) или postgres (asyncpg по DATABASE_URL)
+    db_pool_min_size: int = 2  # соединений в пуле asyncpg
+    db_pool_max_size: int = 10
+    chat_log_batch_size: int = 200  # сообщений в одной пакетной вставке в chats
+    chat_log_flush_interval: float = 1.0  # секунд между записями истории
+    chat_log_max_pending: int = 10000  # сообщений в буфере, после - ожидание записи
+    chat_log_flush_max_retries: int = 5  # неудачных записей пакета подряд, после - запись по одному с отбрасыванием
+    user_cache_size: int = 10000  # пользователей в кэше get_user_by_platform_id
+    user_cache_ttl: int = 300  # секунд хранения найденного пользователя
+    user_cache_negative_ttl: int = 10  # секунд хранения результата "не найден"
+
+    # Redis (хранилище состояний диалогов при FSM_STORAGE=redis)
+    redis_url: Optional[str] = None
+    fsm_state_ttl: int = 3600  # секунд без активности до сброса диалога
+    fsm_storage: Optional[str] = None  # memory (по умолчанию), redis или database (таблица fsm_sessions)
+    fsm_flush_interval: float = 5.0  # секунд между пакетными записями в fsm_sessions
+    fsm_flush_batch_size: int = 500  # сессий в одном upsert
+    fsm_flush_max_retries: int = 5  # неудачных записей подряд, после которых сессия не сохраняется
 
     # Application
+    public_base_url: Optional[str] = None  # внешний адрес приложения для ссылок /images/...
+    timezone: str = "Europe/Moscow"  # часовой пояс кондитерской для дат "завтра", "на субботу"
     app_host: str = "0.0.0.0"
     app_port: int = 8000
     debug: bool = False
@@ -0,0 +1,111 @@
+"""
+Мост для вызова асинхронного кода из потоков ботов (long poll VK)
+Вместо создания нового event loop на каждый вызов все корутины выполняются
+в одном долгоживущем цикле, поэтому пулы соединений OpenAI и Supabase
+переиспользуются между сообщениями. В приложении мост подключается к event loop
+uvicorn (attach), без него запускает собственный цикл в фоновом потоке
+"""
+import asyncio
+import concurrent.futures
+import threading
+import logging
+from typing import Any, Coroutine, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncBridge:
+    """Event loop, в который синхронный код из других потоков отправляет корутины"""
+
+    def __init__(self, name: str = "async-bridge"):
+        self.name = name
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._attached = False
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        if self._attached:
+            return self._loop.is_running()
+        return self._thread is not None and self._thread.is_alive()
+
+    def attach(self, loop: asyncio.AbstractEventLoop):
+        """Использование уже работающего цикла (например, цикла приложения) вместо собственного"""
+        with self._lock:
+            if self._thread is not None:
+                raise RuntimeError("Мост уже запустил собственный цикл")
+            self._loop = loop
+            self._attached = True
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        """Запуск фонового цикла (повторный вызов возвращает уже запущенный цикл)"""
+        with self._lock:
+            if self._attached or self.running:
+                return self._loop
+
+            loop = asyncio.new_event_loop()
+            ready = threading.Event()
+
+            def run():
+                asyncio.set_event_loop(loop)
+                loop.call_soon(ready.set)
+                try:
+                    loop.run_forever()
+                finally:
+                    # Отменяем незавершенные задачи и корректно закрываем цикл
+                    pending = asyncio.all_tasks(loop)
+                    for task in pending:
+                        task.cancel()
+                    if pending:
+                        loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+                    loop.run_until_complete(loop.shutdown_asyncgens())
+                    loop.close()
+
+            self._thread = threading.Thread(target=run, name=self.name, daemon=True)
+            self._thread.start()
+            ready.wait()
+            self._loop = loop
+            logger.info(f"Фоновый event loop '{self.name}' запущен")
+            return loop
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """Отправка корутины в фоновый цикл без ожидания результата"""
+        loop = self.start()
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        """
+        Выполнение корутины в фоновом цикле с блокирующим ожиданием результата
+        :param coro: Корутина
+        :param timeout: Максимальное время ожидания в секундах
+        :return: Результат корутины
+        """
+        loop = self.start()
+        try:
+            in_loop_thread = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            in_loop_thread = False
+        if in_loop_thread:
+            coro.close()
+            raise RuntimeError("Нельзя блокирующе ждать корутину из потока самого цикла")
+        return self.submit(coro).result(timeout)
+
+    def stop(self, timeout: float = 5.0):
+        """Остановка фонового цикла (подключенный цикл не останавливается)"""
+        with self._lock:
+            if self._attached:
+                self._loop = None
+                self._attached = False
+                return
+            if not self.running:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout)
+            self._thread = None
+            self._loop = None
+            logger.info(f"Фоновый event loop '{self.name}' остановлен")
+
+
+# Глобальный мост для потока long poll VK
+bridge = AsyncBridge()
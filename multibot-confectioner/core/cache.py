@@ -0,0 +1,121 @@
+"""
+Ограниченный по размеру кэш с временем жизни записей (LRU + TTL)
+Поддерживает кэширование отсутствующих значений (None) с отдельным коротким TTL
+и объединение одновременных загрузок одного ключа в один запрос.
+Метрики (префикс cache.<name>): hits, misses, evictions, size
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+from core.metrics import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Асинхронный read-through кэш"""
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 300,
+                 negative_ttl: Optional[float] = None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        # None не кэшируется, если negative_ttl не задан
+        self.negative_ttl = negative_ttl
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._loading: Dict[Hashable, asyncio.Future] = {}
+
+        prefix = f"cache.{name}"
+        self._hits = metrics.counter(f"{prefix}.hits")
+        self._misses = metrics.counter(f"{prefix}.misses")
+        self._evictions = metrics.counter(f"{prefix}.evictions")
+        self._size = metrics.gauge(f"{prefix}.size")
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Значение из кэша без загрузки (учитывается в hits/misses)"""
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Значение из кэша без учета в hits/misses"""
+        value = self._lookup(key, count=False)
+        return default if value is _MISSING else value
+
+    def _lookup(self, key: Hashable, count: bool = True) -> Any:
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            del self._entries[key]
+            self._size.set(len(self._entries))
+            entry = None
+        if entry is None:
+            if count:
+                self._misses.inc()
+            return _MISSING
+        self._entries.move_to_end(key)
+        if count:
+            self._hits.inc()
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        """Сохранение значения; None сохраняется только при заданном negative_ttl"""
+        if ttl is None:
+            ttl = self.ttl if value is not None else self.negative_ttl
+        if ttl is None:
+            self.invalidate(key)
+            return
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self._evictions.inc()
+        self._size.set(len(self._entries))
+
+    def invalidate(self, key: Hashable):
+        if self._entries.pop(key, None) is not None:
+            self._size.set(len(self._entries))
+
+    def clear(self):
+        self._entries.clear()
+        self._size.set(0)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Получение значения из кэша или загрузка через loader
+        Одновременные запросы одного ключа ждут одну загрузку
+        """
+        value = self._lookup(key)
+        if value is not _MISSING:
+            return value
+
+        pending = self._loading.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._loading[key] = future
+        try:
+            value = await loader()
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже передано ожидающим, не оставляем его "не полученным"
+            future.exception()
+            raise
+        else:
+            self.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            del self._loading[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": len(self._entries),
+            "hits": self._hits.value,
+            "misses": self._misses.value,
+            "evictions": self._evictions.value,
+        }
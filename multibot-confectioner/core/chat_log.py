@@ -0,0 +1,153 @@
+"""
+Отложенная запись истории сообщений в таблицу chats
+Записи копятся в памяти и сохраняются пакетной вставкой, когда набирается
+batch_size записей или проходит flush_interval секунд, поэтому ответ клиенту
+не ждет базу. Если база не успевает, write ждет, пока в буфере освободится
+место (не больше max_pending записей). При остановке буфер сохраняется целиком.
+Пакет, который не удалось записать max_retries раз подряд, записывается по одному
+сообщению: сообщения, которые база не принимает (например, пользователь удален),
+отбрасываются с записью в лог и не задерживают остальные
+
+Метрики (префикс chat_log): pending, written, errors, dropped, batch_size, flush_seconds
+"""
+import asyncio
+import time
+from datetime import datetime, timezone
+from typing import List, Optional
+import logging
+
+from config import settings
+from core.metrics import metrics
+from database import crud
+from database.models import Chat
+
+logger = logging.getLogger(__name__)
+
+
+class ChatLogWriter:
+    """Буфер сообщений с пакетной записью в фоне"""
+
+    def __init__(self, batch_size: int = 200, flush_interval: float = 1.0, max_pending: int = 10000,
+                 max_retries: int = 5):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self._failures = 0  # неудачные попытки записи первого пакета буфера подряд
+        self._buffer: List[Chat] = []
+        self._pending = 0  # записи в буфере и в выполняющейся вставке
+        self._not_full = asyncio.Condition()
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+        self._pending_gauge = metrics.gauge("chat_log.pending")
+        self._written = metrics.counter("chat_log.written")
+        self._errors = metrics.counter("chat_log.errors")
+        self._dropped = metrics.counter("chat_log.dropped")
+        self._batch_size = metrics.histogram("chat_log.batch_size")
+        self._flush_seconds = metrics.histogram("chat_log.flush_seconds")
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    async def write(self, chat: Chat):
+        """Постановка сообщения в очередь записи"""
+        if chat.timestamp is None:
+            # Время фиксируется при получении, а не при фактической вставке
+            chat.timestamp = datetime.now(timezone.utc)
+        async with self._not_full:
+            await self._not_full.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+        self._buffer.append(chat)
+        self._pending_gauge.set(self._pending)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(), name="chat-log-flush")
+        if len(self._buffer) >= self.batch_size:
+            self._wakeup.set()
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        """Запись всего буфера пакетами по batch_size"""
+        async with self._flush_lock:
+            while self._buffer:
+                batch = self._buffer[:self.batch_size]
+                del self._buffer[:self.batch_size]
+                started = time.monotonic()
+                try:
+                    await crud.create_chats(batch)
+                except asyncio.CancelledError:
+                    self._buffer[:0] = batch
+                    raise
+                except Exception as e:
+                    logger.error(f"Ошибка записи {len(batch)} сообщений в историю: {e}")
+                    self._errors.inc()
+                    self._failures += 1
+                    if self._failures < self.max_retries:
+                        # Вернем пакет в начало буфера, следующая попытка - через flush_interval
+                        self._buffer[:0] = batch
+                        return
+                    self._failures = 0
+                    written = await self._write_one_by_one(batch)
+                else:
+                    self._failures = 0
+                    self._flush_seconds.observe(time.monotonic() - started)
+                    self._batch_size.observe(len(batch))
+                    written = len(batch)
+                self._written.inc(written)
+                async with self._not_full:
+                    self._pending -= len(batch)
+                    self._not_full.notify_all()
+                self._pending_gauge.set(self._pending)
+
+    async def _write_one_by_one(self, batch: List[Chat]) -> int:
+        """Запись пакета по одному сообщению; непринятые базой сообщения отбрасываются"""
+        written = 0
+        for index, chat in enumerate(batch):
+            try:
+                await crud.create_chats([chat])
+                written += 1
+            except asyncio.CancelledError:
+                # Необработанные сообщения возвращаются в буфер, обработанные уже не ждут записи
+                self._buffer[:0] = batch[index:]
+                async with self._not_full:
+                    self._pending -= index
+                    self._not_full.notify_all()
+                self._written.inc(written)
+                raise
+            except Exception as e:
+                logger.error(f"Сообщение пользователя {chat.user_id} не сохранено в историю "
+                             f"после {self.max_retries} попыток: {e}")
+                self._dropped.inc()
+        return written
+
+    async def close(self):
+        """Остановка фоновой записи и сохранение оставшихся сообщений"""
+        # Отмену, пришедшую одновременно с _wakeup, wait_for может проглотить - поэтому еще и флаг
+        self._closing = True
+        if self._task is not None and not self._task.done():
+            self._wakeup.set()
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        await self.flush()
+
+
+# Глобальный буфер истории сообщений
+chat_log = ChatLogWriter(
+    batch_size=settings.chat_log_batch_size,
+    flush_interval=settings.chat_log_flush_interval,
+    max_pending=settings.chat_log_max_pending,
+    max_retries=settings.chat_log_flush_max_retries
+)
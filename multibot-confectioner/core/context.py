@@ -0,0 +1,157 @@
+"""
+Контекст диалога для модели: последние реплики клиента и ответы AI
+Реплики хранятся в памяти в кольцевом буфере на пользователя (последние max_turns обменов),
+из таблицы chats они загружаются только для пользователя, которого нет в памяти
+(после перезапуска или вытеснения). В запрос попадают самые новые реплики не старше
+max_age секунд, пока их оценка не превысит token_budget токенов. Оценка - по длине текста,
+без токенизатора. Собранная история кэшируется до следующей реплики пользователя.
+
+Метрики (префикс context): hits - история из памяти, loads - загрузки из chats,
+tokens - оценка токенов истории в запросе, trimmed - реплики, не вошедшие в бюджет
+"""
+import math
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Deque, List, Optional, Tuple
+import logging
+
+from ai.client import CHARS_PER_TOKEN
+from config import settings
+from core.metrics import metrics
+from database import crud
+
+logger = logging.getLogger(__name__)
+
+# Служебные токены сообщения в формате чата (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка числа токенов сообщения по длине текста"""
+    return len(text) // CHARS_PER_TOKEN + MESSAGE_OVERHEAD
+
+
+@dataclass(frozen=True)
+class Turn:
+    """Обмен репликами: сообщение клиента и ответ AI"""
+    message: str
+    response: str
+    at: float  # время ответа, секунды Unix
+
+    @property
+    def tokens(self) -> int:
+        return estimate_tokens(self.message) + estimate_tokens(self.response)
+
+
+class _History:
+    __slots__ = ('turns', 'assembled')
+
+    def __init__(self, max_turns: int):
+        self.turns: Deque[Turn] = deque(maxlen=max_turns)
+        # Собранная история и время, до которого она актуальна
+        self.assembled: Optional[Tuple[float, List[dict]]] = None
+
+
+async def load_turns_from_db(user_id: str, limit: int) -> List[Turn]:
+    """Последние обмены репликами из таблицы chats"""
+    # Входящие сообщения записываются отдельно (без ответа), поэтому строк берется вдвое больше
+    chats = await crud.get_chats_by_user_id(user_id, limit=limit * 2)
+    return [
+        Turn(chat.message, chat.response, chat.timestamp.timestamp() if chat.timestamp else 0.0)
+        for chat in chats if chat.response
+    ][-limit:]
+
+
+class ContextBuilder:
+    """История диалога в пределах бюджета токенов"""
+
+    def __init__(self, max_turns: int = 10, token_budget: int = 1000, max_age: float = 3600,
+                 max_users: int = 10000,
+                 load: Callable[[str, int], Awaitable[List[Turn]]] = load_turns_from_db):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.max_age = max_age
+        self.max_users = max_users
+        self.load = load
+        self._histories: "OrderedDict[str, _History]" = OrderedDict()
+
+        self._hits = metrics.counter("context.hits")
+        self._loads = metrics.counter("context.loads")
+        self._tokens = metrics.histogram("context.tokens")
+        self._trimmed = metrics.counter("context.trimmed")
+
+    async def _history(self, user_id: str) -> _History:
+        history = self._histories.get(user_id)
+        if history is not None:
+            self._histories.move_to_end(user_id)
+            self._hits.inc()
+            return history
+
+        self._loads.inc()
+        history = _History(self.max_turns)
+        try:
+            history.turns.extend(await self.load(user_id, self.max_turns))
+        except Exception as e:
+            # Без истории ответ все равно будет; загрузка повторится со следующим сообщением
+            logger.error(f"Не удалось загрузить историю диалога {user_id}: {e}")
+            return history
+        self._store(user_id, history)
+        return history
+
+    def _store(self, user_id: str, history: _History):
+        self._histories[user_id] = history
+        self._histories.move_to_end(user_id)
+        while len(self._histories) > self.max_users:
+            self._histories.popitem(last=False)
+
+    def _assemble(self, turns: Deque[Turn], now: float) -> Tuple[float, List[dict]]:
+        """Самые новые реплики в пределах бюджета и возраста, от старых к новым"""
+        selected: List[Turn] = []
+        budget = self.token_budget
+        for turn in reversed(turns):
+            if turn.at < now - self.max_age:
+                break
+            if turn.tokens > budget:
+                self._trimmed.inc()
+                break
+            budget -= turn.tokens
+            selected.append(turn)
+
+        messages = []
+        for turn in reversed(selected):
+            messages.append({"role": "user", "content": turn.message})
+            messages.append({"role": "assistant", "content": turn.response})
+        # История актуальна, пока не устарела самая старая вошедшая реплика
+        expires = selected[-1].at + self.max_age if selected else math.inf
+        self._tokens.observe(self.token_budget - budget)
+        return expires, messages
+
+    async def messages(self, user_id: str) -> List[dict]:
+        """
+        История для запроса к модели (сообщения user/assistant, от старых к новым)
+        Список общий для запросов до следующей реплики - изменять его нельзя
+        """
+        history = await self._history(user_id)
+        now = time.time()
+        if history.assembled is None or history.assembled[0] <= now:
+            history.assembled = self._assemble(history.turns, now)
+        return history.assembled[1]
+
+    def append(self, user_id: str, message: str, response: str):
+        """Новый обмен репликами; собранная история пересобирается при следующем запросе"""
+        history = self._histories.get(user_id)
+        if history is None:
+            # История не загружена (ошибка базы) - реплика уже в chats, загрузится вместе с остальными
+            return
+        history.turns.append(Turn(message, response, time.time()))
+        history.assembled = None
+
+
+# Глобальный построитель контекста диалога
+context_builder = ContextBuilder(
+    max_turns=settings.context_max_turns,
+    token_budget=settings.context_token_budget,
+    max_age=settings.context_max_age,
+    max_users=settings.context_max_users
+)
@@ -0,0 +1,427 @@
+"""
+Единый движок диалога оформления заказа для всех платформ
+Шаги диалога: описание -> вес -> ингредиенты -> дата доставки -> подтверждение.
+Платформенные модули (bots/*) только переводят входящие сообщения в IncomingMessage
+и реализуют PlatformAdapter для отправки ответов
+"""
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Tuple
+import asyncio
+import re
+import time
+import logging
+
+from ai.chat import ERROR_RESPONSE, generate_response, generate_response_stream, analyze_order_description
+from ai.image_cache import CakeImage, get_cake_image
+from database.crud import create_user, get_user_by_platform_id, create_order, update_order
+from database.models import User, Order, Chat
+from config import settings
+from core.chat_log import chat_log
+from core.context import ContextBuilder, context_builder
+from core.dates import DATE_FORMAT
+from core.deadline import DeadlineExceeded, deadline_at
+from core.dispatcher import KeyedDispatcher
+from core.extraction import extractor, parse_weight_reply
+from core.fsm import FSM, OrderState, fsm
+from core.metrics import metrics
+from core.utils import extract_date_from_text
+
+logger = logging.getLogger(__name__)
+
+AI_MODEL = "gpt-4o-mini"
+
+WELCOME_TEXT = (
+    "🎂 Добро пожаловать в кондитерскую AI-помощника!\n\n"
+    "Я помогу вам оформить заказ на торт или десерт. "
+    "Давайте начнем с описания, какой торт вы хотите?"
+)
+ASK_WEIGHT_TEXT = "Теперь укажите вес торта в килограммах:"
+ASK_INGREDIENTS_TEXT = "Какие ингредиенты или начинку вы бы хотели?"
+ASK_DELIVERY_DATE_TEXT = "Когда вам нужна доставка торта?"
+ORDER_ACCEPTED_TEXT = (
+    "Ваш заказ принят! 🎂 Кондитер свяжется с вами в ближайшее время для уточнения деталей. "
+    "Спасибо за заказ!"
+)
+ASK_CHANGES_TEXT = "Пожалуйста, уточните, что вы хотели бы изменить в заказе."
+ERROR_TEXT = "Произошла ошибка. Пожалуйста, попробуйте позже."
+IMAGE_CAPTION = "Вот как будет выглядеть ваш торт!"
+DEGRADED_CHAT_TEXT = (
+    "Извините, сейчас не получается быстро ответить на ваш вопрос. "
+    "Пожалуйста, повторите его чуть позже - кондитер тоже увидит ваше сообщение."
+)
+CONFIRM_WORDS = frozenset(['да', 'ок', 'подтверждаю', 'yes', 'y'])
+
+# Время обработки сообщения по шагам диалога
+_STEP_SECONDS = {state: metrics.histogram(f"conversation.step_seconds.{state.value}") for state in OrderState}
+# Вызовы модели, не завершившиеся до дедлайна сообщения, и ответы шаблоном вместо модели
+_STEP_TIMEOUTS = {state: metrics.counter(f"conversation.timeouts.{state.value}") for state in OrderState}
+_STEP_DEGRADED = {state: metrics.counter(f"conversation.degraded.{state.value}") for state in OrderState}
+
+
+@dataclass
+class IncomingMessage:
+    """Входящее сообщение, приведенное к общему виду"""
+    platform: str
+    platform_user_id: str
+    text: str
+    profile: Dict[str, Any] = field(default_factory=dict)  # first_name, last_name и т.п.
+    # time.monotonic() получения сообщения платформой: от него отсчитывается дедлайн ответа,
+    # поэтому время в очереди обработки тоже входит в дедлайн
+    received_at: float = field(default_factory=time.monotonic)
+
+
+class PlatformAdapter:
+    """Адаптер платформы: отправка ответов в конкретный диалог"""
+
+    platform: str = ""
+    welcome_text: str = WELCOME_TEXT
+    # Команды, начинающие новый заказ в любом состоянии диалога
+    start_commands: frozenset = frozenset()
+    # Слова, начинающие новый заказ, если диалог еще не начат
+    start_keywords: Tuple[str, ...] = ()
+    # Ответ AI показывается по мере генерации (send_stream), а не после полного ответа
+    streaming: bool = False
+
+    async def send_text(self, text: str):
+        raise NotImplementedError
+
+    async def send_stream(self, chunks: AsyncIterator[str]) -> str:
+        """Отправка ответа, приходящего по частям (по умолчанию - целиком после последней части)"""
+        text = "".join([chunk async for chunk in chunks]).strip()
+        if text:
+            await self.send_text(text)
+        return text
+
+    async def send_image(self, image: CakeImage, caption: str):
+        """Отправка изображения (по умолчанию - ссылкой в тексте: постоянной или временной ссылкой OpenAI)"""
+        if not image.link:
+            # Изображение из кэша без PUBLIC_BASE_URL: ссылки нет, а файлы платформа не принимает
+            logger.warning(f"Изображение {image.key} не отправлено в {self.platform}: нет ссылки, задайте PUBLIC_BASE_URL")
+            return
+        await self.send_text(f"{caption} {image.link}")
+
+    async def notify_confectioner(self, order: Order):
+        """Уведомление кондитера о новом заказе (сразу после создания заказа)"""
+        raise NotImplementedError
+
+    async def notify_confectioner_image(self, order: Order, image: CakeImage):
+        """Изображение к уже отправленному кондитеру заказу (из фоновой генерации)"""
+        raise NotImplementedError
+
+    def is_start(self, text: str, state: OrderState) -> bool:
+        normalized = text.strip().lower()
+        if normalized in self.start_commands:
+            return True
+        if state in (OrderState.IDLE, OrderState.ORDER_COMPLETED):
+            return any(word in normalized for word in self.start_keywords)
+        return False
+
+
+@dataclass
+class StepContext:
+    """Данные, доступные шагу диалога"""
+    adapter: PlatformAdapter
+    message: IncomingMessage
+    user: User
+    state: OrderState
+    data: Dict[str, Any]
+
+    @property
+    def user_info(self) -> Dict[str, Any]:
+        return {"id": self.user.id, "age": self.user.age, "gender": self.user.gender}
+
+
+def format_confirmation(data: Dict[str, Any]) -> str:
+    """Сообщение с параметрами заказа для подтверждения"""
+    return (
+        f"Вот что мы знаем о вашем заказе:\n\n"
+        f"Описание: {data.get('description') or 'Не указано'}\n"
+        f"Вес: {data.get('weight') or 'Не указан'} кг\n"
+        f"Ингредиенты: {format_ingredients(data.get('ingredients')) or 'Не указаны'}\n"
+        f"Дата доставки: {data.get('delivery_date') or 'Не указана'}\n\n"
+        f"Все верно? Отправьте 'Да' для подтверждения или уточните, что-то."
+    )
+
+
+def format_ingredients(ingredients: Any) -> str:
+    if isinstance(ingredients, (list, tuple)):
+        return ", ".join(str(item) for item in ingredients)
+    return ingredients or ""
+
+
+class ConversationEngine:
+    """Конечный автомат диалога заказа, общий для Telegram, VK и Avito"""
+
+    def __init__(self, state_machine: FSM, image_jobs: Optional[KeyedDispatcher] = None,
+                 context: Optional[ContextBuilder] = None):
+        self.fsm = state_machine
+        # История диалога для запросов к модели
+        self.context = context if context is not None else context_builder
+        # Очередь фоновой генерации изображений заказов
+        self.image_jobs = image_jobs if image_jobs is not None else KeyedDispatcher(
+            "images",
+            max_in_flight=settings.image_max_concurrency,
+            max_pending=settings.image_max_pending
+        )
+
+    async def handle(self, adapter: PlatformAdapter, message: IncomingMessage):
+        """Обработка входящего сообщения"""
+        try:
+            user = await self._get_or_create_user(message)
+
+            # Запись в историю и загрузка состояния независимы
+            _, (state, data) = await asyncio.gather(
+                self._log_chat(user, message.text, ai_model="user"),
+                self.fsm.get_session(user.id, message.platform)
+            )
+            ctx = StepContext(adapter=adapter, message=message, user=user, state=state, data=data)
+
+            if adapter.is_start(message.text, state):
+                await self.start(ctx)
+                return
+
+            # Переход выбирается по заранее построенной таблице за O(1).
+            # Вызовы модели шага ограничены общим дедлайном сообщения
+            started = time.monotonic()
+            with deadline_at(message.received_at + settings.ai_reply_deadline):
+                await _TRANSITIONS[state](self, ctx)
+            _STEP_SECONDS[state].observe(time.monotonic() - started)
+
+        except Exception as e:
+            logger.error(f"Ошибка обработки сообщения {message.platform}: {e}")
+            await adapter.send_text(ERROR_TEXT)
+
+    async def _get_or_create_user(self, message: IncomingMessage) -> User:
+        user = await get_user_by_platform_id(message.platform, message.platform_user_id)
+        if user:
+            return user
+        return await create_user(User(
+            platform=message.platform,
+            platform_user_id=message.platform_user_id,
+            **message.profile
+        ))
+
+    async def _log_chat(self, user: User, message: str, response: Optional[str] = None,
+                        ai_model: str = AI_MODEL):
+        """Запись в историю (сохраняется в базу в фоне, ответ ее не ждет)"""
+        chat_data = {"user_id": user.id, "platform": user.platform, "message": message, "ai_model": ai_model}
+        if response is not None:
+            chat_data["response"] = response
+        await chat_log.write(Chat(**chat_data))
+
+    def _deadline_expired(self, ctx: StepContext, operation: str):
+        logger.warning(f"Дедлайн сообщения истек: {operation} (шаг {ctx.state.value})")
+        _STEP_TIMEOUTS[ctx.state].inc()
+
+    async def _reply_with_ai(self, ctx: StepContext, prompt: str, cache: bool = False,
+                             degraded: Optional[str] = None) -> Optional[str]:
+        """
+        Генерация ответа AI с учетом истории диалога, отправка пользователю и запись в историю
+        :param degraded: Шаблонный ответ, если модель не ответила до дедлайна сообщения
+            (обычно следующий вопрос диалога); None - ничего не отправлять
+        :return: Отправленный ответ
+        """
+        history = await self.context.messages(ctx.user.id)
+        try:
+            if ctx.adapter.streaming:
+                response = await ctx.adapter.send_stream(
+                    generate_response_stream(prompt, ctx.user_info, cache=cache, history=history)
+                )
+            else:
+                response = await generate_response(prompt, ctx.user_info, cache=cache, history=history)
+                await ctx.adapter.send_text(response)
+        except DeadlineExceeded:
+            self._deadline_expired(ctx, "ответ AI")
+            _STEP_DEGRADED[ctx.state].inc()
+            if degraded:
+                await ctx.adapter.send_text(degraded)
+            await self._log_chat(ctx.user, ctx.message.text, degraded, ai_model="template")
+            return degraded
+
+        if response and response != ERROR_RESPONSE:
+            self.context.append(ctx.user.id, ctx.message.text, response)
+        await self._log_chat(ctx.user, ctx.message.text, response)
+        return response
+
+    async def _set_state(self, ctx: StepContext, state: OrderState, data: Optional[Dict[str, Any]] = None):
+        await self.fsm.set_state(ctx.user.id, ctx.message.platform, state, data)
+
+    # Шаги диалога
+
+    async def start(self, ctx: StepContext):
+        """Начало нового заказа"""
+        await self.fsm.reset_state(ctx.user.id, ctx.message.platform)
+        await ctx.adapter.send_text(ctx.adapter.welcome_text)
+        await self._set_state(ctx, OrderState.WAITING_FOR_DESCRIPTION)
+
+    async def free_chat(self, ctx: StepContext):
+        """Сообщение вне оформления заказа - отвечаем с помощью AI (частые вопросы - из кэша)"""
+        await self._reply_with_ai(ctx, ctx.message.text, cache=True, degraded=DEGRADED_CHAT_TEXT)
+
+    async def handle_description(self, ctx: StepContext):
+        """Обработка описания торта"""
+        text = ctx.message.text
+        # Анализ описания и ответ клиенту не зависят друг от друга - выполняем параллельно.
+        # Ошибка анализа не мешает ответу: заказ продолжится с одним описанием.
+        # Без ответа модели до дедлайна диалог продолжается следующим вопросом
+        order_info, _ = await asyncio.gather(
+            self._analyze_description(ctx, text),
+            self._reply_with_ai(ctx, text)
+        )
+        data = {'description': text, **order_info}
+
+        await ctx.adapter.send_text(ASK_WEIGHT_TEXT)
+        await self._set_state(ctx, OrderState.WAITING_FOR_WEIGHT, data)
+
+    async def _analyze_description(self, ctx: StepContext, text: str) -> Dict[str, Any]:
+        """Параметры заказа из описания: регулярные выражения, модель - только за недостающими полями"""
+        try:
+            extraction = await extractor.extract(text, analyze_order_description)
+            return extraction.values
+        except DeadlineExceeded:
+            # Модель не успела - остаются поля, найденные без нее
+            self._deadline_expired(ctx, "анализ описания")
+            _STEP_DEGRADED[ctx.state].inc()
+            return (await extractor.extract(text)).values
+        except Exception as e:
+            logger.error(f"Ошибка анализа описания заказа: {e}")
+            return {}
+
+    async def handle_weight(self, ctx: StepContext):
+        """Обработка веса торта"""
+        text = ctx.message.text
+        # "2", "2,5", "2 кг", "1500 г" разбираются локально; число без единиц внутри фразы
+        # ("на 10 человек", "3 яруса") - не вес, такие ответы разбирает модель
+        weight = parse_weight_reply(text)
+        if weight is None:
+            try:
+                response = await generate_response(f"Извлеки вес торта из сообщения: {text}",
+                                                   {"gender": ctx.user.gender})
+                numbers = re.findall(r'\d+\.?\d*', response)
+                if numbers:
+                    weight = float(numbers[0])
+            except DeadlineExceeded:
+                # Вес уточнит кондитер, а ответ ниже сразу уйдет шаблоном: время сообщения истекло
+                self._deadline_expired(ctx, "извлечение веса")
+
+        question = f"Вес торта: {weight} кг. {ASK_INGREDIENTS_TEXT}"
+        await self._reply_with_ai(ctx, question, degraded=question if weight is not None else ASK_INGREDIENTS_TEXT)
+        await self._set_state(ctx, OrderState.WAITING_FOR_INGREDIENTS, {'weight': weight})
+
+    async def handle_ingredients(self, ctx: StepContext):
+        """Обработка ингредиентов/начинки"""
+        text = ctx.message.text
+        await self._reply_with_ai(ctx, f"Ингредиенты: {text}. {ASK_DELIVERY_DATE_TEXT}", degraded=ASK_DELIVERY_DATE_TEXT)
+        await self._set_state(ctx, OrderState.WAITING_FOR_DELIVERY_DATE, {'ingredients': text})
+
+    async def handle_delivery_date(self, ctx: StepContext):
+        """Обработка даты доставки"""
+        # "Завтра", "на субботу" отсчитываются от момента сообщения, а не подтверждения заказа.
+        # Неразобранный текст сохраняется для подтверждения, но в заказ не попадает
+        delivery_date = extract_date_from_text(ctx.message.text)
+        data = {
+            **ctx.data,
+            'delivery_date': delivery_date.strftime(DATE_FORMAT) if delivery_date else ctx.message.text
+        }
+        confirmation_msg = format_confirmation(data)
+
+        # Параметры заказа клиент сверяет по точному тексту, поэтому подтверждение - одно
+        # сообщение-шаблон без модели; в историю оно попадает как обычный ответ
+        await ctx.adapter.send_text(confirmation_msg)
+        self.context.append(ctx.user.id, ctx.message.text, confirmation_msg)
+        await self._log_chat(ctx.user, ctx.message.text, confirmation_msg, ai_model="template")
+        await self._set_state(ctx, OrderState.WAITING_FOR_CONFIRMATION, data)
+
+    async def handle_confirmation(self, ctx: StepContext):
+        """Обработка подтверждения заказа"""
+        if ctx.message.text.strip().lower() not in CONFIRM_WORDS:
+            # Если пользователь не подтверждает, возвращаем к предыдущему шагу
+            await ctx.adapter.send_text(ASK_CHANGES_TEXT)
+            await self._set_state(ctx, OrderState.WAITING_FOR_DELIVERY_DATE)
+            return
+
+        # Заказ подтверждается сразу, изображение генерируется в фоне (DALL-E отвечает 10-20 с).
+        # Кондитер узнает о заказе тоже сразу: фоновая задача может не дожить до перезапуска
+        order = await create_order(build_order(ctx.user, ctx.data))
+        await self.fsm.reset_state(ctx.user.id, ctx.message.platform)
+        await ctx.adapter.send_text(ORDER_ACCEPTED_TEXT)
+        try:
+            await ctx.adapter.notify_confectioner(order)
+        except Exception as e:
+            logger.error(f"Не удалось уведомить кондитера о заказе {order.id}: {e}")
+
+        adapter, data = ctx.adapter, ctx.data
+        await self.image_jobs.submit(order.id, lambda: self._deliver_image(adapter, order, data))
+
+    async def _deliver_image(self, adapter: PlatformAdapter, order: Order, data: Dict[str, Any]):
+        """Фоновая задача: генерация изображения, сохранение в заказ, отправка клиенту и кондитеру"""
+        image = await self._generate_image(data)
+        if image is None:
+            return
+        if image.link:
+            # В заказ сохраняется постоянная ссылка, а без PUBLIC_BASE_URL - временная ссылка OpenAI
+            order.image_url = image.link
+            try:
+                await update_order(order.id, Order(
+                    user_id=order.user_id,
+                    platform=order.platform,
+                    description=order.description,
+                    image_url=image.link
+                ))
+            except Exception as e:
+                logger.error(f"Не удалось сохранить изображение заказа {order.id}: {e}")
+        try:
+            await adapter.send_image(image, IMAGE_CAPTION)
+        except Exception as e:
+            logger.error(f"Не удалось отправить изображение заказа {order.id}: {e}")
+        try:
+            await adapter.notify_confectioner_image(order, image)
+        except Exception as e:
+            logger.error(f"Не удалось отправить кондитеру изображение заказа {order.id}: {e}")
+
+    async def _generate_image(self, data: Dict[str, Any]) -> Optional[CakeImage]:
+        try:
+            return await get_cake_image(
+                data.get('description', ''),
+                data.get('weight'),
+                data.get('photo_analysis')  # если было загружено фото
+            )
+        except Exception as e:
+            logger.error(f"Ошибка генерации изображения торта: {e}")
+            return None
+
+def build_order(user: User, data: Dict[str, Any]) -> Order:
+    """Создание модели заказа из данных диалога"""
+    ingredients = data.get('ingredients')
+    if isinstance(ingredients, str):
+        ingredients = [ingredients]
+
+    raw_date = data.get('delivery_date')
+    delivery_date = extract_date_from_text(raw_date) if isinstance(raw_date, str) else None
+
+    return Order(
+        user_id=user.id,
+        platform=user.platform,
+        description=data.get('description', ''),
+        weight=data.get('weight'),
+        ingredients=ingredients or [],
+        delivery_date=delivery_date,
+        status="pending"
+    )
+
+
+StepHandler = Callable[[ConversationEngine, StepContext], Awaitable[None]]
+
+# Таблица переходов строится один раз при импорте модуля
+_TRANSITIONS: Dict[OrderState, StepHandler] = {
+    OrderState.IDLE: ConversationEngine.free_chat,
+    OrderState.WAITING_FOR_DESCRIPTION: ConversationEngine.handle_description,
+    OrderState.WAITING_FOR_WEIGHT: ConversationEngine.handle_weight,
+    OrderState.WAITING_FOR_INGREDIENTS: ConversationEngine.handle_ingredients,
+    OrderState.WAITING_FOR_DELIVERY_DATE: ConversationEngine.handle_delivery_date,
+    OrderState.WAITING_FOR_CONFIRMATION: ConversationEngine.handle_confirmation,
+    OrderState.ORDER_COMPLETED: ConversationEngine.free_chat,
+}
+
+# Глобальный движок диалога
+engine = ConversationEngine(fsm)
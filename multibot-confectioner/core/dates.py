@@ -0,0 +1,160 @@
+"""
+Разбор дат доставки на русском языке
+Кроме числовых форматов (20.12.2030, 2030-12-20, 20/12/30) понимает названия месяцев
+("20 декабря", "5 мая 2031"), дни недели ("на субботу", "в следующую пятницу"),
+относительные выражения ("завтра", "послезавтра", "через 3 дня", "через неделю")
+и день месяца ("к 15-му", "на 15 число"). Относительные даты отсчитываются от
+переданного момента now в часовом поясе кондитерской (TIMEZONE).
+
+Таблицы и выражение DATE_PATTERN строятся один раз при импорте; выражение
+встраивается в общее выражение core.utils.extract_order_fields, поэтому дата
+ищется в том же проходе по тексту, что вес и ингредиенты
+"""
+import calendar
+import re
+from datetime import date, datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+import logging
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+TIMEZONE = ZoneInfo(settings.timezone)
+# Формат даты в данных диалога (данные сохраняются в JSON)
+DATE_FORMAT = '%d.%m.%Y'
+
+# Основы и сокращения названий месяцев (текст уже в нижнем регистре, ё заменена на е)
+MONTHS = {
+    'январ': 1, 'янв': 1, 'феврал': 2, 'фев': 2, 'март': 3, 'мар': 3, 'апрел': 4, 'апр': 4,
+    'мая': 5, 'май': 5, 'июн': 6, 'июл': 7, 'август': 8, 'авг': 8, 'сентябр': 9, 'сент': 9, 'сен': 9,
+    'октябр': 10, 'окт': 10, 'ноябр': 11, 'нояб': 11, 'ноя': 11, 'декабр': 12, 'дек': 12,
+}
+# День недели по первым буквам слова (0 - понедельник); выходные - ближайшая суббота
+WEEKDAYS = {
+    'пон': 0, 'вто': 1, 'сре': 2, 'чет': 3, 'пят': 4, 'суб': 5, 'вос': 6, 'вых': 5,
+    'пн': 0, 'вт': 1, 'ср': 2, 'чт': 3, 'пт': 4, 'сб': 5, 'вс': 6,
+}
+RELATIVE_DAYS = {'сегодня': 0, 'завтра': 1, 'послезавтра': 2, 'после завтра': 2}
+NUMBER_WORDS = {
+    'один': 1, 'одну': 1, 'два': 2, 'две': 2, 'три': 3, 'четыре': 4, 'пять': 5,
+    'шесть': 6, 'семь': 7, 'восемь': 8, 'девять': 9, 'десять': 10,
+}
+
+
+def _alternation(words) -> str:
+    """Альтернатива слов, более длинные - раньше ("послезавтра" раньше "завтра")"""
+    return '|'.join(sorted(map(re.escape, words), key=len, reverse=True))
+
+
+_WORD_START = r'(?<![^\W\d_])'
+_WORD_END = r'(?![^\W\d_])'
+
+# Каждая альтернатива - именованная группа date_*, по ней выбирается способ разбора.
+# Порядок важен: полные даты раньше дат без года и раньше веса в core.utils
+DATE_PATTERN = (
+    r'(?P<date_iso>(?P<iso_year>\d{4})-(?P<iso_month>\d{1,2})-(?P<iso_day>\d{1,2})(?!\d))'
+    r'|(?P<date_numeric>(?P<day>\d{1,2})(?P<sep>[./-])(?P<month>\d{1,2})(?P=sep)(?P<year>\d{4}|\d{2})(?!\d))'
+    r'|(?P<date_text>(?P<text_day>\d{1,2})(?:-?(?:го|е|ое))?\s+(?P<month_name>' + _alternation(MONTHS) + r')[а-я]*\.?'
+    r'(?:\s+(?P<text_year>\d{4})(?!\d))?)'
+    r'|(?P<date_dom>(?P<dom_day>\d{1,2})(?:-?(?:го|е|ое|ого|му|ому)' + _WORD_END + r'|\s+числ[а-я]*))'
+    r'|(?P<date_short>(?P<short_day>\d{1,2})\.(?P<short_month>\d{2})(?![\d.,]|\s*(?:кг|kg|г|g)' + _WORD_END + r'))'
+    r'|(?P<date_relative>' + _WORD_START + r'(?:' + _alternation(RELATIVE_DAYS) + r')' + _WORD_END + r')'
+    r'|(?P<date_weekday>' + _WORD_START + r'(?:(?P<weekday_next>следующ[а-я]*)\s+)?'
+    r'(?P<weekday>(?:понедельник|вторник|четверг|пятниц|суббот|воскресен|выходн)[а-я]*'
+    r'|сред[аеуы]' + _WORD_END + r'|(?:пн|вт|ср|чт|пт|сб|вс)' + _WORD_END + r'))'
+    r'|(?P<date_in>' + _WORD_START + r'через\s+(?:(?P<in_count>\d{1,2}|' + _alternation(NUMBER_WORDS) + r')\s+)?'
+    r'(?P<in_unit>день|дн|недел|месяц)[а-я]*)'
+)
+# Символы, с которых может начинаться дата (для опережающей проверки в core.utils)
+DATE_FIRST_CHARS = ''.join(sorted(
+    {word[0] for word in RELATIVE_DAYS} | {word[0] for word in WEEKDAYS} | {'с', 'ч'}  # "следующую", "через"
+))
+
+
+def local_today(now: Optional[datetime] = None) -> date:
+    """Текущая дата в часовом поясе кондитерской; наивное now считается местным временем"""
+    if now is None:
+        return datetime.now(TIMEZONE).date()
+    if now.tzinfo is not None:
+        return now.astimezone(TIMEZONE).date()
+    return now.date()
+
+
+def _to_datetime(year: int, month: int, day: int) -> Optional[datetime]:
+    try:
+        return datetime(year, month, day)
+    except ValueError:
+        return None
+
+
+def _upcoming(today: date, month: int, day: int) -> Optional[datetime]:
+    """Ближайшая дата с этим днем и месяцем не раньше сегодняшней"""
+    for year in (today.year, today.year + 1):
+        result = _to_datetime(year, month, day)
+        if result is not None and result.date() >= today:
+            return result
+    return None
+
+
+def _add_months(today: date, months: int) -> datetime:
+    month_index = today.month - 1 + months
+    year, month = today.year + month_index // 12, month_index % 12 + 1
+    return datetime(year, month, min(today.day, calendar.monthrange(year, month)[1]))
+
+
+def _year(value: str) -> int:
+    # Если год в формате YY, преобразуем в YYYY
+    return int('20' + value) if len(value) == 2 else int(value)
+
+
+def resolve_date(match: "re.Match", now: Optional[datetime] = None) -> Optional[datetime]:
+    """
+    Дата по совпадению с DATE_PATTERN
+    :param match: Совпадение, у которого lastgroup - одна из групп date_*
+    :param now: Момент, от которого отсчитываются относительные даты (по умолчанию - текущий)
+    :return: Дата (полночь, без часового пояса) или None, если такой даты нет (31.02)
+    """
+    kind = match.lastgroup
+    if kind == 'date_iso':
+        return _to_datetime(int(match['iso_year']), int(match['iso_month']), int(match['iso_day']))
+    if kind == 'date_numeric':
+        return _to_datetime(_year(match['year']), int(match['month']), int(match['day']))
+
+    today = local_today(now)
+    if kind == 'date_text':
+        month = MONTHS[match['month_name']]
+        if match['text_year']:
+            return _to_datetime(int(match['text_year']), month, int(match['text_day']))
+        return _upcoming(today, month, int(match['text_day']))
+    if kind == 'date_short':
+        return _upcoming(today, int(match['short_month']), int(match['short_day']))
+    if kind == 'date_dom':
+        # Ближайший месяц, в котором есть такой день и он еще не прошел
+        day = int(match['dom_day'])
+        for months in range(13):
+            first = _add_months(today.replace(day=1), months)
+            result = _to_datetime(first.year, first.month, day)
+            if result is not None and result.date() >= today:
+                return result
+        return None
+    if kind == 'date_relative':
+        return datetime.combine(today + timedelta(days=RELATIVE_DAYS[match['date_relative']]), datetime.min.time())
+    if kind == 'date_weekday':
+        word = match['weekday']
+        weekday = WEEKDAYS.get(word[:3], WEEKDAYS.get(word[:2]))
+        # Ближайший такой день после сегодняшнего; "следующий" - на следующей неделе
+        days = (weekday - today.weekday()) % 7 or 7
+        if match['weekday_next'] and today.weekday() + days <= 6:
+            days += 7
+        return datetime.combine(today + timedelta(days=days), datetime.min.time())
+    if kind == 'date_in':
+        count = match['in_count']
+        count = 1 if count is None else int(count) if count.isdigit() else NUMBER_WORDS[count]
+        unit = match['in_unit']
+        if unit.startswith('месяц'):
+            return _add_months(today, count)
+        days = count * 7 if unit.startswith('недел') else count
+        return datetime.combine(today + timedelta(days=days), datetime.min.time())
+    return None
@@ -0,0 +1,90 @@
+"""
+Дедлайн обработки входящего сообщения
+Движок диалога задает дедлайн от момента получения сообщения (IncomingMessage.received_at),
+а вызовы моделей ограничиваются оставшимся временем (within_deadline). Дедлайн хранится
+в contextvars и переходит в задачи, запущенные из обработчика (asyncio.gather, create_task),
+поэтому все вызовы одного сообщения делят одно время: если первый вызов съел его целиком,
+следующий сразу получает DeadlineExceeded и шаг диалога отвечает шаблоном.
+"""
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Awaitable, Iterator, Optional, TypeVar
+
+T = TypeVar("T")
+
+# Момент time.monotonic(), к которому нужен ответ; None - без ограничения
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Истек дедлайн обработки сообщения"""
+
+
+@contextmanager
+def deadline_at(at: Optional[float], inherit: bool = True) -> Iterator[None]:
+    """
+    Дедлайн для вызовов внутри блока
+    :param at: Момент time.monotonic(); None - без ограничения
+    :param inherit: Учитывать внешний дедлайн (берется более ранний); False - для фоновых
+        задач, которые не должны зависеть от дедлайна сообщения, запустившего их
+    """
+    current = _deadline.get() if inherit else None
+    if current is not None and at is not None:
+        at = min(at, current)
+    elif at is None:
+        at = current
+    token = _deadline.set(at)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def deadline_after(seconds: float, inherit: bool = True):
+    """Дедлайн через seconds секунд (см. deadline_at)"""
+    return deadline_at(time.monotonic() + seconds, inherit=inherit)
+
+
+def remaining() -> Optional[float]:
+    """Секунд до дедлайна (отрицательное - уже истек); None - дедлайна нет"""
+    at = _deadline.get()
+    return None if at is None else at - time.monotonic()
+
+
+async def within_deadline(awaitable: Awaitable[T]) -> T:
+    """
+    Ожидание с ограничением оставшимся временем; по истечении вызов отменяется
+    :raises DeadlineExceeded: дедлайн истек до завершения (или до начала) вызова
+    """
+    left = remaining()
+    if left is None:
+        return await awaitable
+    if left <= 0:
+        if asyncio.iscoroutine(awaitable):
+            awaitable.close()
+        raise DeadlineExceeded("Дедлайн истек до вызова")
+    try:
+        return await asyncio.wait_for(awaitable, left)
+    except asyncio.TimeoutError:
+        if remaining() > 0:
+            # Таймаут самого вызова, а не дедлайна
+            raise
+        raise DeadlineExceeded(f"Вызов не завершился за {left:.1f} с") from None
+
+
+async def stream_within_deadline(chunks: AsyncIterator[T]) -> AsyncIterator[T]:
+    """Фрагменты потока, пока не истек дедлайн; по истечении поток закрывается"""
+    iterator = chunks.__aiter__()
+    try:
+        while True:
+            try:
+                chunk = await within_deadline(iterator.__anext__())
+            except StopAsyncIteration:
+                return
+            yield chunk
+    finally:
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
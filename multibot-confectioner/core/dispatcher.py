@@ -0,0 +1,109 @@
+"""
+Диспетчер входящих сообщений
+Сообщения с одинаковым ключом (диалог, peer_id) обрабатываются строго по порядку,
+сообщения разных диалогов - параллельно, но не больше max_in_flight одновременно
+
+Метрики (префикс dispatcher.<name>): queue_depth, in_flight, active_keys,
+processed, errors и wait_seconds - время от постановки в очередь до запуска
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Set, Tuple
+import logging
+from core.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+JobFactory = Callable[[], Awaitable[Any]]
+
+
+class KeyedDispatcher:
+    """Асинхронный пул обработчиков с сохранением порядка внутри ключа"""
+
+    def __init__(self, name: str, max_in_flight: int = 8, max_pending: int = 1000):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self.max_pending = max_pending
+        self._queues: Dict[Hashable, Deque[Tuple[JobFactory, float]]] = {}
+        self._tasks: Set[asyncio.Task] = set()
+        self._semaphore = asyncio.Semaphore(max_in_flight)
+        self._not_full = asyncio.Condition()
+        self._pending = 0
+
+        prefix = f"dispatcher.{name}"
+        self._queue_depth = metrics.gauge(f"{prefix}.queue_depth")
+        self._in_flight = metrics.gauge(f"{prefix}.in_flight")
+        self._active_keys = metrics.gauge(f"{prefix}.active_keys")
+        self._processed = metrics.counter(f"{prefix}.processed")
+        self._errors = metrics.counter(f"{prefix}.errors")
+        self._wait_seconds = metrics.histogram(f"{prefix}.wait_seconds")
+
+    @property
+    def pending(self) -> int:
+        """Количество сообщений, ожидающих обработки или обрабатываемых"""
+        return self._pending
+
+    async def submit(self, key: Hashable, job: JobFactory):
+        """
+        Постановка задачи в очередь ключа
+        :param key: Ключ упорядочивания (например, ID диалога)
+        :param job: Фабрика корутины обработчика
+        """
+        async with self._not_full:
+            # Backpressure: не принимаем больше max_pending задач
+            await self._not_full.wait_for(lambda: self._pending < self.max_pending)
+            self._pending += 1
+        self._queue_depth.inc()
+
+        item = (job, time.monotonic())
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(item)
+            return
+
+        self._queues[key] = deque([item])
+        self._active_keys.set(len(self._queues))
+        task = asyncio.create_task(self._drain(key), name=f"{self.name}:{key}")
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _drain(self, key: Hashable):
+        """Последовательная обработка очереди одного ключа"""
+        queue = self._queues[key]
+        try:
+            while queue:
+                job, enqueued_at = queue.popleft()
+                try:
+                    async with self._semaphore:
+                        self._queue_depth.dec()
+                        self._in_flight.inc()
+                        self._wait_seconds.observe(time.monotonic() - enqueued_at)
+                        try:
+                            await job()
+                        finally:
+                            self._in_flight.dec()
+                            self._processed.inc()
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    self._errors.inc()
+                    logger.error(f"Ошибка обработчика {self.name} для {key}: {e}")
+                finally:
+                    async with self._not_full:
+                        self._pending -= 1
+                        self._not_full.notify()
+        finally:
+            del self._queues[key]
+            self._active_keys.set(len(self._queues))
+
+    async def join(self):
+        """Ожидание обработки всех поставленных задач"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    async def close(self):
+        """Отмена всех задач"""
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*list(self._tasks), return_exceptions=True)
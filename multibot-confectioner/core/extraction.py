@@ -0,0 +1,163 @@
+"""
+Извлечение параметров заказа из описания в два уровня
+Сначала работают локальные регулярные выражения core.utils (микросекунды) и для каждого
+поля оценивается уверенность. Модель (analyze_order_description, сотни миллисекунд и оплата
+токенов) вызывается, только если какое-то поле не найдено или найдено неуверенно, а в тексте
+есть признаки этого поля ("начинка на ваш вкус", "к пятнице", "на 10 человек").
+Из ответа модели берутся только недостающие поля.
+
+Метрики (префикс extraction): local_only - описания без вызова модели, llm_calls - вызовы модели
+"""
+import re
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Awaitable, Callable, Dict, Optional
+import logging
+
+from config import settings
+from core.metrics import metrics
+from core.dates import DATE_FORMAT
+from core.utils import OrderFields, extract_date_from_text, extract_order_fields
+
+logger = logging.getLogger(__name__)
+
+ORDER_FIELDS = ('weight', 'ingredients', 'delivery_date')
+
+MIN_WEIGHT, MAX_WEIGHT = 0.2, 50.0
+
+# Признаки того, что поле в тексте есть, даже если регулярные выражения его не разобрали
+_CUES = {
+    'weight': re.compile(r'кило|грамм|\bкг\b|\bвес|полкило|полтора|человек|персон|гост', re.IGNORECASE),
+    'ingredients': re.compile(r'начинк|вкус|прослойк|пропитк|ягод|фрукт|орех', re.IGNORECASE),
+    'delivery_date': re.compile(
+        r'\d{1,2}[./-]\d{1,2}|сегодня|завтра|понедельник|вторник|\bсред|четверг|пятниц|суббот|'
+        r'воскресен|выходн|недел|январ|феврал|\bмарт|апрел|\bма[яй]\b|\bиюн|\bиюл|август|сентябр|'
+        r'октябр|ноябр|декабр|числ|\bк\s+\d{1,2}\b',
+        re.IGNORECASE
+    ),
+}
+
+LLMExtractor = Callable[[str], Awaitable[Dict[str, Any]]]
+
+
+@dataclass
+class Extraction:
+    """Результат извлечения: значения полей, уверенность (0..1) и источник (local или llm)"""
+    values: Dict[str, Any] = field(default_factory=dict)
+    confidence: Dict[str, float] = field(default_factory=dict)
+    source: Dict[str, str] = field(default_factory=dict)
+
+    def missing(self, min_confidence: float) -> list:
+        """Поля, которые не найдены или найдены с уверенностью ниже порога"""
+        return [key for key in ORDER_FIELDS if self.confidence.get(key, 0.0) < min_confidence]
+
+
+def _weight_confidence(fields: OrderFields) -> float:
+    if fields.weight is None:
+        return 0.0
+    if not MIN_WEIGHT <= fields.weight <= MAX_WEIGHT:
+        return 0.2
+    # Число без единиц измерения может быть возрастом, количеством ярусов и т.п.
+    return 0.9 if fields.weight_has_unit else 0.3
+
+
+_BARE_NUMBER_RE = re.compile(r'\s*\d+(?:[,.]\d+)?\s*')
+
+
+def parse_weight_reply(text: str) -> Optional[float]:
+    """
+    Вес из ответа на вопрос о весе без обращения к модели: сообщение целиком из числа ("2,5")
+    или число с единицами ("2 кг", "1500 г") в пределах MIN_WEIGHT..MAX_WEIGHT
+    :return: Вес в кг или None, если локально вес уверенно не определить ("на 10 человек", "3 яруса")
+    """
+    fields = extract_order_fields(text)
+    if fields.weight is None or not MIN_WEIGHT <= fields.weight <= MAX_WEIGHT:
+        return None
+    if fields.weight_has_unit or _BARE_NUMBER_RE.fullmatch(text):
+        return fields.weight
+    return None
+
+
+def extract_local(text: str, now: Optional[datetime] = None) -> Extraction:
+    """Локальный уровень: один проход регулярным выражением без обращения к модели"""
+    fields = extract_order_fields(text, now=now)
+    result = Extraction()
+
+    result.confidence['weight'] = _weight_confidence(fields)
+    if fields.weight is not None:
+        result.values['weight'] = fields.weight
+
+    result.confidence['ingredients'] = 0.8 if fields.ingredients else 0.0
+    if fields.ingredients:
+        result.values['ingredients'] = fields.ingredients
+    # Декор не обязателен для заказа и у модели не уточняется
+    if fields.decor:
+        result.values['decor'] = fields.decor
+
+    result.confidence['delivery_date'] = 0.9 if fields.delivery_date else 0.0
+    if fields.delivery_date:
+        # Данные диалога сохраняются в JSON, поэтому дата хранится строкой
+        result.values['delivery_date'] = fields.delivery_date.strftime(DATE_FORMAT)
+
+    for key in result.values:
+        result.source[key] = 'local'
+    return result
+
+
+def needs_llm(text: str, extraction: Extraction, min_confidence: float) -> list:
+    """Недостающие поля, признаки которых есть в тексте - только их имеет смысл спрашивать у модели"""
+    return [key for key in extraction.missing(min_confidence) if _CUES[key].search(text)]
+
+
+def _normalize(key: str, value: Any, now: Optional[datetime] = None) -> Any:
+    """Дата от модели ("к пятнице", "2030-12-20") приводится к формату диалога, если разбирается"""
+    if key == 'delivery_date':
+        parsed = extract_date_from_text(str(value), now=now)
+        if parsed:
+            return parsed.strftime(DATE_FORMAT)
+    return value
+
+
+class TieredExtractor:
+    """Локальное извлечение с обращением к модели только за недостающими полями"""
+
+    def __init__(self, min_confidence: float = 0.6, llm_fallback: bool = True):
+        self.min_confidence = min_confidence
+        self.llm_fallback = llm_fallback
+        self._local_only = metrics.counter("extraction.local_only")
+        self._llm_calls = metrics.counter("extraction.llm_calls")
+
+    async def extract(self, text: str, llm: Optional[LLMExtractor] = None,
+                      now: Optional[datetime] = None) -> Extraction:
+        """
+        Извлечение параметров заказа
+        :param text: Описание заказа
+        :param llm: Извлечение с помощью модели (например, analyze_order_description)
+        :param now: Момент сообщения, от которого отсчитываются относительные даты (по умолчанию - текущий)
+        :return: Найденные поля; поля с уверенностью ниже порога не возвращаются
+        """
+        result = extract_local(text, now=now)
+        fields = needs_llm(text, result, self.min_confidence) if self.llm_fallback and llm else []
+
+        if fields:
+            self._llm_calls.inc()
+            order_info = await llm(text) or {}
+            for key in fields:
+                if order_info.get(key):
+                    result.values[key] = _normalize(key, order_info[key], now)
+                    result.confidence[key] = 1.0
+                    result.source[key] = 'llm'
+        else:
+            self._local_only.inc()
+
+        for key in result.missing(self.min_confidence):
+            result.values.pop(key, None)
+            result.source.pop(key, None)
+        return result
+
+
+# Глобальный экстрактор параметров заказа
+extractor = TieredExtractor(
+    min_confidence=settings.extraction_min_confidence,
+    llm_fallback=settings.extraction_llm_fallback
+)
@@ -1,12 +1,23 @@
 """
 Модуль для управления состояниями диалога
 Поскольку FSM реализован по-разному в различных библиотеках ботов,
-этот модуль предоставляет общие состояния и интерфейс для управления ими
+этот модуль предоставляет общие состояния и интерфейс для управления ими.
+Состояния хранятся в подключаемом хранилище: в памяти процесса, в Redis
+или в памяти с отложенной записью в таблицу fsm_sessions
 """
 from enum import Enum
-from typing import Dict, Any, Optional
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Set, Tuple
+import asyncio
 import json
 import time
+import logging
+
+from config import settings
+from database import crud
+
+logger = logging.getLogger(__name__)
 
 class OrderState(Enum):
     """Перечисление состояний заказа"""
@@ -18,78 +29,320 @@ class OrderState(Enum):
     WAITING_FOR_CONFIRMATION = "waiting_for_confirmation"  # Ожидание подтверждения
     ORDER_COMPLETED = "order_completed"  # Заказ завершен
 
+
+class StateStorage:
+    """
+    Интерфейс хранилища состояний
+    Запись сессии - пара (state, data); save объединяет data с уже сохраненными
+    данными и продлевает срок жизни записи
+    """
+
+    async def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        raise NotImplementedError
+
+    async def save(self, key: str, state: Optional[str], data: Dict[str, Any], ttl: int):
+        """
+        Сохранение сессии
+        :param state: Новое состояние или None, чтобы оставить текущее
+        :param data: Данные, объединяемые с сохраненными
+        :param ttl: Время жизни записи в секундах
+        """
+        raise NotImplementedError
+
+    async def delete(self, key: str):
+        raise NotImplementedError
+
+    async def cleanup(self):
+        """Удаление устаревших записей (если хранилище не делает этого само)"""
+
+    async def close(self):
+        pass
+
+
+class MemoryStorage(StateStorage):
+    """
+    Хранилище в памяти процесса
+    Записи упорядочены по времени истечения (у всех один TTL), поэтому очистка
+    удаляет только устаревшие записи с начала, без полного обхода
+    """
+
+    def __init__(self):
+        self._records: "OrderedDict[str, Tuple[float, str, Dict[str, Any]]]" = OrderedDict()
+
+    async def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        record = self._records.get(key)
+        if record is None:
+            return None
+        expires_at, state, data = record
+        if expires_at <= time.time():
+            del self._records[key]
+            return None
+        return state, dict(data)
+
+    async def save(self, key: str, state: Optional[str], data: Dict[str, Any], ttl: int):
+        existing = await self.load(key)
+        if existing is not None:
+            current_state, current_data = existing
+            data = {**current_data, **data}
+        else:
+            current_state = OrderState.IDLE.value
+        self._records[key] = (time.time() + ttl, state or current_state, data)
+        self._records.move_to_end(key)
+        self._evict_expired()
+
+    async def delete(self, key: str):
+        self._records.pop(key, None)
+
+    async def cleanup(self):
+        self._evict_expired()
+
+    def _evict_expired(self):
+        now = time.time()
+        while self._records:
+            key, (expires_at, _, _) = next(iter(self._records.items()))
+            if expires_at > now:
+                break
+            del self._records[key]
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+
+class RedisStorage(StateStorage):
+    """
+    Хранилище в Redis
+    Сессия - хэш с полем state и полями d:<ключ> с JSON-значениями данных,
+    поэтому объединение данных выполняется на стороне Redis, а каждая операция
+    занимает один сетевой вызов. Устаревание - через TTL ключа
+    """
+
+    STATE_FIELD = "state"
+    DATA_PREFIX = "d:"
+
+    def __init__(self, url: str, prefix: str = "fsm:"):
+        try:
+            import redis.asyncio as aioredis
+        except ImportError:
+            raise RuntimeError("Для хранения состояний в Redis установите пакет redis")
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._prefix = prefix
+
+    async def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        fields = await self._redis.hgetall(self._prefix + key)
+        if not fields:
+            return None
+        data = {
+            name[len(self.DATA_PREFIX):]: json.loads(value)
+            for name, value in fields.items()
+            if name.startswith(self.DATA_PREFIX)
+        }
+        return fields.get(self.STATE_FIELD, OrderState.IDLE.value), data
+
+    async def save(self, key: str, state: Optional[str], data: Dict[str, Any], ttl: int):
+        redis_key = self._prefix + key
+        mapping = {self.DATA_PREFIX + name: json.dumps(value, ensure_ascii=False, default=str)
+                   for name, value in data.items()}
+        async with self._redis.pipeline(transaction=True) as pipe:
+            if state is not None:
+                mapping[self.STATE_FIELD] = state
+            else:
+                pipe.hsetnx(redis_key, self.STATE_FIELD, OrderState.IDLE.value)
+            if mapping:
+                pipe.hset(redis_key, mapping=mapping)
+            pipe.expire(redis_key, ttl)
+            await pipe.execute()
+
+    async def delete(self, key: str):
+        await self._redis.delete(self._prefix + key)
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+class PersistentStorage(StateStorage):
+    """
+    Хранилище в памяти с отложенной записью в таблицу fsm_sessions
+    Измененные сессии помечаются "грязными" и сохраняются пакетным upsert
+    раз в flush_interval секунд, поэтому обработка сообщения не ждет базу.
+    Сессия загружается из базы лениво - при первом обращении после запуска.
+    Ключ сессии - "<platform>:<user_id>", где user_id - id пользователя в базе
+    """
+
+    def __init__(self, ttl: int, flush_interval: float = 5.0, batch_size: int = 500, max_retries: int = 5):
+        self._memory = MemoryStorage()
+        self._ttl = ttl
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._max_retries = max_retries
+        self._dirty: Set[str] = set()
+        # Неудачные попытки сохранения сессии подряд
+        self._failures: Dict[str, int] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _split_key(key: str) -> Tuple[str, str]:
+        platform, user_id = key.split(":", 1)
+        return platform, user_id
+
+    def _is_fresh(self, row: Dict[str, Any]) -> bool:
+        updated_at = row.get('updated_at')
+        if not updated_at:
+            return True
+        updated = datetime.fromisoformat(updated_at)
+        if updated.tzinfo is None:
+            updated = updated.replace(tzinfo=timezone.utc)
+        return (datetime.now(timezone.utc) - updated).total_seconds() < self._ttl
+
+    async def load(self, key: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        record = await self._memory.load(key)
+        if record is not None:
+            return record
+
+        # Первое обращение к сессии: восстанавливаем из базы. Отсутствие сессии
+        # тоже запоминается в памяти, чтобы не ходить в базу на каждое сообщение
+        platform, user_id = self._split_key(key)
+        state, data = OrderState.IDLE.value, {}
+        try:
+            row = await crud.get_fsm_session(user_id, platform)
+            if row and self._is_fresh(row):
+                state, data = row['state'], row.get('data') or {}
+        except Exception as e:
+            logger.error(f"Не удалось восстановить FSM сессию {key}: {e}")
+        await self._memory.save(key, state, data, self._ttl)
+        return state, dict(data)
+
+    async def save(self, key: str, state: Optional[str], data: Dict[str, Any], ttl: int):
+        await self.load(key)
+        await self._memory.save(key, state, data, ttl)
+        self._mark_dirty(key)
+
+    async def delete(self, key: str):
+        # Сброс сохраняется как пустая сессия в состоянии idle
+        await self._memory.delete(key)
+        await self._memory.save(key, OrderState.IDLE.value, {}, self._ttl)
+        self._mark_dirty(key)
+
+    async def cleanup(self):
+        await self._memory.cleanup()
+
+    def _mark_dirty(self, key: str):
+        self._dirty.add(key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_loop(), name="fsm-flush")
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self._flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        """Пакетное сохранение всех измененных сессий"""
+        while self._dirty:
+            keys = [self._dirty.pop() for _ in range(min(self._batch_size, len(self._dirty)))]
+            rows = []
+            for key in keys:
+                record = await self._memory.load(key)
+                if record is None:
+                    continue  # сессия истекла до сохранения
+                platform, user_id = self._split_key(key)
+                rows.append({'user_id': user_id, 'platform': platform, 'state': record[0], 'data': record[1]})
+            if not rows:
+                continue
+            try:
+                await crud.upsert_fsm_sessions(rows)
+            except Exception as e:
+                # Вернем сессии в очередь, следующая попытка - через flush_interval;
+                # после max_retries неудач подряд сессия не сохраняется, пока не изменится снова
+                logger.error(f"Ошибка сохранения {len(rows)} FSM сессий: {e}")
+                dropped = 0
+                for key in keys:
+                    attempts = self._failures.get(key, 0) + 1
+                    if attempts >= self._max_retries:
+                        self._failures.pop(key, None)
+                        dropped += 1
+                    else:
+                        self._failures[key] = attempts
+                        self._dirty.add(key)
+                if dropped:
+                    logger.error(f"{dropped} FSM сессий не сохранены после {self._max_retries} попыток")
+                return
+            for key in keys:
+                self._failures.pop(key, None)
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+            await asyncio.gather(self._flush_task, return_exceptions=True)
+        await self.flush()
+
+
+def create_storage() -> StateStorage:
+    """
+    Выбор хранилища по настройке FSM_STORAGE (memory, redis, database);
+    если она не задана - память процесса (REDIS_URL сам по себе хранилище не меняет)
+    """
+    kind = settings.fsm_storage or "memory"
+    if kind == "redis":
+        logger.info("Состояния диалогов хранятся в Redis")
+        return RedisStorage(settings.redis_url)
+    if kind == "database":
+        logger.info("Состояния диалогов сохраняются в таблицу fsm_sessions")
+        return PersistentStorage(
+            settings.fsm_state_ttl,
+            flush_interval=settings.fsm_flush_interval,
+            batch_size=settings.fsm_flush_batch_size,
+            max_retries=settings.fsm_flush_max_retries
+        )
+    if kind != "memory":
+        raise ValueError(f"Неизвестное хранилище состояний: {kind}")
+    return MemoryStorage()
+
+
 class FSM:
     """Класс для управления состояниями пользователей"""
-    
-    def __init__(self):
-        # В реальной реализации лучше использовать Redis или базу данных
-        self.user_states: Dict[str, Dict[str, Any]] = {}
-        self.state_timestamps: Dict[str, float] = {}
-    
-    def get_state(self, user_id: str, platform: str) -> OrderState:
+
+    def __init__(self, storage: Optional[StateStorage] = None, ttl: Optional[int] = None):
+        self.storage = storage if storage is not None else MemoryStorage()
+        # Время жизни состояния без активности (по умолчанию 1 час)
+        self.ttl = ttl or settings.fsm_state_ttl
+
+    @staticmethod
+    def _key(user_id: str, platform: str) -> str:
+        return f"{platform}:{user_id}"
+
+    async def get_session(self, user_id: str, platform: str) -> Tuple[OrderState, Dict[str, Any]]:
+        """Получение состояния и данных пользователя за одно обращение к хранилищу"""
+        record = await self.storage.load(self._key(user_id, platform))
+        if record is None:
+            return OrderState.IDLE, {}
+        state, data = record
+        return OrderState(state), data
+
+    async def get_state(self, user_id: str, platform: str) -> OrderState:
         """Получение текущего состояния пользователя"""
-        user_key = f"{platform}:{user_id}"
-        return OrderState(self.user_states.get(user_key, {}).get('state', OrderState.IDLE.value))
-    
-    def set_state(self, user_id: str, platform: str, state: OrderState, data: Optional[Dict[str, Any]] = None):
-        """Установка состояния пользователя"""
-        user_key = f"{platform}:{user_id}"
-        
-        if data is None:
-            data = {}
-        
-        # Если пользователь уже был в каком-то состоянии, сохраняем его данные
-        if user_key in self.user_states:
-            existing_data = self.user_states[user_key].get('data', {})
-            data = {**existing_data, **data}
-        
-        self.user_states[user_key] = {
-            'state': state.value,
-            'data': data
-        }
-        self.state_timestamps[user_key] = time.time()
-    
-    def update_state_data(self, user_id: str, platform: str, data: Dict[str, Any]):
+        state, _ = await self.get_session(user_id, platform)
+        return state
+
+    async def set_state(self, user_id: str, platform: str, state: OrderState, data: Optional[Dict[str, Any]] = None):
+        """Установка состояния пользователя (данные объединяются с уже сохраненными)"""
+        await self.storage.save(self._key(user_id, platform), state.value, data or {}, self.ttl)
+
+    async def update_state_data(self, user_id: str, platform: str, data: Dict[str, Any]):
         """Обновление данных состояния пользователя"""
-        user_key = f"{platform}:{user_id}"
-        
-        if user_key not in self.user_states:
-            self.user_states[user_key] = {
-                'state': OrderState.IDLE.value,
-                'data': data
-            }
-        else:
-            existing_data = self.user_states[user_key].get('data', {})
-            self.user_states[user_key]['data'] = {**existing_data, **data}
-        
-        self.state_timestamps[user_key] = time.time()
-    
-    def get_state_data(self, user_id: str, platform: str) -> Dict[str, Any]:
+        await self.storage.save(self._key(user_id, platform), None, data, self.ttl)
+
+    async def get_state_data(self, user_id: str, platform: str) -> Dict[str, Any]:
         """Получение данных состояния пользователя"""
-        user_key = f"{platform}:{user_id}"
-        return self.user_states.get(user_key, {}).get('data', {})
-    
-    def reset_state(self, user_id: str, platform: str):
+        _, data = await self.get_session(user_id, platform)
+        return data
+
+    async def reset_state(self, user_id: str, platform: str):
         """Сброс состояния пользователя"""
-        user_key = f"{platform}:{user_id}"
-        if user_key in self.user_states:
-            del self.user_states[user_key]
-        if user_key in self.state_timestamps:
-            del self.state_timestamps[user_key]
-    
-    def cleanup_expired_states(self, max_age: int = 3600):
-        """Очистка устаревших состояний (по умолчанию за 1 час)"""
-        current_time = time.time()
-        expired_keys = [
-            key for key, timestamp in self.state_timestamps.items()
-            if current_time - timestamp > max_age
-        ]
-        
-        for key in expired_keys:
-            if key in self.user_states:
-                del self.user_states[key]
-            if key in self.state_timestamps:
-                del self.state_timestamps[key]
+        await self.storage.delete(self._key(user_id, platform))
+
+    async def cleanup_expired_states(self):
+        """Очистка устаревших состояний (Redis удаляет их сам по TTL)"""
+        await self.storage.cleanup()
 
 # Глобальный экземпляр FSM
-fsm = FSM()
\ No newline at end of file
+fsm = FSM(create_storage())
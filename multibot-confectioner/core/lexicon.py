@@ -0,0 +1,171 @@
+"""
+Словарь ингредиентов и декора для извлечения параметров заказа
+Словарь хранится в JSON-файле (по умолчанию core/lexicon.json) и перечитывается
+при изменении файла без перезапуска приложения. Каждая запись - канонический
+идентификатор, название для заказа и основы слов: основа совпадает с началом
+слова ("вишн" - "вишня", "вишней", "вишневый"), основа с "$" на конце - только
+с целым словом ("мак$" - "мак", но не "макет"). Синонимы - дополнительные основы
+той же записи ("голубик" -> черника).
+
+Основы собираются в префиксное дерево, которое превращается в регулярное выражение
+той же формы: общие начала основ проверяются один раз, поэтому поиск по тексту
+выполняется за один проход, O(длина текста), независимо от размера словаря
+"""
+import json
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import logging
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEXICON_PATH = os.path.join(os.path.dirname(__file__), "lexicon.json")
+KINDS = ('ingredients', 'decor')
+
+# Отрицание перед словом исключает его: "без орехов"
+NEGATION_PATTERN = r'(?P<negation>без|кроме)\s+'
+_WORD_END = r'(?![^\W\d_])'
+
+
+@dataclass(frozen=True)
+class LexiconEntry:
+    id: str
+    name: str
+    kind: str  # ingredients или decor
+
+
+class _TrieNode:
+    __slots__ = ('children', 'prefix', 'exact')
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.prefix = False  # здесь заканчивается основа (начало слова)
+        self.exact = False  # здесь заканчивается целое слово
+
+
+def _trie_pattern(node: _TrieNode) -> str:
+    """Регулярное выражение по дереву: сначала более длинные основы, затем целое слово, затем основа"""
+    alternatives = [re.escape(char) + _trie_pattern(child) for char, child in sorted(node.children.items())]
+    if node.exact:
+        alternatives.append(_WORD_END)
+    if node.prefix:
+        alternatives.append('')
+    if len(alternatives) == 1:
+        return alternatives[0]
+    return '(?:' + '|'.join(alternatives) + ')'
+
+
+def normalize_stem(stem: str) -> str:
+    return stem.strip().lower().replace('ё', 'е')
+
+
+class LexiconIndex:
+    """Неизменяемый скомпилированный словарь одной версии файла"""
+
+    def __init__(self, data: dict):
+        self.version = data.get('version')
+        self.entries: Dict[str, LexiconEntry] = {}
+        self.by_stem: Dict[str, LexiconEntry] = {}
+        root = _TrieNode()
+
+        for kind in KINDS:
+            for entry_id, item in (data.get(kind) or {}).items():
+                entry = LexiconEntry(id=entry_id, name=item['name'], kind=kind)
+                self.entries[entry_id] = entry
+                for stem in item.get('stems') or [item['name']]:
+                    stem = normalize_stem(stem)
+                    exact = stem.endswith('$')
+                    stem = stem.rstrip('$')
+                    if not stem:
+                        continue
+                    if stem in self.by_stem and self.by_stem[stem] != entry:
+                        logger.warning(f"Основа '{stem}' словаря указана у {self.by_stem[stem].id} и {entry_id}")
+                    self.by_stem[stem] = entry
+                    node = root
+                    for char in stem:
+                        node = node.children.setdefault(char, _TrieNode())
+                    if exact:
+                        node.exact = True
+                    else:
+                        node.prefix = True
+
+        # Первые символы основ и отрицаний - для быстрого пропуска остальных позиций текста
+        self.first_chars = ''.join(sorted(set(root.children) | set('бк')))
+        # Совпадение начинается с начала слова и поглощает слово до конца
+        self.pattern = (
+            r'(?<![^\W\d_])(?:' + NEGATION_PATTERN + r')?(?P<stem>' + _trie_pattern(root) + r')[^\W\d_]*'
+            if root.children else r'(?!)'
+        )
+        self.regex = re.compile(self.pattern)
+
+    def lookup(self, stem: str) -> LexiconEntry:
+        """Запись по основе, найденной выражением pattern"""
+        return self.by_stem[stem]
+
+
+def load_index(path: str) -> LexiconIndex:
+    with open(path, encoding='utf-8') as f:
+        return LexiconIndex(json.load(f))
+
+
+class Lexicon:
+    """
+    Словарь из файла с перечитыванием при изменении
+    Время изменения файла проверяется не чаще раза в reload_interval секунд;
+    если новый файл не читается, продолжает работать предыдущая версия
+    """
+
+    def __init__(self, path: str, reload_interval: float = 5.0):
+        self.path = path
+        self.reload_interval = reload_interval
+        self._index: Optional[LexiconIndex] = None
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+
+    def reload(self) -> bool:
+        """Перечитывание файла; True, если словарь обновлен"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+            index = load_index(self.path)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error(f"Не удалось загрузить словарь {self.path}: {e}")
+            if self._index is None:
+                self._index = LexiconIndex({})
+            return False
+        self._index, self._mtime = index, mtime
+        logger.info(f"Словарь {self.path} загружен: {len(index.entries)} записей, {len(index.by_stem)} основ")
+        return True
+
+    @property
+    def index(self) -> LexiconIndex:
+        now = time.monotonic()
+        if self._index is None:
+            self._checked_at = now
+            self.reload()
+        elif now - self._checked_at >= self.reload_interval:
+            self._checked_at = now
+            try:
+                changed = os.stat(self.path).st_mtime != self._mtime
+            except OSError:
+                changed = False
+            if changed:
+                self.reload()
+        return self._index
+
+    def match(self, text: str) -> List[LexiconEntry]:
+        """Записи словаря, упомянутые в тексте (без отрицания), в порядке упоминания"""
+        index = self.index
+        found: Dict[str, LexiconEntry] = {}
+        for match in index.regex.finditer(text.lower().replace('ё', 'е')):
+            if match.group('negation') is None:
+                entry = index.lookup(match.group('stem'))
+                found.setdefault(entry.id, entry)
+        return list(found.values())
+
+
+# Глобальный словарь ингредиентов и декора
+lexicon = Lexicon(settings.lexicon_path or DEFAULT_LEXICON_PATH, reload_interval=settings.lexicon_reload_interval)
@@ -0,0 +1,132 @@
+"""
+Простые метрики приложения (счетчики, показатели и гистограммы)
+Снимок всех метрик отдается эндпоинтом /metrics
+"""
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List
+
+
+def _pick(sorted_samples: List[float], p: float) -> float:
+    """Перцентиль p по отсортированной выборке"""
+    index = min(len(sorted_samples) - 1, int(round(p / 100 * (len(sorted_samples) - 1))))
+    return sorted_samples[index]
+
+
+class Counter:
+    """Монотонно растущий счетчик"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def snapshot(self) -> Any:
+        return self._value
+
+
+class Gauge:
+    """Текущее значение (глубина очереди, число активных задач и т.п.)"""
+
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def set(self, value: float):
+        with self._lock:
+            self._value = value
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    @property
+    def value(self) -> float:
+        return self._value
+
+    def snapshot(self) -> Any:
+        return self._value
+
+
+class Histogram:
+    """Распределение значений по последним max_samples наблюдениям"""
+
+    def __init__(self, max_samples: int = 1024):
+        self._samples: Deque[float] = deque(maxlen=max_samples)
+        self._count = 0
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        with self._lock:
+            self._samples.append(value)
+            self._count += 1
+            self._sum += value
+
+    def percentile(self, p: float) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        return _pick(samples, p) if samples else 0.0
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    def snapshot(self) -> Any:
+        with self._lock:
+            samples = sorted(self._samples)
+            count, total = self._count, self._sum
+        if not samples:
+            return {"count": count, "sum": total}
+
+        return {
+            "count": count,
+            "sum": round(total, 6),
+            "avg": round(total / count, 6),
+            "p50": _pick(samples, 50),
+            "p95": _pick(samples, 95),
+            "p99": _pick(samples, 99),
+            "max": samples[-1],
+        }
+
+
+class MetricsRegistry:
+    """Реестр метрик, метрики создаются при первом обращении по имени"""
+
+    def __init__(self):
+        self._metrics: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, factory):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(name, factory())
+        return metric
+
+    def counter(self, name: str) -> Counter:
+        return self._get(name, Counter)
+
+    def gauge(self, name: str) -> Gauge:
+        return self._get(name, Gauge)
+
+    def histogram(self, name: str) -> Histogram:
+        return self._get(name, Histogram)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {name: metric.snapshot() for name, metric in sorted(self._metrics.items())}
+
+
+# Глобальный реестр метрик
+metrics = MetricsRegistry()
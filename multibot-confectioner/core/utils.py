@@ -2,105 +2,109 @@
 Вспомогательные функции для проекта AI-помощника кондитера
 """
 import re
-from typing import Optional, Dict, Any
+from functools import lru_cache
+from typing import Optional, Dict, Any, List, NamedTuple, Pattern
 from datetime import datetime
 import logging
 
+from core.dates import DATE_FIRST_CHARS, DATE_PATTERN, resolve_date
+from core.lexicon import Lexicon, LexiconEntry, LexiconIndex, lexicon as default_lexicon
+
 logger = logging.getLogger(__name__)
 
+# Граммы переводятся в килограммы
+_WEIGHT_UNITS = {'кг': 1.0, 'kg': 1.0, 'г': 0.001, 'g': 0.001}
+
+# Вес и числа; даты добавляются выражением core.dates, ингредиенты и декор - выражением словаря core.lexicon.
+# Порядок альтернатив важен: дата раньше веса и числа, иначе "20.12.2030" разберется как вес 20.12
+_WEIGHT_PATTERN = (
+    r'(?P<weight>\d+(?:[,.]\d+)?)\s*(?P<unit>кг|kg|г|g)(?![^\W\d_])'  # 2,5 кг, 500 г
+    r'|(?P<number>\d+(?:[,.]\d+)?)'                                 # просто число
+)
+
+@lru_cache(maxsize=4)
+def _order_fields_re(index: LexiconIndex) -> Pattern:
+    """
+    Одно выражение для всех полей, компилируется один раз на версию словаря.
+    Все альтернативы начинаются с начала слова или числа, поэтому проверки первого символа
+    и предыдущего символа пропускают остальные позиции без перебора альтернатив
+    """
+    first_chars = re.escape(''.join(sorted(set(DATE_FIRST_CHARS) | set(index.first_chars))))
+    return re.compile(f'(?=[\\d{first_chars}])(?<![^\\W_])(?:{DATE_PATTERN}|{_WEIGHT_PATTERN}|{index.pattern})')
+
+class OrderFields(NamedTuple):
+    """Параметры заказа, найденные в тексте за один проход"""
+    weight: Optional[float]
+    weight_has_unit: bool  # вес указан с единицами измерения, а не просто числом
+    delivery_date: Optional[datetime]
+    ingredients: List[str]  # названия из словаря в порядке упоминания
+    decor: List[str]
+
+def _to_float(value: str) -> float:
+    return float(value.replace(',', '.'))
+
+def extract_order_fields(text: str, lexicon: Optional[Lexicon] = None,
+                         now: Optional[datetime] = None) -> OrderFields:
+    """
+    Извлечение веса, даты, ингредиентов и декора за один проход по тексту
+    :param text: Текст сообщения
+    :param lexicon: Словарь ингредиентов и декора (по умолчанию - глобальный core.lexicon)
+    :param now: Момент, от которого отсчитываются "завтра", "на субботу" и т.п. (по умолчанию - текущий)
+    :return: Первый вес с единицами измерения (иначе первое число), первая корректная дата,
+             ингредиенты и декор без отрицания ("без орехов")
+    """
+    index = (lexicon or default_lexicon).index
+    weight = number = delivery_date = None
+    found: Dict[str, LexiconEntry] = {}
+
+    for match in _order_fields_re(index).finditer(text.lower().replace('ё', 'е')):
+        group = match.lastgroup
+        if group == 'stem':
+            if match.group('negation') is None:
+                entry = index.lookup(match.group('stem'))
+                found.setdefault(entry.id, entry)
+        elif group == 'unit':
+            if weight is None:
+                weight = _to_float(match.group('weight')) * _WEIGHT_UNITS[match.group('unit')]
+        elif group == 'number':
+            if number is None:
+                number = _to_float(match.group('number'))
+        elif delivery_date is None:
+            delivery_date = resolve_date(match, now)
+
+    return OrderFields(
+        weight=weight if weight is not None else number,
+        weight_has_unit=weight is not None,
+        delivery_date=delivery_date,
+        ingredients=[entry.name for entry in found.values() if entry.kind == 'ingredients'],
+        decor=[entry.name for entry in found.values() if entry.kind == 'decor']
+    )
+
 def extract_weight_from_text(text: str) -> Optional[float]:
     """
     Извлечение веса из текста
     :param text: Текст, из которого нужно извлечь вес
     :return: Вес в килограммах или None, если не найден
     """
-    # Регулярное выражение для поиска чисел с возможной запятой или точкой
-    # и возможным указанием единиц измерения (кг, г, etc.)
-    patterns = [
-        r'(\d+[,\.]?\d*)\s*кг',  # Поиск числа с последующим "кг"
-        r'(\d+[,\.]?\d*)\s*kg',  # Поиск числа с последующим "kg"
-        r'(\d+[,\.]?\d*)\s*г',   # Поиск числа с последующим "г", затем преобразуем в кг
-        r'(\d+[,\.]?\d*)\s*g',   # Поиск числа с последующим "g", затем преобразуем в кг
-        r'(\d+[,\.]?\d*)'        # Просто число (предполагаем, что это кг)
-    ]
-    
-    for i, pattern in enumerate(patterns):
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
-            try:
-                weight = float(matches[0].replace(',', '.'))
-                
-                # Если нашли граммы, конвертируем в килограммы
-                if i in [2, 3]:  # Это были граммы
-                    weight = weight / 1000.0
-                
-                return weight
-            except ValueError:
-                continue
-    
-    return None
+    return extract_order_fields(text).weight
 
-def extract_date_from_text(text: str) -> Optional[datetime]:
+def extract_date_from_text(text: str, now: Optional[datetime] = None) -> Optional[datetime]:
     """
-    Извлечение даты из текста
+    Извлечение даты из текста: числовые форматы (DD.MM.YYYY, YYYY-MM-DD, DD/MM/YY), "20 декабря",
+    "на субботу", "послезавтра", "через неделю", "к 15-му" (см. core.dates)
     :param text: Текст, из которого нужно извлечь дату
+    :param now: Момент, от которого отсчитываются относительные даты (по умолчанию - текущий)
     :return: Дата или None, если не найдена
     """
-    # Регулярные выражения для различных форматов дат
-    date_patterns = [
-        r'(\d{1,2})\.(\d{1,2})\.(\d{4})',    # DD.MM.YYYY
-        r'(\d{1,2})-(\d{1,2})-(\d{4})',     # DD-MM-YYYY
-        r'(\d{1,2})/(\d{1,2})/(\d{4})',     # DD/MM/YYYY
-        r'(\d{4})-(\d{1,2})-(\d{1,2})',     # YYYY-MM-DD
-        r'(\d{1,2})\.(\d{1,2})\.(\d{2})',   # DD.MM.YY
-    ]
-    
-    for pattern in date_patterns:
-        matches = re.findall(pattern, text)
-        if matches:
-            try:
-                match = matches[0]
-                
-                # Если год в формате YY, преобразуем в YYYY
-                if len(match[2]) == 2:
-                    year = int('20' + match[2])
-                else:
-                    year = int(match[2])
-                
-                month = int(match[1])
-                day = int(match[0])
-                
-                return datetime(year, month, day)
-            except ValueError:
-                continue
-    
-    return None
+    return extract_order_fields(text, now=now).delivery_date
 
 def extract_ingredients_from_text(text: str) -> list:
     """
-    Извлечение ингредиентов из текста
+    Извлечение ингредиентов из текста (по словарю core.lexicon, с учетом падежей: "с вишней" -> вишня)
     :param text: Текст, из которого нужно извлечь ингредиенты
     :return: Список ингредиентов
     """
-    # В реальной реализации можно использовать NLP для более точного извлечения
-    # Пока что просто возвращаем все слова, которые могут быть ингредиентами
-    
-    # Пример простого подхода - извлечение ключевых слов
-    ingredients_keywords = [
-        'шоколад', 'вишня', 'клубника', 'крем', 'орехи', 'изюм', 'масло', 
-        'сметана', 'творог', 'яйца', 'мука', 'сахар', 'ваниль', 'какао',
-        'малина', 'черника', 'лимон', 'апельсин', 'кокос', 'миндаль',
-        'фундук', 'кешью', 'фисташки', 'сливки', 'повидло', 'джем'
-    ]
-    
-    text_lower = text.lower()
-    found_ingredients = []
-    
-    for ingredient in ingredients_keywords:
-        if ingredient in text_lower:
-            found_ingredients.append(ingredient)
-    
-    return found_ingredients
+    return extract_order_fields(text).ingredients
 
 def format_order_description(description: str, weight: Optional[float] = None, 
                            ingredients: Optional[list] = None, 
@@ -163,6 +167,19 @@ def sanitize_input(text: str) -> str:
     
     return sanitized
 
+_PUNCTUATION_RE = re.compile(r'[^\w\s]+')
+_SPACES_RE = re.compile(r'\s+')
+
+def normalize_text(text: Optional[str]) -> str:
+    """
+    Нормализация текста для сравнения и ключей кэша
+    :param text: Исходный текст
+    :return: Текст в нижнем регистре, без знаков препинания и лишних пробелов, ё заменена на е
+    """
+    text = (text or '').lower().replace('ё', 'е')
+    text = _PUNCTUATION_RE.sub(' ', text)
+    return _SPACES_RE.sub(' ', text).strip()
+
 def normalize_platform_name(platform: str) -> str:
     """
     Нормализация названия платформы
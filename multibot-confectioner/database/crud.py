@@ -1,30 +1,68 @@
+from datetime import datetime
 from typing import List, Optional
 from .models import User, Order, Chat
-from .init import get_supabase_client
+from .init import get_supabase_client, execute
+from . import postgres
+from config import settings
+from core.cache import TTLCache
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Кэш пользователей по (platform, platform_user_id); отсутствие пользователя
+# кэшируется на короткое время, чтобы новый пользователь не ждал долго
+user_cache = TTLCache(
+    "users",
+    max_size=settings.user_cache_size,
+    ttl=settings.user_cache_ttl,
+    negative_ttl=settings.user_cache_negative_ttl
+)
+
+CHAT_BATCH_FIELDS = {'user_id', 'platform', 'message', 'response', 'timestamp', 'ai_model'}
+
+def _order_row(order: Order) -> dict:
+    """Поля заказа для HTTP API Supabase: даты передаются строками ISO 8601"""
+    row = order.dict(exclude_unset=True)
+    for key in ('delivery_date', 'created_at', 'updated_at'):
+        if isinstance(row.get(key), datetime):
+            row[key] = row[key].isoformat()
+    return row
+
+def _use_postgres() -> bool:
+    """Запросы напрямую в Postgres (DB_BACKEND=postgres) вместо HTTP API Supabase"""
+    return settings.db_backend == "postgres"
+
 # CRUD операции для User
 async def create_user(user: User) -> User:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('users').insert(user.dict(exclude_unset=True)).execute()
-        created_user = response.data[0]
-        return User(**created_user)
+        if _use_postgres():
+            created_user = await postgres.create_user(user)
+        else:
+            supabase = get_supabase_client()
+            response = await execute(supabase.table('users').insert(user.dict(exclude_unset=True)))
+            created_user = User(**response.data[0])
+        user_cache.set((created_user.platform, created_user.platform_user_id), created_user)
+        return created_user
     except Exception as e:
         logger.error(f"Ошибка при создании пользователя: {e}")
         raise
 
 async def get_user_by_platform_id(platform: str, platform_user_id: str) -> Optional[User]:
-    supabase = get_supabase_client()
+    return await user_cache.get_or_load(
+        (platform, platform_user_id),
+        lambda: _fetch_user_by_platform_id(platform, platform_user_id)
+    )
+
+async def _fetch_user_by_platform_id(platform: str, platform_user_id: str) -> Optional[User]:
     try:
-        response = (
+        if _use_postgres():
+            return await postgres.get_user_by_platform_id(platform, platform_user_id)
+        supabase = get_supabase_client()
+        response = await execute(
             supabase.table('users')
             .select('*')
             .eq('platform', platform)
             .eq('platform_user_id', platform_user_id)
-            .execute()
         )
         if response.data:
             return User(**response.data[0])
@@ -34,20 +72,26 @@ async def get_user_by_platform_id(platform: str, platform_user_id: str) -> Optio
         raise
 
 async def update_user(user_id: str, user: User) -> User:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('users').update(user.dict(exclude_unset=True)).eq('id', user_id).execute()
-        updated_user = response.data[0]
-        return User(**updated_user)
+        if _use_postgres():
+            updated_user = await postgres.update_user(user_id, user)
+        else:
+            supabase = get_supabase_client()
+            response = await execute(supabase.table('users').update(user.dict(exclude_unset=True)).eq('id', user_id))
+            updated_user = User(**response.data[0])
+        user_cache.set((updated_user.platform, updated_user.platform_user_id), updated_user)
+        return updated_user
     except Exception as e:
         logger.error(f"Ошибка при обновлении пользователя: {e}")
         raise
 
 # CRUD операции для Order
 async def create_order(order: Order) -> Order:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('orders').insert(order.dict(exclude_unset=True)).execute()
+        if _use_postgres():
+            return await postgres.create_order(order)
+        supabase = get_supabase_client()
+        response = await execute(supabase.table('orders').insert(_order_row(order)))
         created_order = response.data[0]
         return Order(**created_order)
     except Exception as e:
@@ -55,9 +99,11 @@ async def create_order(order: Order) -> Order:
         raise
 
 async def get_order_by_id(order_id: str) -> Optional[Order]:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('orders').select('*').eq('id', order_id).execute()
+        if _use_postgres():
+            return await postgres.get_order_by_id(order_id)
+        supabase = get_supabase_client()
+        response = await execute(supabase.table('orders').select('*').eq('id', order_id))
         if response.data:
             return Order(**response.data[0])
         return None
@@ -66,9 +112,11 @@ async def get_order_by_id(order_id: str) -> Optional[Order]:
         raise
 
 async def update_order(order_id: str, order: Order) -> Order:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('orders').update(order.dict(exclude_unset=True)).eq('id', order_id).execute()
+        if _use_postgres():
+            return await postgres.update_order(order_id, order)
+        supabase = get_supabase_client()
+        response = await execute(supabase.table('orders').update(_order_row(order)).eq('id', order_id))
         updated_order = response.data[0]
         return Order(**updated_order)
     except Exception as e:
@@ -76,9 +124,11 @@ async def update_order(order_id: str, order: Order) -> Order:
         raise
 
 async def get_orders_by_user_id(user_id: str) -> List[Order]:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('orders').select('*').eq('user_id', user_id).execute()
+        if _use_postgres():
+            return await postgres.get_orders_by_user_id(user_id)
+        supabase = get_supabase_client()
+        response = await execute(supabase.table('orders').select('*').eq('user_id', user_id))
         return [Order(**order) for order in response.data]
     except Exception as e:
         logger.error(f"Ошибка при получении заказов пользователя: {e}")
@@ -86,20 +136,73 @@ async def get_orders_by_user_id(user_id: str) -> List[Order]:
 
 # CRUD операции для Chat
 async def create_chat(chat: Chat) -> Chat:
-    supabase = get_supabase_client()
     try:
-        response = supabase.table('chats').insert(chat.dict(exclude_unset=True)).execute()
+        if _use_postgres():
+            return await postgres.create_chat(chat)
+        supabase = get_supabase_client()
+        response = await execute(supabase.table('chats').insert(chat.dict(exclude_unset=True)))
         created_chat = response.data[0]
         return Chat(**created_chat)
     except Exception as e:
         logger.error(f"Ошибка при создании чата: {e}")
         raise
 
-async def get_chats_by_user_id(user_id: str) -> List[Chat]:
-    supabase = get_supabase_client()
+async def create_chats(chats: List[Chat]):
+    """Пакетная вставка сообщений одним запросом"""
     try:
-        response = supabase.table('chats').select('*').eq('user_id', user_id).execute()
-        return [Chat(**chat) for chat in response.data]
+        if _use_postgres():
+            return await postgres.create_chats(chats)
+        supabase = get_supabase_client()
+        # У всех строк одинаковый набор полей, как требует пакетная вставка PostgREST
+        rows = [
+            {**chat.dict(include=CHAT_BATCH_FIELDS), 'timestamp': chat.timestamp.isoformat() if chat.timestamp else None}
+            for chat in chats
+        ]
+        await execute(supabase.table('chats').insert(rows))
+    except Exception as e:
+        logger.error(f"Ошибка при пакетной записи чатов: {e}")
+        raise
+
+async def get_chats_by_user_id(user_id: str, limit: Optional[int] = None) -> List[Chat]:
+    """Сообщения пользователя; с limit - только последние limit сообщений, от старых к новым"""
+    try:
+        if _use_postgres():
+            return await postgres.get_chats_by_user_id(user_id, limit)
+        supabase = get_supabase_client()
+        query = supabase.table('chats').select('*').eq('user_id', user_id)
+        if limit is None:
+            response = await execute(query)
+            return [Chat(**chat) for chat in response.data]
+        response = await execute(query.order('timestamp', desc=True).limit(limit))
+        return [Chat(**chat) for chat in reversed(response.data)]
     except Exception as e:
         logger.error(f"Ошибка при получении чатов пользователя: {e}")
-        raise
\ No newline at end of file
+        raise
+
+# CRUD операции для FSM сессий
+async def get_fsm_session(user_id: str, platform: str) -> Optional[dict]:
+    try:
+        if _use_postgres():
+            return await postgres.get_fsm_session(user_id, platform)
+        supabase = get_supabase_client()
+        response = await execute(
+            supabase.table('fsm_sessions')
+            .select('state, data, updated_at')
+            .eq('user_id', user_id)
+            .eq('platform', platform)
+        )
+        return response.data[0] if response.data else None
+    except Exception as e:
+        logger.error(f"Ошибка при получении FSM сессии: {e}")
+        raise
+
+async def upsert_fsm_sessions(sessions: List[dict]):
+    """Пакетное сохранение сессий одним запросом (ключ - user_id и platform)"""
+    try:
+        if _use_postgres():
+            return await postgres.upsert_fsm_sessions(sessions)
+        supabase = get_supabase_client()
+        await execute(supabase.table('fsm_sessions').upsert(sessions, on_conflict='user_id,platform'))
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении FSM сессий: {e}")
+        raise
@@ -1,16 +1,29 @@
 import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
 from supabase import create_client, Client
 from config import settings
+from core.metrics import metrics
 from .models import User, Order, Chat
+from . import postgres
 import logging
 
 logger = logging.getLogger(__name__)
 
 supabase_client: Client = None
 
+# Клиент Supabase синхронный: запросы выполняются в ограниченном пуле потоков,
+# чтобы не блокировать event loop на время сетевого вызова
+_executor: ThreadPoolExecutor = None
+_query_seconds = metrics.histogram("db.query_seconds")
+_queries_in_flight = metrics.gauge("db.in_flight")
+
 async def init_db():
-    """Инициализация подключения к Supabase"""
+    """Инициализация подключения к Supabase или пула Postgres (DB_BACKEND=postgres)"""
     global supabase_client
+    if settings.db_backend == "postgres":
+        return await postgres.init_pool()
     try:
         supabase_client = create_client(settings.supabase_url, settings.supabase_key)
         logger.info("Подключение к Supabase успешно установлено")
@@ -24,4 +37,34 @@ def get_supabase_client():
     global supabase_client
     if supabase_client is None:
         raise RuntimeError("Supabase клиент не инициализирован. Вызовите init_db() сначала.")
-    return supabase_client
\ No newline at end of file
+    return supabase_client
+
+def get_db_executor() -> ThreadPoolExecutor:
+    """Пул потоков для запросов к Supabase (создается при первом обращении)"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=settings.db_executor_workers, thread_name_prefix="supabase")
+    return _executor
+
+async def execute(query) -> Any:
+    """
+    Выполнение запроса Supabase (построенного без .execute()) в пуле потоков
+    :param query: Построитель запроса PostgREST
+    :return: Ответ запроса
+    """
+    loop = asyncio.get_running_loop()
+    started = time.monotonic()
+    _queries_in_flight.inc()
+    try:
+        return await loop.run_in_executor(get_db_executor(), query.execute)
+    finally:
+        _queries_in_flight.dec()
+        _query_seconds.observe(time.monotonic() - started)
+
+async def close_db():
+    """Остановка пула потоков после завершения начатых запросов и закрытие пула Postgres"""
+    global _executor
+    await postgres.close_pool()
+    if _executor is not None:
+        executor, _executor = _executor, None
+        await asyncio.to_thread(executor.shutdown, wait=True)
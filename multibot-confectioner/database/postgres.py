@@ -0,0 +1,195 @@
+"""
+Прямой доступ к Postgres через пул соединений asyncpg (DB_BACKEND=postgres)
+Реализует те же операции, что и database.crud поверх Supabase, но без HTTP и JSON
+на каждый запрос. Запросы выполняются как prepared statements: asyncpg подготавливает
+запрос один раз на соединение и дальше берет его из кэша по тексту запроса,
+поэтому тексты запросов постоянны (вставка строится по отсортированному набору полей)
+"""
+import json
+import uuid
+from decimal import Decimal
+from typing import Any, Dict, List, Optional
+import logging
+
+from config import settings
+from .models import User, Order, Chat
+
+logger = logging.getLogger(__name__)
+
+_pool = None
+
+USER_COLUMNS = "id, platform, platform_user_id, first_name, last_name, age, gender, phone, email, created_at, updated_at"
+ORDER_COLUMNS = ("id, user_id, platform, description, weight, ingredients, delivery_date, status, price, "
+                 "image_url, created_at, updated_at")
+CHAT_COLUMNS = "id, user_id, platform, message, response, timestamp, ai_model"
+
+SELECT_USER_BY_PLATFORM_ID = f"SELECT {USER_COLUMNS} FROM users WHERE platform = $1 AND platform_user_id = $2"
+SELECT_ORDER_BY_ID = f"SELECT {ORDER_COLUMNS} FROM orders WHERE id = $1"
+SELECT_ORDERS_BY_USER_ID = f"SELECT {ORDER_COLUMNS} FROM orders WHERE user_id = $1"
+SELECT_CHATS_BY_USER_ID = f"SELECT {CHAT_COLUMNS} FROM chats WHERE user_id = $1"
+SELECT_LAST_CHATS_BY_USER_ID = f"SELECT {CHAT_COLUMNS} FROM chats WHERE user_id = $1 ORDER BY timestamp DESC LIMIT $2"
+INSERT_CHATS = """
+    INSERT INTO chats (user_id, platform, message, response, timestamp, ai_model)
+    SELECT * FROM unnest($1::uuid[], $2::varchar[], $3::text[], $4::text[], $5::timestamptz[], $6::varchar[])
+"""
+SELECT_FSM_SESSION = "SELECT state, data, updated_at FROM fsm_sessions WHERE user_id = $1 AND platform = $2"
+UPSERT_FSM_SESSIONS = """
+    INSERT INTO fsm_sessions (user_id, platform, state, data)
+    SELECT * FROM unnest($1::uuid[], $2::varchar[], $3::varchar[], $4::jsonb[])
+    ON CONFLICT (user_id, platform) DO UPDATE SET state = EXCLUDED.state, data = EXCLUDED.data
+"""
+
+
+async def _init_connection(connection):
+    """JSONB передается как dict, а не как строка"""
+    await connection.set_type_codec("jsonb", encoder=json.dumps, decoder=json.loads, schema="pg_catalog")
+
+
+async def init_pool():
+    """Создание пула соединений с DATABASE_URL"""
+    global _pool
+    import asyncpg
+    try:
+        _pool = await asyncpg.create_pool(
+            settings.database_url,
+            min_size=settings.db_pool_min_size,
+            max_size=settings.db_pool_max_size,
+            init=_init_connection
+        )
+        logger.info("Пул соединений с Postgres создан")
+        return _pool
+    except Exception as e:
+        logger.error(f"Ошибка подключения к Postgres: {e}")
+        raise
+
+
+async def close_pool():
+    global _pool
+    if _pool is not None:
+        pool, _pool = _pool, None
+        await pool.close()
+
+
+def get_pool():
+    if _pool is None:
+        raise RuntimeError("Пул Postgres не инициализирован. Вызовите init_db() сначала.")
+    return _pool
+
+
+def _row_to_dict(row) -> Dict[str, Any]:
+    """Приведение типов asyncpg к типам моделей (UUID -> str, Decimal -> float)"""
+    result = {}
+    for key, value in row.items():
+        if isinstance(value, uuid.UUID):
+            value = str(value)
+        elif isinstance(value, Decimal):
+            value = float(value)
+        result[key] = value
+    return result
+
+
+def _insert_query(table: str, fields: List[str], returning: str) -> str:
+    placeholders = ", ".join(f"${i}" for i in range(1, len(fields) + 1))
+    return f"INSERT INTO {table} ({', '.join(fields)}) VALUES ({placeholders}) RETURNING {returning}"
+
+
+def _update_query(table: str, fields: List[str], returning: str) -> str:
+    assignments = ", ".join(f"{field} = ${i}" for i, field in enumerate(fields, start=2))
+    return f"UPDATE {table} SET {assignments} WHERE id = $1 RETURNING {returning}"
+
+
+async def _insert(table: str, values: Dict[str, Any], returning: str) -> Dict[str, Any]:
+    fields = sorted(values)
+    row = await get_pool().fetchrow(_insert_query(table, fields, returning), *(values[f] for f in fields))
+    return _row_to_dict(row)
+
+
+async def _update(table: str, row_id: str, values: Dict[str, Any], returning: str) -> Optional[Dict[str, Any]]:
+    fields = sorted(field for field in values if field != 'id')
+    row = await get_pool().fetchrow(_update_query(table, fields, returning), row_id, *(values[f] for f in fields))
+    return _row_to_dict(row) if row else None
+
+
+# User
+
+async def create_user(user: User) -> User:
+    return User(**await _insert('users', user.dict(exclude_unset=True), USER_COLUMNS))
+
+
+async def get_user_by_platform_id(platform: str, platform_user_id: str) -> Optional[User]:
+    row = await get_pool().fetchrow(SELECT_USER_BY_PLATFORM_ID, platform, platform_user_id)
+    return User(**_row_to_dict(row)) if row else None
+
+
+async def update_user(user_id: str, user: User) -> User:
+    return User(**await _update('users', user_id, user.dict(exclude_unset=True), USER_COLUMNS))
+
+
+# Order
+
+async def create_order(order: Order) -> Order:
+    return Order(**await _insert('orders', order.dict(exclude_unset=True), ORDER_COLUMNS))
+
+
+async def get_order_by_id(order_id: str) -> Optional[Order]:
+    row = await get_pool().fetchrow(SELECT_ORDER_BY_ID, order_id)
+    return Order(**_row_to_dict(row)) if row else None
+
+
+async def update_order(order_id: str, order: Order) -> Order:
+    return Order(**await _update('orders', order_id, order.dict(exclude_unset=True), ORDER_COLUMNS))
+
+
+async def get_orders_by_user_id(user_id: str) -> List[Order]:
+    rows = await get_pool().fetch(SELECT_ORDERS_BY_USER_ID, user_id)
+    return [Order(**_row_to_dict(row)) for row in rows]
+
+
+# Chat
+
+async def create_chat(chat: Chat) -> Chat:
+    return Chat(**await _insert('chats', chat.dict(exclude_unset=True), CHAT_COLUMNS))
+
+
+async def create_chats(chats: List[Chat]):
+    """Пакетная вставка сообщений одним запросом"""
+    await get_pool().execute(
+        INSERT_CHATS,
+        [c.user_id for c in chats],
+        [c.platform for c in chats],
+        [c.message for c in chats],
+        [c.response for c in chats],
+        [c.timestamp for c in chats],
+        [c.ai_model for c in chats]
+    )
+
+
+async def get_chats_by_user_id(user_id: str, limit: Optional[int] = None) -> List[Chat]:
+    if limit is None:
+        rows = await get_pool().fetch(SELECT_CHATS_BY_USER_ID, user_id)
+    else:
+        rows = reversed(await get_pool().fetch(SELECT_LAST_CHATS_BY_USER_ID, user_id, limit))
+    return [Chat(**_row_to_dict(row)) for row in rows]
+
+
+# FSM сессии
+
+async def get_fsm_session(user_id: str, platform: str) -> Optional[dict]:
+    row = await get_pool().fetchrow(SELECT_FSM_SESSION, user_id, platform)
+    if row is None:
+        return None
+    session = dict(row)
+    if session['updated_at'] is not None:
+        session['updated_at'] = session['updated_at'].isoformat()
+    return session
+
+
+async def upsert_fsm_sessions(sessions: List[dict]):
+    """Пакетное сохранение сессий одним запросом"""
+    await get_pool().execute(
+        UPSERT_FSM_SESSIONS,
+        [s['user_id'] for s in sessions],
+        [s['platform'] for s in sessions],
+        [s['state'] for s in sessions],
+        [s['data'] for s in sessions]
+    )
@@ -1,12 +1,19 @@
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse, PlainTextResponse
 import uvicorn
 import asyncio
+import os
 from config import settings
-from bots.telegram import setup_telegram_bot
-from bots.vk import setup_vk_bot
-from bots.avito import setup_avito_bot
-from database.init import init_db
+from bots.telegram import setup_telegram_bot, shutdown_telegram_bot, enqueue_update as enqueue_telegram_update
+from bots.vk import setup_vk_bot, shutdown_vk_bot, enqueue_message as enqueue_vk_message
+from bots.avito import setup_avito_bot, shutdown_avito_bot, enqueue_webhook_event as enqueue_avito_event
+from database.init import init_db, close_db
+from ai.image_cache import image_store
+from core.async_bridge import bridge
+from core.metrics import metrics
+from core.fsm import fsm
+from core.chat_log import chat_log
+from core.conversation import engine
 import logging
 
 # Настройка логирования
@@ -19,12 +26,31 @@ app = FastAPI(title="AI-Помощник Кондитера", version="1.0.0")
 async def startup_event():
     logger.info("Инициализация базы данных...")
     await init_db()
+    # Корутины из потока long poll VK выполняются в этом же event loop
+    bridge.attach(asyncio.get_running_loop())
     logger.info("Инициализация ботов...")
     await setup_telegram_bot()
     setup_vk_bot()
-    setup_avito_bot()
+    await setup_avito_bot()
     logger.info("Приложение запущено")
 
+@app.on_event("shutdown")
+async def shutdown_event():
+    # Изображения уже принятых заказов отправляются до закрытия сессий ботов
+    try:
+        await asyncio.wait_for(engine.image_jobs.join(), settings.image_shutdown_timeout)
+    except asyncio.TimeoutError:
+        logger.warning("Не все изображения заказов отправлены до остановки")
+        await engine.image_jobs.close()
+    logger.info("Остановка ботов...")
+    await shutdown_telegram_bot()
+    await shutdown_avito_bot()
+    await shutdown_vk_bot()
+    await fsm.storage.close()
+    await chat_log.close()
+    await close_db()
+    bridge.stop()
+
 @app.get("/")
 async def root():
     return {"message": "AI-Помощник Кондитера", "status": "ok"}
@@ -33,28 +59,63 @@ async def root():
 async def health_check():
     return {"status": "healthy"}
 
+@app.get("/metrics")
+async def metrics_snapshot():
+    return metrics.snapshot()
+
+@app.get("/images/{key}.png")
+async def cake_image(key: str):
+    # Постоянные ссылки на изображения заказов (PUBLIC_BASE_URL/images/<ключ>.png)
+    path = image_store.path(key)
+    if path is None or not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Image not found")
+    return FileResponse(path, media_type="image/png")
+
 @app.post("/webhook/telegram/{token}")
 async def telegram_webhook(token: str, request: Request):
-    # Обработка вебхука от Telegram
+    # Обновление ставится в очередь, ответ Telegram возвращается сразу
+    if token != settings.telegram_bot_token:
+        raise HTTPException(status_code=403, detail="Invalid token")
     data = await request.json()
-    logger.info(f"Получено сообщение от Telegram: {data}")
-    # Здесь будет логика обработки сообщения от Telegram
+    try:
+        await enqueue_telegram_update(data)
+    except ValueError as e:
+        logger.warning(f"Отклонено обновление Telegram: {e}")
+        raise HTTPException(status_code=400, detail="Invalid update")
     return {"ok": True}
 
 @app.post("/webhook/vk")
 async def vk_webhook(request: Request):
-    # Обработка вебхука от VK
+    # Callback API VK: подтверждение сервера и новые сообщения
     data = await request.json()
-    logger.info(f"Получено сообщение от VK: {data}")
-    # Здесь будет логика обработки сообщения от VK
-    return {"ok": True}
+    if str(data.get("group_id")) != str(settings.vk_group_id):
+        raise HTTPException(status_code=403, detail="Invalid group")
+    if data.get("type") == "confirmation":
+        return PlainTextResponse(settings.vk_confirmation_token)
+    if data.get("secret") != settings.vk_secret_key:
+        raise HTTPException(status_code=403, detail="Invalid secret")
+    if data.get("type") == "message_new":
+        message = (data.get("object") or {}).get("message")
+        if not message or "peer_id" not in message:
+            raise HTTPException(status_code=400, detail="Invalid event")
+        await enqueue_vk_message(message)
+    # VK ожидает в ответ строку "ok"
+    return PlainTextResponse("ok")
 
-@app.post("/webhook/avito")
-async def avito_webhook(request: Request):
-    # Обработка вебхука от Avito
+@app.post("/webhook/avito/{secret}")
+async def avito_webhook(secret: str, request: Request):
+    # Сообщение ставится в очередь, ответ Avito возвращается сразу
+    if not settings.avito_webhook_secret or secret != settings.avito_webhook_secret:
+        raise HTTPException(status_code=403, detail="Invalid secret")
     data = await request.json()
-    logger.info(f"Получено сообщение от Avito: {data}")
-    # Здесь будет логика обработки сообщения от Avito
+    try:
+        await enqueue_avito_event(data)
+    except ValueError as e:
+        logger.warning(f"Отклонено уведомление Avito: {e}")
+        raise HTTPException(status_code=400, detail="Invalid event")
+    except RuntimeError as e:
+        logger.error(f"Уведомление Avito не принято: {e}")
+        raise HTTPException(status_code=503, detail="Avito bot is not ready")
     return {"ok": True}
 
 if __name__ == "__main__":
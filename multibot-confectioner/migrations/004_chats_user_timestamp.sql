@@ -0,0 +1,2 @@
+-- Индекс для загрузки последних сообщений пользователя (контекст диалога для модели)
+CREATE INDEX IF NOT EXISTS idx_chats_user_timestamp ON chats (user_id, timestamp DESC);
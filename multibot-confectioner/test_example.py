@@ -3,11 +3,17 @@
 """
 import pytest
 import asyncio
+import time
 from unittest.mock import AsyncMock, MagicMock, patch
 from ai.chat import generate_response, analyze_order_description
 from ai.image_gen import generate_cake_image
+from ai.image_cache import CakeImage
 from database.crud import create_user, get_user_by_platform_id
 from core.utils import extract_weight_from_text, extract_date_from_text
+from core.async_bridge import AsyncBridge
+from core.dispatcher import KeyedDispatcher
+from core.metrics import metrics
+from core.conversation import ConversationEngine, IncomingMessage, PlatformAdapter
 
 
 @pytest.mark.asyncio
@@ -118,4 +124,1234 @@ async def test_generate_cake_image():
         image_url = await generate_cake_image(description, weight)
         
         assert image_url == "https://example.com/cake_image.jpg"
-        mock_openai.assert_called_once()
\ No newline at end of file
+        mock_openai.assert_called_once()
+
+
+def test_async_bridge_reuses_single_loop():
+    """Тест общего фонового event loop для синхронных обёрток"""
+    async def current_loop():
+        return asyncio.get_running_loop()
+
+    bridge = AsyncBridge(name="test-bridge")
+    try:
+        first = bridge.run(current_loop())
+        second = bridge.run(current_loop())
+        assert first is second
+        assert not first.is_closed()
+    finally:
+        bridge.stop()
+
+
+
+@pytest.mark.asyncio
+async def test_keyed_dispatcher_orders_per_key():
+    """Тест диспетчера: порядок внутри ключа и ограничение параллелизма"""
+    dispatcher = KeyedDispatcher("test", max_in_flight=2)
+    processed = []
+    active = 0
+    max_active = 0
+
+    async def job(key, n):
+        nonlocal active, max_active
+        active += 1
+        max_active = max(max_active, active)
+        await asyncio.sleep(0.01)
+        processed.append((key, n))
+        active -= 1
+
+    for n in range(3):
+        for key in ("a", "b", "c"):
+            await dispatcher.submit(key, lambda key=key, n=n: job(key, n))
+    await dispatcher.join()
+
+    for key in ("a", "b", "c"):
+        assert [n for k, n in processed if k == key] == [0, 1, 2]
+    assert max_active == 2
+    assert dispatcher.pending == 0
+    assert metrics.gauge("dispatcher.test.queue_depth").value == 0
+    assert metrics.gauge("dispatcher.test.in_flight").value == 0
+    assert metrics.counter("dispatcher.test.processed").value == 9
+
+
+
+def test_vk_webhook_handshake():
+    """Тест подтверждения сервера и проверки секрета в Callback API VK"""
+    from fastapi.testclient import TestClient
+    from config import settings
+    from main import app
+
+    client = TestClient(app)
+
+    response = client.post("/webhook/vk", json={"type": "confirmation", "group_id": settings.vk_group_id})
+    assert response.status_code == 200
+    assert response.text == settings.vk_confirmation_token
+
+    response = client.post("/webhook/vk", json={
+        "type": "message_new",
+        "group_id": settings.vk_group_id,
+        "secret": "wrong",
+        "object": {"message": {"peer_id": 1, "from_id": 1, "text": "начать"}}
+    })
+    assert response.status_code == 403
+
+
+def test_telegram_webhook_enqueues_update():
+    """Тест вебхука Telegram: проверка токена и обновления, постановка в очередь с received_at"""
+    from fastapi.testclient import TestClient
+    from config import settings
+    from main import app
+
+    dispatcher = MagicMock()
+    dispatcher.submit = AsyncMock()
+    dp = MagicMock()
+    dp.feed_update = AsyncMock()
+    client = TestClient(app)
+    update = {
+        "update_id": 7,
+        "message": {
+            "message_id": 1, "date": 1700000000, "text": "Хочу торт",
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Анна"}
+        }
+    }
+
+    with patch("bots.telegram.update_dispatcher", dispatcher), patch("bots.telegram.dp", dp):
+        response = client.post("/webhook/telegram/wrong-token", json=update)
+        assert response.status_code == 403
+
+        response = client.post(f"/webhook/telegram/{settings.telegram_bot_token}", json={"update_id": "x"})
+        assert response.status_code == 400
+        dispatcher.submit.assert_not_awaited()
+
+        before = time.monotonic()
+        response = client.post(f"/webhook/telegram/{settings.telegram_bot_token}", json=update)
+        assert response.status_code == 200 and response.json() == {"ok": True}
+
+        # Обновления упорядочиваются по чату, обработчик получает момент приема обновления
+        key, job = dispatcher.submit.await_args.args
+        assert key == 42
+        asyncio.run(job())
+    _, fed_update = dp.feed_update.await_args.args
+    assert fed_update.update_id == 7 and fed_update.message.text == "Хочу торт"
+    received_at = dp.feed_update.await_args.kwargs["received_at"]
+    assert before <= received_at <= time.monotonic()
+
+
+def test_avito_webhook_enqueues_message():
+    """Тест вебхука Avito: проверка секрета и уведомления, постановка сообщения в очередь диалога"""
+    from fastapi.testclient import TestClient
+    from config import settings
+    from main import app
+
+    dispatcher = MagicMock()
+    dispatcher.submit = AsyncMock()
+    handle_message = AsyncMock()
+    client = TestClient(app)
+
+    def event(author_id):
+        return {"payload": {"type": "message", "value": {
+            "id": "webhook-m1", "chat_id": "c9", "author_id": author_id, "user_id": 100,
+            "content": {"text": "Сколько стоит торт?"}
+        }}}
+
+    url = "/webhook/avito/s3cret"
+
+    # Без заданного секрета вебхук отклоняет все уведомления
+    with patch.object(settings, "avito_webhook_secret", None):
+        assert client.post(url, json=event(author_id=55)).status_code == 403
+
+    with patch.object(settings, "avito_webhook_secret", "s3cret"):
+        assert client.post("/webhook/avito/wrong", json=event(author_id=55)).status_code == 403
+        # Бот не инициализирован (ошибка setup_avito_bot) - 503, а не 500
+        with patch("bots.avito.dispatcher", None):
+            assert client.post(url, json=event(author_id=55)).status_code == 503
+
+        with patch("bots.avito.dispatcher", dispatcher), patch("bots.avito.handle_message", handle_message):
+            assert client.post(url, json={"payload": "oops"}).status_code == 400
+            assert client.post(url, json={"payload": {"type": "message", "value": {}}}).status_code == 400
+
+            # Уведомления не о сообщениях и собственные сообщения аккаунта не обрабатываются
+            assert client.post(url, json={"payload": {"type": "system"}}).status_code == 200
+            assert client.post(url, json=event(author_id=100)).status_code == 200
+            dispatcher.submit.assert_not_awaited()
+
+            response = client.post(url, json=event(author_id=55))
+            assert response.status_code == 200 and response.json() == {"ok": True}
+            key, job = dispatcher.submit.await_args.args
+            assert key == "c9"
+            asyncio.run(job())
+
+    message_data, received_at = handle_message.await_args.args
+    assert message_data == {
+        "id": "webhook-m1", "user_id": 55, "text": "Сколько стоит торт?", "conversation_id": "c9"
+    }
+    assert received_at <= time.monotonic()
+
+
+
+class RecordingAdapter(PlatformAdapter):
+    """Адаптер платформы для тестов: запоминает отправленные сообщения"""
+
+    platform = "test"
+    start_commands = frozenset(["/start"])
+
+    def __init__(self):
+        self.sent = []
+        self.notified = []
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def notify_confectioner(self, order):
+        self.notified.append((order, None))
+
+    async def notify_confectioner_image(self, order, image):
+        self.notified.append((order, image))
+
+
+@pytest.mark.asyncio
+async def test_conversation_engine_order_flow():
+    """Тест единого движка диалога: полный сценарий заказа"""
+    from core.fsm import FSM, OrderState
+    from database.models import User, Order
+
+    user = User(id="u1", platform="test", platform_user_id="42")
+    created_orders = []
+
+    async def fake_create_order(order):
+        created_orders.append(order)
+        return Order(id="o1", **order.dict(exclude={"id"}))
+
+    engine = ConversationEngine(FSM())
+    adapter = RecordingAdapter()
+    update_order = AsyncMock()
+    image = CakeImage(key="0" * 64, data=b"png", url="https://img/cake.png")
+
+    with patch("core.conversation.get_user_by_platform_id", AsyncMock(return_value=user)), \
+         patch("core.conversation.chat_log", MagicMock(write=AsyncMock())), \
+         patch("core.conversation.generate_response", AsyncMock(return_value="AI")), \
+         patch("core.conversation.analyze_order_description", AsyncMock(return_value={"weight": None})), \
+         patch("core.conversation.get_cake_image", AsyncMock(return_value=image)), \
+         patch("core.conversation.update_order", update_order), \
+         patch("core.conversation.create_order", fake_create_order):
+        for text in ["/start", "Шоколадный торт", "2,5", "вишня", "20.12.2030", "да"]:
+            await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text=text))
+        # Подтверждение и уведомление кондитера - сразу, изображение кондитеру - после фоновой генерации
+        assert adapter.sent[-1] == "Ваш заказ принят! 🎂 Кондитер свяжется с вами в ближайшее время для уточнения деталей. Спасибо за заказ!"
+        assert [(order.id, image) for order, image in adapter.notified] == [("o1", None)]
+        await engine.image_jobs.join()
+
+    assert len(created_orders) == 1
+    order = created_orders[0]
+    assert order.description == "Шоколадный торт"
+    assert order.weight == 2.5
+    assert order.ingredients == ["вишня"]
+    assert order.delivery_date.day == 20
+    assert adapter.sent[-1] == "Вот как будет выглядеть ваш торт! https://img/cake.png"
+    notified_order, notified_image = adapter.notified[1]
+    assert notified_order.id == "o1" and notified_image is image
+    assert notified_order.image_url == "https://img/cake.png"
+    order_id, update = update_order.await_args.args
+    assert order_id == "o1" and update.image_url == "https://img/cake.png"
+    assert await engine.fsm.get_state("u1", "test") == OrderState.IDLE
+
+
+@pytest.mark.asyncio
+async def test_conversation_weight_parsed_locally():
+    """Тест шага веса: "2 кг" разбирается без модели, словесный вес - моделью"""
+    from core.fsm import FSM, OrderState
+    from database.models import User
+
+    user = User(id="u1", platform="test", platform_user_id="42")
+    engine = ConversationEngine(FSM())
+    adapter = RecordingAdapter()
+    generate = AsyncMock(return_value="3")
+
+    with patch("core.conversation.get_user_by_platform_id", AsyncMock(return_value=user)), \
+         patch("core.conversation.chat_log", MagicMock(write=AsyncMock())), \
+         patch("core.conversation.generate_response", generate):
+        await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_WEIGHT)
+        await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text="2 кг"))
+        # Модель только формулирует ответ, вес ее не спрашивают
+        assert [call.args[0] for call in generate.await_args_list] == [
+            "Вес торта: 2.0 кг. Какие ингредиенты или начинку вы бы хотели?"
+        ]
+        assert (await engine.fsm.get_state_data("u1", "test"))["weight"] == 2.0
+
+        generate.reset_mock()
+        await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_WEIGHT)
+        await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text="три кило"))
+        assert generate.await_args_list[0].args[0] == "Извлеки вес торта из сообщения: три кило"
+        assert (await engine.fsm.get_state_data("u1", "test"))["weight"] == 3.0
+
+        # Число без единиц внутри фразы - количество гостей или ярусов, а не вес
+        for text in ["на 10 человек", "3 яруса"]:
+            generate.reset_mock()
+            await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_WEIGHT)
+            await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text=text))
+            assert generate.await_args_list[0].args[0] == f"Извлеки вес торта из сообщения: {text}"
+
+
+@pytest.mark.asyncio
+async def test_conversation_delivery_date_single_confirmation():
+    """Тест шага даты доставки: одно сообщение с подтверждением, без вызова модели"""
+    from core.conversation import format_confirmation
+    from core.fsm import FSM, OrderState
+    from database.models import User
+
+    user = User(id="u1", platform="test", platform_user_id="42")
+    engine = ConversationEngine(FSM())
+    adapter = RecordingAdapter()
+    generate = AsyncMock(return_value="AI")
+    data = {"description": "Шоколадный торт", "weight": 2.0, "ingredients": ["вишня"]}
+
+    with patch("core.conversation.get_user_by_platform_id", AsyncMock(return_value=user)), \
+         patch("core.conversation.chat_log", MagicMock(write=AsyncMock())), \
+         patch("core.conversation.generate_response", generate):
+        await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_DELIVERY_DATE, data)
+        await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text="20.12.2030"))
+
+    assert adapter.sent == [format_confirmation({**data, "delivery_date": "20.12.2030"})]
+    generate.assert_not_awaited()
+    assert await engine.fsm.get_state("u1", "test") == OrderState.WAITING_FOR_CONFIRMATION
+
+
+@pytest.mark.asyncio
+async def test_fsm_memory_storage_ttl():
+    """Тест хранилища состояний в памяти: объединение данных и истечение TTL"""
+    from core.fsm import FSM, MemoryStorage, OrderState
+
+    storage = MemoryStorage()
+    state_machine = FSM(storage, ttl=60)
+
+    await state_machine.set_state("1", "vk", OrderState.WAITING_FOR_WEIGHT, {"description": "торт"})
+    await state_machine.update_state_data("1", "vk", {"weight": 2.0})
+    assert await state_machine.get_session("1", "vk") == (
+        OrderState.WAITING_FOR_WEIGHT, {"description": "торт", "weight": 2.0}
+    )
+
+    with patch("core.fsm.time.time", return_value=10 ** 12):
+        await state_machine.cleanup_expired_states()
+    assert len(storage) == 0
+    assert await state_machine.get_state("1", "vk") == OrderState.IDLE
+
+
+class _FakeRedisPipeline:
+    """Конвейер поддельного Redis: команды копятся и выполняются в execute"""
+
+    def __init__(self, redis, transaction):
+        self.redis = redis
+        self.transaction = transaction
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    def hsetnx(self, key, field, value):
+        self.commands.append(("hsetnx", key, field, value))
+
+    def hset(self, key, mapping):
+        self.commands.append(("hset", key, mapping))
+
+    def expire(self, key, ttl):
+        self.commands.append(("expire", key, ttl))
+
+    async def execute(self):
+        self.redis.executed.append((self.transaction, list(self.commands)))
+        for name, key, *args in self.commands:
+            if name == "hsetnx":
+                self.redis.hashes.setdefault(key, {}).setdefault(*args)
+            elif name == "hset":
+                self.redis.hashes.setdefault(key, {}).update(args[0])
+            else:
+                self.redis.ttls[key] = args[0]
+
+
+class _FakeRedis:
+    """Поддельный redis.asyncio.Redis с хэшами, TTL и конвейером"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.ttls = {}
+        self.executed = []
+
+    def pipeline(self, transaction=True):
+        return _FakeRedisPipeline(self, transaction)
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def delete(self, key):
+        self.hashes.pop(key, None)
+        self.ttls.pop(key, None)
+
+    async def aclose(self):
+        pass
+
+
+@pytest.mark.asyncio
+async def test_fsm_redis_storage_merge_and_ttl():
+    """Тест хранилища в Redis: объединение данных в хэше, продление TTL, сохранение состояния"""
+    from core.fsm import FSM, RedisStorage, OrderState
+
+    redis = _FakeRedis()
+    with patch("redis.asyncio.from_url", return_value=redis) as from_url:
+        storage = RedisStorage("redis://test:6379/0")
+    from_url.assert_called_once_with("redis://test:6379/0", decode_responses=True)
+    state_machine = FSM(storage, ttl=60)
+
+    # Данные без состояния: состояние IDLE ставится только для новой записи
+    await state_machine.update_state_data("1", "vk", {"description": "торт"})
+    assert redis.hashes["fsm:vk:1"] == {"state": "idle", "d:description": '"торт"'}
+
+    await state_machine.set_state("1", "vk", OrderState.WAITING_FOR_WEIGHT, {"weight": 2.5})
+    await state_machine.update_state_data("1", "vk", {"ingredients": ["вишня"]})
+    assert await state_machine.get_session("1", "vk") == (
+        OrderState.WAITING_FOR_WEIGHT, {"description": "торт", "weight": 2.5, "ingredients": ["вишня"]}
+    )
+
+    # Каждая запись - одна транзакция конвейера с продлением TTL ключа
+    assert len(redis.executed) == 3
+    for transaction, commands in redis.executed:
+        assert transaction is True
+        assert commands[-1] == ("expire", "fsm:vk:1", 60)
+    # Обновление данных не перезаписывает текущее состояние
+    assert redis.executed[2][1][0] == ("hsetnx", "fsm:vk:1", "state", "idle")
+    assert not any(name == "hset" and "state" in args[0] for name, _, *args in redis.executed[2][1])
+
+    await state_machine.reset_state("1", "vk")
+    assert "fsm:vk:1" not in redis.hashes
+    assert await state_machine.get_state("1", "vk") == OrderState.IDLE
+
+
+def test_fsm_create_storage_default():
+    """Тест выбора хранилища: память по умолчанию даже при заданном REDIS_URL, Redis - по FSM_STORAGE"""
+    from config import settings
+    from core.fsm import MemoryStorage, RedisStorage, create_storage
+
+    with patch.object(settings, "redis_url", "redis://test:6379/0"), \
+         patch.object(settings, "fsm_storage", None):
+        assert isinstance(create_storage(), MemoryStorage)
+
+    with patch.object(settings, "redis_url", "redis://test:6379/0"), \
+         patch.object(settings, "fsm_storage", "redis"), \
+         patch("redis.asyncio.from_url", return_value=_FakeRedis()):
+        assert isinstance(create_storage(), RedisStorage)
+
+
+
+@pytest.mark.asyncio
+async def test_fsm_persistent_storage_write_behind():
+    """Тест отложенной записи сессий в fsm_sessions и ленивого восстановления"""
+    from core.fsm import FSM, PersistentStorage, OrderState
+
+    stored = {"state": "waiting_for_weight", "data": {"description": "торт"}, "updated_at": None}
+    get_session = AsyncMock(side_effect=lambda user_id, platform: stored if user_id == "u1" else None)
+    upsert = AsyncMock()
+
+    with patch("core.fsm.crud.get_fsm_session", get_session), \
+         patch("core.fsm.crud.upsert_fsm_sessions", upsert):
+        state_machine = FSM(PersistentStorage(ttl=60, flush_interval=3600), ttl=60)
+
+        # Сессия восстанавливается из базы один раз, дальше читается из памяти
+        assert await state_machine.get_state("u1", "vk") == OrderState.WAITING_FOR_WEIGHT
+        await state_machine.set_state("u1", "vk", OrderState.WAITING_FOR_INGREDIENTS, {"weight": 2.0})
+        await state_machine.set_state("u2", "vk", OrderState.WAITING_FOR_DESCRIPTION)
+        assert get_session.await_count == 2
+        upsert.assert_not_awaited()
+
+        await state_machine.storage.close()
+
+    upsert.assert_awaited_once()
+    rows = sorted(upsert.await_args.args[0], key=lambda row: row["user_id"])
+    assert rows == [
+        {"user_id": "u1", "platform": "vk", "state": "waiting_for_ingredients",
+         "data": {"description": "торт", "weight": 2.0}},
+        {"user_id": "u2", "platform": "vk", "state": "waiting_for_description", "data": {}},
+    ]
+
+
+@pytest.mark.asyncio
+async def test_user_cache_read_through():
+    """Тест кэша пользователей: повторные запросы, отрицательный кэш и инвалидация"""
+    from database import crud
+    from database.models import User
+
+    user = User(id="42", platform="vk", platform_user_id="7")
+    fetch = AsyncMock(side_effect=[None, user])
+    crud.user_cache.clear()
+    hits_before = crud.user_cache.stats()["hits"]
+
+    with patch("database.crud._fetch_user_by_platform_id", fetch):
+        # Отсутствие пользователя тоже кэшируется, одновременные запросы - один поход в базу
+        results = await asyncio.gather(*(crud.get_user_by_platform_id("vk", "7") for _ in range(5)))
+        assert results == [None] * 5
+        assert fetch.await_count == 1
+
+        # После сброса записи (как по истечении TTL) пользователь загружается снова
+        crud.user_cache.invalidate(("vk", "7"))
+        assert await crud.get_user_by_platform_id("vk", "7") == user
+        assert await crud.get_user_by_platform_id("vk", "7") == user
+        assert fetch.await_count == 2
+
+        # update_user обновляет запись в кэше
+        updated = {"id": "42", "platform": "vk", "platform_user_id": "7", "first_name": "Анна"}
+        client = MagicMock()
+        client.table.return_value.update.return_value.eq.return_value.execute.return_value.data = [updated]
+        with patch("database.crud.get_supabase_client", return_value=client):
+            await crud.update_user("42", User(platform="vk", platform_user_id="7", first_name="Анна"))
+        assert (await crud.get_user_by_platform_id("vk", "7")).first_name == "Анна"
+        assert fetch.await_count == 2
+
+    assert crud.user_cache.stats()["hits"] > hits_before
+    assert metrics.snapshot()["cache.users.misses"] >= 2
+
+
+@pytest.mark.asyncio
+async def test_db_execute_runs_off_event_loop():
+    """Тест выполнения синхронных запросов Supabase в пуле потоков"""
+    import threading
+    from database.init import execute
+
+    loop_thread = threading.get_ident()
+    query = MagicMock()
+    query.execute.side_effect = lambda: threading.get_ident()
+
+    # Пока запросы выполняются, event loop продолжает обрабатывать другие задачи
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            ticks += 1
+            await asyncio.sleep(0)
+
+    task = asyncio.create_task(ticker())
+    threads = await asyncio.gather(*(execute(query) for _ in range(5)))
+    task.cancel()
+
+    assert loop_thread not in threads
+    assert query.execute.call_count == 5
+    assert ticks > 0
+
+
+@pytest.mark.asyncio
+async def test_postgres_backend_dispatch():
+    """Тест выбора бэкенда asyncpg: те же функции crud, постоянные тексты запросов"""
+    import uuid
+    from decimal import Decimal
+    from config import settings
+    from database import crud, postgres
+    from database.models import Order
+
+    order_id = uuid.uuid4()
+    pool = MagicMock()
+    pool.fetchrow = AsyncMock(return_value={
+        "id": order_id, "user_id": uuid.uuid4(), "platform": "vk", "description": "торт",
+        "weight": Decimal("2.50"), "ingredients": ["шоколад"], "status": "pending",
+    })
+
+    with patch.object(settings, "db_backend", "postgres"), \
+         patch("database.postgres._pool", pool), \
+         patch("database.crud.get_supabase_client", side_effect=AssertionError):
+        order = await crud.get_order_by_id(str(order_id))
+        await crud.create_order(Order(user_id="u1", platform="vk", description="торт", weight=2.5))
+        await crud.create_order(Order(platform="vk", description="наполеон", user_id="u2", weight=1.0))
+
+    assert order.id == str(order_id)
+    assert order.weight == 2.5
+    assert pool.fetchrow.await_args_list[0].args == (postgres.SELECT_ORDER_BY_ID, str(order_id))
+    # Одинаковый набор полей дает один и тот же текст запроса (один prepared statement)
+    first_insert, second_insert = (call.args[0] for call in pool.fetchrow.await_args_list[1:])
+    assert first_insert == second_insert
+    assert first_insert.startswith("INSERT INTO orders (description, platform, user_id, weight)")
+
+
+@pytest.mark.asyncio
+async def test_chat_log_batches_and_drains():
+    """Тест пакетной записи истории: пакеты по размеру, backpressure и сохранение при остановке"""
+    from core.chat_log import ChatLogWriter
+    from database.models import Chat
+
+    batches = []
+    release = asyncio.Event()
+
+    async def fake_create_chats(chats):
+        await release.wait()
+        batches.append([chat.message for chat in chats])
+
+    writer = ChatLogWriter(batch_size=2, flush_interval=3600, max_pending=3)
+    with patch("core.chat_log.crud.create_chats", fake_create_chats):
+        for i in range(3):
+            await writer.write(Chat(user_id="u1", platform="vk", message=str(i)))
+        assert writer.pending == 3
+
+        # Буфер заполнен: запись ждет, пока база примет пакет
+        blocked = asyncio.create_task(writer.write(Chat(user_id="u1", platform="vk", message="3")))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+
+        release.set()
+        await asyncio.wait_for(blocked, 1)
+        await writer.close()
+
+    assert batches[0] == ["0", "1"]
+    assert sum(batches, []) == ["0", "1", "2", "3"]
+    assert writer.pending == 0
+    assert metrics.snapshot()["chat_log.batch_size"]["max"] == 2
+
+
+@pytest.mark.asyncio
+async def test_chat_log_drops_rejected_rows_after_retries():
+    """Тест ограничения повторов записи истории: непринятое базой сообщение не блокирует остальные"""
+    from core.chat_log import ChatLogWriter
+    from database.models import Chat
+
+    saved = []
+    attempts = 0
+
+    async def fake_create_chats(chats):
+        nonlocal attempts
+        attempts += 1
+        # Сообщение удаленного пользователя база не принимает никогда
+        if any(chat.user_id == "deleted" for chat in chats):
+            raise RuntimeError("violates foreign key constraint")
+        saved.extend(chat.message for chat in chats)
+
+    writer = ChatLogWriter(batch_size=3, flush_interval=3600, max_pending=3, max_retries=2)
+    with patch("core.chat_log.crud.create_chats", fake_create_chats):
+        for user_id, message in [("u1", "0"), ("deleted", "1"), ("u2", "2")]:
+            await writer.write(Chat(user_id=user_id, platform="vk", message=message))
+        await writer.flush()
+        assert saved == [] and writer.pending == 3
+
+        # После второй неудачи пакет пишется по одному, сообщение удаленного пользователя отбрасывается
+        await writer.flush()
+        assert saved == ["0", "2"] and writer.pending == 0
+        assert attempts == 2 + 3
+
+        # Буфер освободился: новые сообщения принимаются без ожидания
+        await asyncio.wait_for(writer.write(Chat(user_id="u1", platform="vk", message="3")), 1)
+        await writer.close()
+
+    assert saved == ["0", "2", "3"]
+    assert metrics.snapshot()["chat_log.dropped"] >= 1
+
+
+@pytest.mark.asyncio
+async def test_description_step_runs_calls_concurrently():
+    """Тест шага описания: анализ и ответ AI идут параллельно, ошибка анализа не прерывает диалог"""
+    from core.fsm import FSM, OrderState
+    from database.models import User
+
+    user = User(id="u1", platform="test", platform_user_id="42")
+    started = []
+
+    async def slow_response(prompt, user_info, cache=False, history=None):
+        started.append("response")
+        await asyncio.sleep(0.05)
+        return "AI"
+
+    async def failing_analysis(text):
+        started.append("analysis")
+        await asyncio.sleep(0.05)
+        raise RuntimeError("OpenAI недоступен")
+
+    engine = ConversationEngine(FSM())
+    adapter = RecordingAdapter()
+    await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_DESCRIPTION)
+
+    with patch("core.conversation.get_user_by_platform_id", AsyncMock(return_value=user)), \
+         patch("core.conversation.chat_log", MagicMock(write=AsyncMock())), \
+         patch("core.conversation.generate_response", slow_response), \
+         patch("core.conversation.analyze_order_description", failing_analysis):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        # Начинка не разобрана регулярными выражениями - нужен анализ моделью
+        text = "Торт, начинка на ваш вкус"
+        await engine.handle(adapter, IncomingMessage(platform="test", platform_user_id="42", text=text))
+        elapsed = loop.time() - start
+
+    assert sorted(started) == ["analysis", "response"]
+    assert elapsed < 0.09
+    assert adapter.sent == ["AI", "Теперь укажите вес торта в килограммах:"]
+    assert await engine.fsm.get_session("u1", "test") == (OrderState.WAITING_FOR_WEIGHT, {"description": text})
+
+
+@pytest.mark.asyncio
+async def test_cake_image_cache(tmp_path):
+    """Тест кэша изображений: нормализованный ключ, повторный заказ без DALL-E, вытеснение по размеру"""
+    from ai import image_cache
+    from ai.image_cache import DiskImageStore, get_cake_image, image_key
+
+    assert image_key("Шоколадный торт!", 2.1) == image_key("шоколадный  торт", 1.9)
+    assert image_key("шоколадный торт", 2.0) != image_key("шоколадный торт", 3.0)
+
+    store = DiskImageStore(str(tmp_path), max_bytes=10, ttl=3600)
+    generate = AsyncMock(return_value="https://openai/tmp.png")
+    download = AsyncMock(return_value=b"12345678")
+
+    with patch.object(image_cache, "image_store", store), \
+         patch("ai.image_cache.generate_cake_image", generate), \
+         patch("ai.image_cache._download", download), \
+         patch.object(image_cache.settings, "public_base_url", "https://bot.example.com"):
+        first, second = await asyncio.gather(
+            get_cake_image("Шоколадный торт", 2.0),
+            get_cake_image("шоколадный торт.", 2.0)
+        )
+        again = await get_cake_image("Шоколадный торт", 2.2)
+
+        assert first.data == second.data == again.data == b"12345678"
+        assert again.url == f"https://bot.example.com/images/{again.key}.png"
+        # Временная ссылка OpenAI есть только у только что сгенерированного изображения
+        assert first.source_url == second.source_url == "https://openai/tmp.png"
+        assert again.source_url is None
+        generate.assert_awaited_once()
+
+        # Новое изображение не помещается вместе со старым - старое вытесняется
+        await get_cake_image("Медовик", 1.0)
+        assert store.get(first.key) is None
+        assert generate.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_link_only_adapter_image_without_public_url(caplog):
+    """Тест отправки изображения ссылкой без PUBLIC_BASE_URL: временная ссылка OpenAI, иначе предупреждение"""
+    from database.models import Order
+
+    engine = ConversationEngine(MagicMock())
+    adapter = RecordingAdapter()
+    order = Order(id="o1", user_id="u1", platform="test", description="Медовик")
+    fresh = CakeImage(key="0" * 64, data=b"png", source_url="https://openai/tmp.png")
+    update_order = AsyncMock()
+
+    with patch("core.conversation.get_cake_image", AsyncMock(return_value=fresh)), \
+         patch("core.conversation.update_order", update_order):
+        await engine._deliver_image(adapter, order, {"description": "Медовик"})
+    assert adapter.sent == ["Вот как будет выглядеть ваш торт! https://openai/tmp.png"]
+    assert update_order.await_args.args[1].image_url == "https://openai/tmp.png"
+
+    # Изображение из кэша без постоянной ссылки отправить нечем - это видно в логе
+    adapter.sent.clear()
+    cached = CakeImage(key="1" * 64, data=b"png")
+    with patch("core.conversation.get_cake_image", AsyncMock(return_value=cached)), \
+         patch("core.conversation.update_order", AsyncMock()), \
+         caplog.at_level("WARNING", logger="core.conversation"):
+        await engine._deliver_image(adapter, order, {"description": "Медовик"})
+    assert adapter.sent == []
+    assert "PUBLIC_BASE_URL" in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_response_cache_for_frequent_questions():
+    """Тест кэша ответов в generate_response: нормализация, варианты промпта, похожие вопросы, ошибки"""
+    from ai.chat import ERROR_RESPONSE, generate_response
+    from ai.prompts import prompts
+    from ai.providers import ChatProvider, LocalProvider
+    from ai.response_cache import ResponseCache, TrigramIndex
+    from ai.router import LLMRouter
+
+    class CountingProvider(ChatProvider):
+        name = "openai"
+
+        def __init__(self, reply=None, error=None):
+            self.reply = reply
+            self.error = error
+            self.calls = 0
+
+        async def complete(self, messages, **params):
+            self.calls += 1
+            if self.error is not None:
+                raise self.error
+            return self.reply
+
+    cache = ResponseCache(max_size=10, ttl=60, index=TrigramIndex(threshold=0.7))
+    provider = CountingProvider("Да, доставляем по городу")
+    adult_female = {"age": 30, "gender": "Female"}
+    senior = {"age": 70}
+
+    with patch("ai.chat.response_cache", cache), patch("ai.chat.router", LLMRouter([provider], hedge=False)):
+        assert await generate_response("Доставляете?", adult_female, cache=True) == "Да, доставляем по городу"
+        assert await generate_response("доставляете", adult_female, cache=True) == "Да, доставляем по городу"
+        # Похожий вопрос отвечается из кэша, другой вариант промпта - нет
+        assert await generate_response("а доставляете?", adult_female, cache=True) == "Да, доставляем по городу"
+        await generate_response("Доставляете?", senior, cache=True)
+    assert provider.calls == 2
+    assert metrics.snapshot()["cache.responses.similar_hits"] >= 1
+    prompt_key, _ = prompts.select(adult_female)
+    assert cache.get(prompt_key, "Доставляете?") == "Да, доставляем по городу"
+
+    # Ошибка модели и шаблонный ответ запасного провайдера в кэш не попадают
+    failing = CountingProvider(error=RuntimeError("429"))
+    with patch("ai.chat.response_cache", cache), patch("ai.chat.router", LLMRouter([failing], hedge=False)):
+        assert await generate_response("Сколько стоит торт?", adult_female, cache=True) == ERROR_RESPONSE
+    with patch("ai.chat.response_cache", cache), patch("ai.chat.router", LLMRouter([LocalProvider()], hedge=False)):
+        await generate_response("Сколько стоит торт?", adult_female, cache=True)
+    assert cache.get(prompt_key, "Сколько стоит торт?") is None
+
+
+@pytest.mark.asyncio
+async def test_tiered_extraction_calls_llm_only_for_missing_fields():
+    """Тест двухуровневого извлечения: модель вызывается только за недостающими полями"""
+    from core.extraction import TieredExtractor, extract_local
+
+    local = extract_local("Шоколадный торт 2 кг к 20.12.2030")
+    assert local.values == {"weight": 2.0, "ingredients": ["шоколад"], "delivery_date": "20.12.2030"}
+    # Число без единиц измерения - неуверенный вес
+    assert extract_local("Торт на 5 лет").confidence["weight"] < 0.6
+
+    llm = AsyncMock(return_value={"weight": 1.5, "ingredients": ["манго"], "delivery_date": "к пятнице"})
+    extractor = TieredExtractor(min_confidence=0.6)
+
+    result = await extractor.extract("Шоколадный торт 2 кг к 20.12.2030", llm)
+    assert result.values["weight"] == 2.0
+    llm.assert_not_awaited()
+
+    result = await extractor.extract("Торт 3 кг, начинка на ваш вкус", llm)
+    llm.assert_awaited_once()
+    assert result.values == {"weight": 3.0, "ingredients": ["манго"]}
+    assert result.source == {"weight": "local", "ingredients": "llm"}
+
+    # Без признаков недостающих полей модель не нужна, неуверенный вес не возвращается
+    llm.reset_mock()
+    result = await extractor.extract("Торт на 5 лет", llm)
+    llm.assert_not_awaited()
+    assert result.values == {}
+
+
+def test_extract_order_fields_single_pass():
+    """Тест извлечения всех полей за один проход"""
+    from datetime import datetime
+    from core.utils import extract_order_fields
+
+    fields = extract_order_fields("Шоколадный торт с кремом 1500 г к 2030-12-30")
+    assert fields.weight == 1.5 and fields.weight_has_unit
+    assert fields.delivery_date == datetime(2030, 12, 30)
+    assert fields.ingredients == ["шоколад", "крем"]
+
+    # Числа даты не принимаются за вес, некорректная дата пропускается
+    fields = extract_order_fields("торт 30.02.2030 или 01.03.30")
+    assert fields.weight is None and not fields.weight_has_unit
+    assert fields.delivery_date == datetime(2030, 3, 1)
+    # "г" в начале слова - не граммы
+    assert extract_order_fields("торт на 2 года").weight_has_unit is False
+
+
+def test_lexicon_matches_inflections_and_reloads(tmp_path):
+    """Тест словаря: падежные формы, синонимы, отрицание и перечитывание файла"""
+    import json
+    import os
+    from core.lexicon import Lexicon
+    from core.utils import extract_order_fields
+
+    path = tmp_path / "lexicon.json"
+    path.write_text(json.dumps({"ingredients": {
+        "cherry": {"name": "вишня", "stems": ["вишн", "вишен"]},
+        "blueberry": {"name": "черника", "stems": ["черник", "голубик"]},
+        "poppy": {"name": "мак", "stems": ["мак$", "маком$", "маков"]},
+    }, "decor": {"fondant": {"name": "мастика", "stems": ["мастик"]}}}), encoding="utf-8")
+    lexicon = Lexicon(str(path), reload_interval=0)
+
+    fields = extract_order_fields("Вишнёвый торт с голубикой и маком, без мастики, макет", lexicon)
+    assert fields.ingredients == ["вишня", "черника", "мак"]
+    assert fields.decor == []
+    assert [entry.id for entry in lexicon.match("Мастика и вишни")] == ["fondant", "cherry"]
+
+    path.write_text(json.dumps({"ingredients": {"mango": {"name": "манго", "stems": ["манго"]}}}), encoding="utf-8")
+    os.utime(path, (0, os.stat(path).st_mtime + 10))
+    assert extract_order_fields("с вишней и манго", lexicon).ingredients == ["манго"]
+
+    # Ошибка в файле не ломает извлечение: работает предыдущая версия
+    path.write_text("{", encoding="utf-8")
+    os.utime(path, (0, os.stat(path).st_mtime + 20))
+    assert extract_order_fields("с манго", lexicon).ingredients == ["манго"]
+
+
+def test_extract_russian_dates():
+    """Названия месяцев, дни недели и относительные даты отсчитываются от момента сообщения"""
+    import json
+    import os
+    from datetime import datetime, timezone
+
+    with open(os.path.join("benchmarks", "data", "date_expressions.json"), encoding="utf-8") as f:
+        corpus = json.load(f)
+    now = datetime.fromisoformat(corpus["now"])
+    for item in corpus["items"]:
+        parsed = extract_date_from_text(item["text"], now=now)
+        assert (parsed.strftime("%Y-%m-%d") if parsed else None) == item["date"], item["text"]
+
+    # 22:30 UTC 10 марта - уже 11 марта в Москве, "завтра" - 12 марта
+    now = datetime(2030, 3, 10, 22, 30, tzinfo=timezone.utc)
+    assert extract_date_from_text("Доставка завтра", now=now) == datetime(2030, 3, 12)
+
+
+@pytest.mark.asyncio
+async def test_ai_client_retries_and_adapts_concurrency():
+    """Тест клиента OpenAI: повтор после 429, уменьшение лимита одновременных запросов, очередь"""
+    from ai.client import AIClient, AIMDLimiter
+
+    class RateLimitError(Exception):
+        http_status = 429
+
+    client = AIClient(retry_base_delay=0.001, initial_concurrency=8)
+    limits = client.configure("test-model", requests_per_minute=600, tokens_per_minute=60000)
+    mock_response = MagicMock()
+    create = AsyncMock(side_effect=[RateLimitError("429"), mock_response])
+
+    response = await client.call("test-model", create, tokens=100)
+
+    assert response is mock_response
+    assert create.call_count == 2
+    assert limits.limiter.limit < 8
+    assert metrics.counter("ai.test-model.rate_limited").value == 1
+    assert metrics.histogram("ai.test-model.queue_wait").count == 2
+
+    # Ошибки, не связанные с перегрузкой, не повторяются
+    create = AsyncMock(side_effect=ValueError("bad request"))
+    with pytest.raises(ValueError):
+        await client.call("test-model", create)
+    assert create.call_count == 1
+
+    # Сверх лимита запросы ждут освобождения места
+    limiter = AIMDLimiter(initial=1)
+    await limiter.acquire()
+    waiting = asyncio.ensure_future(limiter.acquire())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    limiter.release()
+    await asyncio.wait_for(waiting, 1)
+    assert limiter.in_flight == 1
+
+
+@pytest.mark.asyncio
+async def test_telegram_streaming_reply_coalesces_edits():
+    """Тест потокового ответа: первое сообщение сразу, правки не чаще интервала, метрика ttfb"""
+    from ai.client import AIClient
+    from bots.telegram import TelegramAdapter
+
+    async def fake_stream():
+        for word in ["Какой ", "вес ", "торта ", "вам ", "нужен", "?"]:
+            await asyncio.sleep(0.02)
+            yield word
+
+    client = AIClient()
+    chunks = [chunk async for chunk in client.stream("stream-model", AsyncMock(return_value=fake_stream()))]
+    assert "".join(chunks) == "Какой вес торта вам нужен?"
+    assert metrics.histogram("ai.stream-model.ttfb").count == 1
+    assert client.limits("stream-model").limiter.in_flight == 0
+
+    sent = MagicMock()
+    sent.edit_text = AsyncMock()
+    message = MagicMock()
+    message.answer = AsyncMock(return_value=sent)
+    adapter = TelegramAdapter(message, edit_interval=0.05)
+
+    text = await adapter.send_stream(fake_stream())
+
+    assert text == "Какой вес торта вам нужен?"
+    message.answer.assert_awaited_once_with("Какой ")
+    # Шесть частей - одно сообщение и не больше трех правок, последняя - полный текст
+    assert 1 <= sent.edit_text.await_count <= 3
+    assert sent.edit_text.await_args.args[0] == "Какой вес торта вам нужен?"
+
+
+@pytest.mark.asyncio
+async def test_context_builder_budget_and_cold_load():
+    """Тест контекста диалога: загрузка из базы один раз, бюджет токенов, кэш собранной истории"""
+    import time
+    from ai.chat import _chat_messages
+    from core.context import ContextBuilder, Turn
+
+    now = time.time()
+    load = AsyncMock(return_value=[Turn("Старый вопрос", "Старый ответ", now - 7200),
+                                   Turn("Торт с вишней?", "Да, делаем", now - 60)])
+    builder = ContextBuilder(max_turns=3, token_budget=60, max_age=3600, load=load)
+
+    history = await builder.messages("u1")
+    # Реплика старше max_age не попадает в историю
+    assert history == [{"role": "user", "content": "Торт с вишней?"},
+                       {"role": "assistant", "content": "Да, делаем"}]
+    assert await builder.messages("u1") is history
+    load.assert_awaited_once_with("u1", 3)
+
+    for i in range(5):
+        builder.append("u1", f"Вопрос {i}", "Ответ " + "очень длинный " * i)
+    history = await builder.messages("u1")
+    assert load.await_count == 1
+    # Самые новые реплики в пределах 60 токенов (оценка 30 + 26), буфер - последние 3 обмена
+    assert [message["content"] for message in history] == [
+        "Вопрос 3", "Ответ " + "очень длинный " * 3, "Вопрос 4", "Ответ " + "очень длинный " * 4
+    ]
+
+    messages = _chat_messages("system", "Сколько стоит?", history)
+    assert messages[0]["content"] == "system"
+    assert messages[-1] == {"role": "user", "content": "Сколько стоит?"}
+    assert messages[1:-1] == history
+
+
+def test_prompt_registry_precomputed_and_ab_sticky():
+    """Тест реестра промптов: все варианты собраны заранее, A/B-версия постоянна для клиента"""
+    from types import SimpleNamespace
+    from ai.client import ModelLimits, AIMDLimiter
+    from ai.prompts import PROMPT_BUILDERS, VARIANTS, PromptRegistry, build_system_prompt
+
+    registry = PromptRegistry(PROMPT_BUILDERS, version="v1", ab_version="v2", ab_share=0.5)
+    key, prompt = registry.select({"id": "u1", "age": 70, "gender": "female"})
+    version = key.split("/")[0]
+    assert key == f"{version}/senior:female"
+    # Один и тот же объект строки - промпт не собирается заново
+    assert registry.select({"id": "u1", "age": 70, "gender": "female"})[1] is prompt
+    assert registry.get("v1", "senior:female") == build_system_prompt("senior:female")
+
+    versions = [registry.version_for(f"user-{i}") for i in range(1000)]
+    assert 400 < versions.count("v2") < 600
+    assert versions == [registry.version_for(f"user-{i}") for i in range(1000)]
+    # В v2 общее начало промпта одинаково для всех вариантов
+    v2 = [registry.get("v2", variant) for variant in VARIANTS]
+    assert all(p.startswith(registry.get("v2", ":")) for p in v2)
+
+    with pytest.raises(ValueError):
+        PromptRegistry(PROMPT_BUILDERS, version="v9")
+
+    limits = ModelLimits("usage-model", 0, 6000, AIMDLimiter(1))
+    usage = SimpleNamespace(total_tokens=120, prompt_tokens=100, completion_tokens=20,
+                            prompt_tokens_details=SimpleNamespace(cached_tokens=64))
+    limits.settle(500, SimpleNamespace(usage=usage))
+    assert metrics.histogram("ai.usage-model.cached_tokens").percentile(50) == 64
+    assert metrics.histogram("ai.usage-model.prompt_tokens").percentile(50) == 100
+
+
+@pytest.mark.asyncio
+async def test_llm_router_hedges_slow_provider_and_opens_breaker():
+    """Тест маршрутизатора моделей: дубль медленного запроса, предохранитель, локальный провайдер"""
+    import asyncio
+    from ai.providers import LOCAL_REPLY, ChatProvider, LocalProvider
+    from ai.router import LLMRouter
+
+    class FakeProvider(ChatProvider):
+        def __init__(self, name, delay=0.0, fail=False):
+            self.name, self.delay, self.fail = name, delay, fail
+            self.calls = self.cancelled = 0
+
+        async def complete(self, messages, **params):
+            self.calls += 1
+            try:
+                await asyncio.sleep(self.delay)
+            except asyncio.CancelledError:
+                self.cancelled += 1
+                raise
+            if self.fail:
+                raise RuntimeError("503 Service Unavailable")
+            return f"ответ {self.name}"
+
+    messages = [{"role": "user", "content": "Торт на субботу успеете?"}]
+    slow, fast = FakeProvider("slow", delay=0.5), FakeProvider("fast", delay=0.01)
+    router = LLMRouter([slow, fast, LocalProvider()], hedge_default_delay=0.05, hedge_min_delay=0.01)
+
+    # slow не ответил к дедлайну - запрос продублирован fast, медленный запрос отменен
+    assert await router.complete(messages) == ("ответ fast", "fast", False)
+    await asyncio.sleep(0)
+    assert slow.cancelled == 1
+    # По EWMA задержки fast теперь первый, slow больше не вызывается
+    assert (await router.complete(messages)).provider == "fast"
+    assert slow.calls == 1
+
+    broken = FakeProvider("broken", fail=True)
+    router = LLMRouter([broken, LocalProvider()], hedge=False, breaker_failures=2, breaker_cooldown=60)
+    for _ in range(3):
+        assert await router.complete(messages) == (LOCAL_REPLY, "local", True)
+    # После двух ошибок подряд провайдер отключен: третий запрос к нему не ушел
+    assert broken.calls == 2
+    assert router.state("broken").breaker.state == "open"
+    assert [chunk.text async for chunk in router.stream(messages)] == [LOCAL_REPLY]
+    assert (await router.complete(messages, response_format={"type": "json_object"})).text == "{}"
+
+
+@pytest.mark.asyncio
+async def test_deadline_from_message_degrades_to_next_question():
+    """Тест дедлайна сообщения: медленная модель прерывается, диалог продолжается шаблонным вопросом"""
+    import time
+    from ai.providers import ChatProvider
+    from ai.router import LLMRouter
+    from config import settings
+    from core.context import ContextBuilder
+    from core.conversation import ASK_DELIVERY_DATE_TEXT, ASK_INGREDIENTS_TEXT
+    from core.fsm import FSM, OrderState
+    from core.metrics import metrics
+    from database.models import User
+
+    class HangingProvider(ChatProvider):
+        name = "hanging"
+
+        async def complete(self, messages, **params):
+            await asyncio.sleep(10)
+            return "не успел"
+
+    user = User(id="u1", platform="test", platform_user_id="42")
+    engine = ConversationEngine(FSM(), context=ContextBuilder(load=AsyncMock(return_value=[])))
+    adapter = RecordingAdapter()
+    timeouts = metrics.counter("conversation.timeouts.waiting_for_weight")
+    degraded = metrics.counter("conversation.degraded.waiting_for_weight")
+    before = (timeouts.value, degraded.value)
+
+    def late_message(text):
+        # Сообщение пролежало в очереди почти весь дедлайн - на модель осталось 50 мс
+        return IncomingMessage(platform="test", platform_user_id="42", text=text,
+                               received_at=time.monotonic() - settings.ai_reply_deadline + 0.05)
+
+    with patch("ai.chat.router", LLMRouter([HangingProvider()], hedge=False)), \
+         patch("core.conversation.get_user_by_platform_id", AsyncMock(return_value=user)), \
+         patch("core.conversation.chat_log", MagicMock(write=AsyncMock())):
+        await engine.fsm.set_state("u1", "test", OrderState.WAITING_FOR_WEIGHT)
+        started = time.monotonic()
+        await engine.handle(adapter, late_message("два килограмма"))
+        assert time.monotonic() - started < 0.5
+
+        await engine.handle(adapter, late_message("вишня"))
+
+    # Извлечение веса и ответ делят один дедлайн: оба вызова истекли, ответ - следующий вопрос
+    assert adapter.sent == [ASK_INGREDIENTS_TEXT, ASK_DELIVERY_DATE_TEXT]
+    assert (timeouts.value - before[0], degraded.value - before[1]) == (2, 1)
+    assert await engine.fsm.get_session("u1", "test") == (
+        OrderState.WAITING_FOR_DELIVERY_DATE, {"weight": None, "ingredients": "вишня"}
+    )
+
+
+@pytest.mark.asyncio
+async def test_fsm_sessions_flush_postgres_and_retry_cap():
+    """Тест записи fsm_sessions: бэкенд asyncpg при DB_BACKEND=postgres, ограничение повторов"""
+    from config import settings
+    from core.fsm import PersistentStorage
+    from database import crud
+
+    rows = [{"user_id": "u1", "platform": "vk", "state": "idle", "data": {}}]
+    upsert = AsyncMock()
+    with patch.object(settings, "db_backend", "postgres"), \
+         patch("database.postgres.upsert_fsm_sessions", upsert), \
+         patch("database.crud.get_supabase_client", side_effect=AssertionError):
+        await crud.upsert_fsm_sessions(rows)
+    upsert.assert_awaited_once_with(rows)
+
+    failing = AsyncMock(side_effect=RuntimeError("база недоступна"))
+    with patch("core.fsm.crud.get_fsm_session", AsyncMock(return_value=None)), \
+         patch("core.fsm.crud.upsert_fsm_sessions", failing):
+        storage = PersistentStorage(ttl=60, flush_interval=3600, max_retries=3)
+        await storage.save("vk:u1", "waiting_for_weight", {}, 60)
+        for _ in range(5):
+            await storage.flush()
+        storage._flush_task.cancel()
+
+    # Три неудачные попытки, после них сессия больше не повторяется
+    assert failing.await_count == 3
+    assert not storage._dirty
+
+
+@pytest.mark.asyncio
+async def test_faq_cache_served_with_dialog_history():
+    """Тест кэша частых вопросов при непустой истории: самостоятельный вопрос - из кэша, отсылка - моделью"""
+    from ai.chat import generate_response
+    from ai.providers import ChatProvider
+    from ai.response_cache import ResponseCache
+    from ai.router import LLMRouter
+
+    class RecordingProvider(ChatProvider):
+        name = "recording"
+
+        def __init__(self):
+            self.requests = []
+
+        async def complete(self, messages, **params):
+            self.requests.append(messages)
+            return f"ответ {len(self.requests)}"
+
+    provider = RecordingProvider()
+    history = [{"role": "user", "content": "Торт с вишней"}, {"role": "assistant", "content": "Отличный выбор"}]
+    user = {"id": "u1", "age": 30, "gender": "female"}
+
+    with patch("ai.chat.router", LLMRouter([provider], hedge=False)), \
+         patch("ai.chat.response_cache", ResponseCache(max_size=10, ttl=60)):
+        assert await generate_response("Доставляете?", user, cache=True, history=history) == "ответ 1"
+        # Второй клиент с другой историей получает ответ из кэша
+        other = [{"role": "user", "content": "Медовик"}, {"role": "assistant", "content": "Хорошо"}]
+        assert await generate_response("доставляете", {"id": "u2", "age": 30, "gender": "female"},
+                                       cache=True, history=other) == "ответ 1"
+        # Вопрос с отсылкой к прошлым репликам зависит от истории - не кэшируется
+        assert await generate_response("А его можно доставить?", user, cache=True, history=history) == "ответ 2"
+        assert await generate_response("А его можно доставить?", user, cache=True, history=history) == "ответ 3"
+
+    # Кэшируемый ответ сгенерирован без истории, ответ на отсылку - с историей
+    assert len(provider.requests[0]) == 2
+    assert provider.requests[1][1:3] == history
+
+
+def _aiohttp_response(payload=None):
+    """Ответ aiohttp для `async with session.get(...)`"""
+    response = MagicMock()
+    response.json = AsyncMock(return_value=payload)
+    context = MagicMock()
+    context.__aenter__ = AsyncMock(return_value=response)
+    context.__aexit__ = AsyncMock(return_value=False)
+    return context
+
+
+@pytest.mark.asyncio
+async def test_avito_client_token_messages_and_send():
+    """Тест клиента Avito: токен получается один раз на все запросы, заголовок Bearer, отправка JSON"""
+    from bots.avito import AVITO_API_URL, AvitoClient
+
+    session = MagicMock(closed=False)
+    session.post.side_effect = [_aiohttp_response({"access_token": "t1", "expires_in": 3600}),
+                                _aiohttp_response()]
+    session.get.return_value = _aiohttp_response({"messages": [{"id": "m1", "conversation_id": "c1"}]})
+    client = AvitoClient()
+    client._session = session
+
+    assert await client.get_new_messages() == [{"id": "m1", "conversation_id": "c1"}]
+    await client.send_message("c1", "Здравствуйте!")
+
+    token_call, send_call = session.post.call_args_list
+    assert token_call.args[0] == f"{AVITO_API_URL}/oauth/token"
+    assert token_call.kwargs["data"]["grant_type"] == "client_credentials"
+    assert session.get.call_args.kwargs["headers"]["Authorization"] == "Bearer t1"
+    assert send_call.args[0].endswith("/conversations/c1/messages")
+    assert send_call.kwargs["json"] == {"text": "Здравствуйте!"}
+    assert send_call.kwargs["headers"]["Authorization"] == "Bearer t1"
+
+
+@pytest.mark.asyncio
+async def test_avito_poll_skips_seen_messages_and_keeps_chat_order():
+    """Тест опроса Avito: повторно полученные сообщения не обрабатываются, порядок внутри диалога сохраняется"""
+    from bots import avito
+    from core.cache import TTLCache
+
+    # Непрочитанные сообщения приходят при каждом опросе, новые сначала
+    unread = [
+        {"id": "a2", "conversation_id": "A", "user_id": "1", "text": "на субботу", "created": 2},
+        {"id": "b1", "conversation_id": "B", "user_id": "2", "text": "медовик", "created": 1},
+        {"id": "a1", "conversation_id": "A", "user_id": "1", "text": "торт", "created": 1},
+    ]
+    handled = []
+
+    async def slow_handle(message_data, received_at=None):
+        # Первое сообщение диалога обрабатывается дольше второго - порядок держит диспетчер
+        await asyncio.sleep(0.02 if message_data["id"].endswith("1") else 0)
+        handled.append(message_data["id"])
+
+    client = MagicMock(get_new_messages=AsyncMock(return_value=unread), mark_read=AsyncMock())
+    with patch.object(avito, "client", client), \
+         patch.object(avito, "dispatcher", KeyedDispatcher("avito-test", max_in_flight=4)), \
+         patch.object(avito, "seen_messages", TTLCache("avito_seen_test", max_size=100, ttl=60)), \
+         patch.object(avito, "handle_message", slow_handle):
+        assert await avito.poll_avito_messages() == 3
+        assert await avito.poll_avito_messages() == 0
+        # Тот же ID из вебхука тоже не обрабатывается повторно
+        await avito.enqueue_webhook_event({"payload": {"type": "message", "value": {
+            "id": "b1", "chat_id": "B", "author_id": "2", "content": {"text": "медовик"}}}})
+        await avito.dispatcher.join()
+
+    assert sorted(handled) == ["a1", "a2", "b1"]
+    assert handled.index("a1") < handled.index("a2")
+    assert {call.args[0] for call in client.mark_read.await_args_list} == {"A", "B"}